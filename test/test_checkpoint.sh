@@ -0,0 +1,15 @@
+#!/bin/bash
+#
+# Count to $2 a second at a time, saving the count to the checkpoint $1 on
+# SIGTERM and resuming from it with a third argument "resume". Every run
+# appends its starting count to run/checkpoint-log.
+#
+
+i=0
+[ "$3" = resume ] && i=$(cat "$1")
+echo $i >> run/checkpoint-log
+trap 'echo $i > "$1"; exit 143' TERM
+while [ $i -lt $2 ]; do
+	sleep 1 & wait $!
+	i=$((i + 1))
+done
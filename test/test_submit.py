@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 
+import json
 import os
 import sys
 import logging
+import threading
+import time
 
-from yatamana import LocalTaskManager, SgeTaskManager, SlurmTaskManager, Task
+from yatamana import (
+        AllocationOfTasksTask, CeleryTaskManager, CheckpointingMixin,
+        CondorTaskManager, DeferredSubmitter, FederatedTaskManager,
+        LocalTaskManager, LogArchive, Plan, ResultStore, ScratchStagingMixin,
+        SgeTaskManager, SlurmTaskManager, Speculator, SubmissionGovernor,
+        Sweep, Task, TaskTable, UpToDateFinishedMixin, Watchdog,
+        find_unfinished, get_task_manager, read_stats)
+from yatamana.placement_policy import SgePlacementPolicy, SlurmPlacementPolicy
+from yatamana import up_to_date_finished_mixin
 
 
 def setup_log(level=logging.WARNING):
@@ -43,6 +54,43 @@ class Test2Task(Task):
         return False
 
 
+class CopyTask(UpToDateFinishedMixin, Task):
+    __slots__ = ('inputs', 'outputs')
+
+    def __init__(self, src, dst):
+        super(CopyTask, self).__init__()
+        self.inputs = [src]
+        self.outputs = [dst]
+        self.command = ['cp', src, dst]
+
+
+class AppendTask(Task):
+    def __init__(self, line, condition='true'):
+        super(AppendTask, self).__init__()
+        self.command = [
+            condition, '&&', 'echo', str(line), '>>', 'run/chunk-log']
+
+
+class CountTask(CheckpointingMixin, Task):
+    def __init__(self, n, walltime):
+        super(CountTask, self).__init__()
+        self.checkpoint = 'run/checkpoint-%d' % n
+        self.command = ['./test_checkpoint.sh', self.checkpoint, str(n)]
+        self.resume_command = self.command + ['resume']
+        self.opts['walltime'] = walltime
+
+
+class StagedTask(ScratchStagingMixin, Task):
+    __slots__ = ('inputs', 'outputs')
+    claim_wait = 2
+
+    def __init__(self, src, dst):
+        super(StagedTask, self).__init__()
+        self.inputs = [src]
+        self.outputs = [dst]
+        self.command = ['cp', src, dst]
+
+
 def test_sge():
     task_manager = SgeTaskManager(setup_file='sge-setup.json')
     task = TestTask('param')
@@ -76,6 +124,811 @@ def test_local():
         task_manager.enqueue(task2)
 
 
+def test_local_allocation():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['runner']['opts'] = {'walltime': 1}
+    task_manager = LocalTaskManager(setup_file=setup)
+    tasks = [Test2Task(i) for i in range(5)]
+    for allocation in task_manager.enqueue_chunked(
+            tasks, n=5, wrapper=AllocationOfTasksTask):
+        assert allocation.opts['nodes'] == 2
+        # Five tasks of a minute on four cores.
+        assert allocation.opts['walltime'] == 120
+        command = allocation.render_command()
+        assert command.count(
+            './fake-srun --exclusive -N 1 -n 1 -c 1 "$BASH" -c') == 5
+
+
+def test_local_task_table():
+    task_manager = LocalTaskManager(setup_file='local-setup.json')
+    table = TaskTable(Test2Task)
+    for i in range(7):
+        table.append(param=i, param_default='p%d' % (i % 2))
+    assert table[-1].command == ['./test_run2.py', '6', 'p0']
+    chunks = list(task_manager.enqueue_chunked(table, n=3))
+    assert len(chunks) == 3
+    assert chunks[0].tasks[0]._defaults is chunks[2].tasks[0]._defaults
+
+
+def test_local_sweep():
+    task_manager = LocalTaskManager(setup_file='local-setup.json')
+    sweep = Sweep(Test2Task, block_size=4).product([('param', range(3))])
+    sweep.zip([('param_default', ['a', 'b'])])
+    assert len(sweep) == 6 and sweep.count_chunks(4) == 2
+    assert sweep.get_row(3) == {'param': 1, 'param_default': 'b'}
+    assert [t.command[1:] for t in sweep][3:5] == [['1', 'b'], ['2', 'a']]
+    chunks = list(task_manager.enqueue_chunked(sweep, n=4))
+    assert len(chunks) == 2
+    sweep = Sweep(lambda: Test2Task(0),
+                  command=['./test_run2.py', '%(param)s', 'x'])
+    sweep.product([('param', range(100))]).sample(7, seed=1)
+    assert len(sweep) == 7 and sweep[0].command[2] == 'x'
+    chunks = list(task_manager.enqueue_chunked(sweep, n=3))
+    assert len(chunks) == 3
+    assert sweep.sample(10).indices is not None
+    sweep = Sweep(Test2Task).product([('param', range(10 ** 6))])
+    sweep.product([('param_default', range(10 ** 6))])
+    assert sweep.sample(10 ** 13).indices is None
+    sampled = list(sweep.sample(5, seed=1).indices)
+    assert len(sweep) == 5 and sampled == sorted(sampled)
+    assert set(sweep.sample(3, seed=1).indices) <= set(sampled)
+
+
+def test_local_shell_transport():
+    task_manager = LocalTaskManager(
+            setup_file='local-setup.json', transport={'type': 'shell'})
+    for i in range(3):
+        task_manager.enqueue(Test2Task(i))
+    assert task_manager.transport.process is not None
+    task_manager.transport.close()
+
+
+def test_local_condor_dag():
+    task_manager = CondorTaskManager(setup_file='condor-setup.json')
+    tasks = [Test2Task(i) for i in range(4)]
+    tasks[1].opts['dependencies'] = [tasks[0]]
+    tasks[2].opts['dependencies'] = [tasks[0], tasks[1]]
+    enqueued = task_manager.enqueue_dag(reversed(tasks))
+    assert enqueued.index(tasks[0]) < enqueued.index(tasks[2])
+    assert all(task.job_id == 1 for task in enqueued)
+    # Tasks enqueued more than once keep sharing their defaults.
+    assert tasks[0]._defaults is tasks[3]._defaults
+    # A timed out submission is looked up by its runner.
+    task_manager = CondorTaskManager(
+            setup_file='condor-setup.json', status_command='./fake-condor_q')
+    write_fake_queue(['7 1 a-abc run/a.sh', '8 2 b-abc run/b.sh'])
+    out = task_manager.find_submission(['condor_submit', 'run/b.sub'])
+    assert task_manager.get_job_id(out) == 8
+    assert task_manager.find_submission(['condor_submit', 'run/c.sub']) \
+        is None
+    # Jobs cannot be enqueued depending on running ones.
+    tasks = [Test2Task(i) for i in range(2)]
+    tasks[1].opts['dependencies'] = [tasks[0]]
+    try:
+        list(DeferredSubmitter(task_manager, lead=300).run(tasks))
+    except ValueError:
+        assert all(task.job_id is None for task in tasks)
+    else:
+        assert False, 'Enqueued jobs depending on other jobs.'
+
+
+def test_local_graph():
+    task_manager = LocalTaskManager(setup_file='local-setup.json')
+    tasks = [Test2Task(i) for i in range(3)]
+    tasks[2].opts['dependencies'] = [tasks[0]]
+    for task, walltime in zip(tasks, [2, 1, 2]):
+        task.opts['walltime'] = walltime
+    enqueued = task_manager.enqueue_graph(tasks)
+    assert enqueued.index(tasks[0]) < enqueued.index(tasks[2])
+    # The slack of the second task is three quarters of the critical path.
+    assert [task.opts['nice'] for task in tasks] == [0, 750, 0]
+    assert tasks[0]._defaults is tasks[1]._defaults is tasks[2]._defaults
+    # Modifying the defaults of a task copies them.
+    task = Test2Task(3)
+    assert task.runner_name is None and task.member is None
+    task.defaults['walltime'] = 5
+    tasks[0].defaults.update(nice=10)
+    assert dict(task.defaults) == {
+        'current_working_directory': True, 'walltime': 5}
+    assert tasks[0].defaults['nice'] == 10 and 'nice' not in tasks[1].defaults
+    task_manager.enqueue(task)
+    assert task.opts['walltime'] == 300
+
+
+def test_local_plan():
+    task_manager = CondorTaskManager(
+            setup_file='condor-setup.json', dryrun=True)
+    plan = task_manager.start_plan()
+    tasks = [Test2Task(i) for i in range(3)]
+    tasks[2].opts['dependencies'] = [tasks[0]]
+    task_manager.enqueue_dag(tasks)
+    plan.save('run/plan.json')
+    plan = Plan.load('run/plan.json')
+    assert len(plan.jobs) == 1
+    job_ids = plan.submit(get_task_manager(plan.setup))
+    assert job_ids == {0: 1}
+    # The jobs submitted around a failing one are journaled.
+    if os.path.exists('run/plan-journal'):
+        os.remove('run/plan-journal')
+    task_manager = CondorTaskManager(
+            setup_file='condor-setup.json', dryrun=True)
+    plan = task_manager.start_plan()
+    for task in [AppendTask(0), AppendTask(1, 'false'), AppendTask(2)]:
+        task_manager.enqueue(task)
+    try:
+        plan.submit(get_task_manager(plan.setup), journal='run/plan-journal')
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'The failing submission did not fail the plan.'
+    with open('run/plan-journal') as fr:
+        assert [line.split()[0] for line in fr] == ['0', '2']
+    task_manager = FederatedTaskManager(setup_file={'members': {
+        'a': {'setup_file': 'local-setup.json'}}}, dryrun=True)
+    try:
+        task_manager.start_plan()
+    except ValueError:
+        pass
+    else:
+        assert False, 'A federation recorded a plan.'
+
+
+def test_local_placement():
+    outputs = {
+        'sinfo': ['short|4:00:00|16|64000|4/12/0/16',
+                  'short|4:00:00|32+|128000|0/32/0/32',
+                  'long|2-00:00:00|16|64000|16/0/0/16'],
+        'squeue': ['short,long|8', 'long|4'],
+        'qstat': ['CLUSTER QUEUE  CQLOAD  USED  RES  AVAIL  TOTAL aoACDS',
+                  '-------------------------------------------------------',
+                  'all.q          0.50      10    0     22     32      0',
+                  'long.q         0.10       2    0     30     32      0']}
+
+    def run_cmd(cmd):
+        return '\n'.join(outputs[cmd[0]]).encode('utf-8')
+
+    policy = SlurmPlacementPolicy(
+            run_cmd, sinfo_command='sinfo', squeue_command='squeue',
+            candidates=['short', {'name': 'long', 'qos': 'lowprio'}])
+    assert policy.get_state() == {
+        'short': {'max_walltime': 14400, 'max_cores': 32, 'max_memory': 125,
+                  'free_cores': 36},
+        'long': {'max_walltime': 172800, 'max_cores': 16, 'max_memory': 62,
+                 'free_cores': -12, 'qos': 'lowprio'}}
+    opts = {'walltime': 3600, 'cores': 4}
+    assert policy.place(opts) == 'short'
+    assert policy.state['short']['free_cores'] == 32
+    opts = {'walltime': 86400}
+    assert policy.place(opts) == 'long' and opts['qos'] == 'lowprio'
+    assert policy.place({'cores': 64}) is None
+    policy = SgePlacementPolicy(
+            run_cmd, qstat_command='qstat',
+            candidates=['all.q', {'name': 'long.q', 'max_cores': 8}])
+    assert policy.place({'cores': 16}) == 'all.q'
+    assert policy.place({'cores': 1}) == 'long.q'
+    # Dry runs do not query the cluster.
+    with open('slurm-setup.json') as fr:
+        setup = json.load(fr)
+    setup['shared_tmp'] = 'run'
+    setup['placement'] = {'sinfo_command': './missing-sinfo'}
+    task_manager = SlurmTaskManager(
+            setup_file=setup, dryrun=True, submit_command='sbatch')
+    task = task_manager.enqueue(TestTask('param'))
+    assert 'partition' not in task.opts
+
+
+def test_local_result_store():
+    make_run_dir()
+    for filename in ['run/results.db', 'run/segment', 'run/segment.idx']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    store = ResultStore('run/results.db')
+    with open('run/segment', 'wb') as fw:
+        fw.write(b'{"a": 1}')
+    with open('run/segment.idx', 'wb') as fw:
+        fw.write(b'a 0 8\nb 8')
+    assert store.merge_segment('run/segment') == 1
+    # The result being appended is merged by the next call.
+    with open('run/segment', 'ab') as fw:
+        fw.write(b'{"b": 2}')
+    with open('run/segment.idx', 'ab') as fw:
+        fw.write(b' 8\n')
+    assert store.merge_segment('run/segment') == 1
+    assert store.merge_segment('run/segment') == 0
+    assert store.keys() == ['a', 'b']
+    assert store['a'] == b'{"a": 1}' and store['b'] == b'{"b": 2}'
+    store.close()
+
+
+def make_run_dir():
+    if not os.path.isdir('run'):
+        os.makedirs('run')
+
+
+def write_fake_queue(lines):
+    make_run_dir()
+    with open('run/fake-queue', 'w') as fw:
+        fw.write(''.join(line + '\n' for line in lines))
+
+
+def test_local_backpressure():
+    task_manager = SlurmTaskManager(
+            setup_file='slurm-setup.json', status_command='./fake-squeue')
+    write_fake_queue(['11 R a-abc run/a.sh', '12 PD b-abc run/b.sh',
+                      '13 S c-xyz run/c.sh'])
+    assert task_manager.get_job_states() == {
+        11: 'running', 12: 'pending', 13: 'held'}
+    task_manager.wait_for_capacity(4)
+    assert task_manager.in_flight == 3
+    # Wait until a job leaves the full queue.
+    timer = threading.Timer(0.3, write_fake_queue, [['11 R a-abc run/a.sh']])
+    timer.start()
+    task_manager.wait_for_capacity(3, poll_interval=0.1)
+    assert task_manager.in_flight == 1
+    os.remove('run/fake-queue')
+
+
+def test_local_deferred():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['completion'] = {'sentinel_dir': 'run/sentinels'}
+    task_manager = LocalTaskManager(setup_file=setup)
+    tasks = [Test2Task(i) for i in range(2)]
+    tasks[1].opts['dependencies'] = [tasks[0]]
+    finished = list(DeferredSubmitter(task_manager, interval=0).run(
+        reversed(tasks), timeout=60))
+    assert finished == [(tasks[0], 'succeeded'), (tasks[1], 'succeeded')]
+    # Jobs are found in the queue of a fake squeue and cancelled by a fake
+    # scancel.
+    make_run_dir()
+    if os.path.exists('run/fake-scancel.log'):
+        os.remove('run/fake-scancel.log')
+    task_manager = SlurmTaskManager(
+            setup_file='slurm-setup.json', status_command='./fake-squeue',
+            cancel_command='./fake-scancel')
+    submitter = DeferredSubmitter(task_manager, lead=300)
+    tasks = [Test2Task(i) for i in range(4)]
+    for task, job_id in zip(tasks, [11, 12, 13]):
+        task.job_id, task.runner_name = job_id, 'run/%d.sh' % job_id
+        task.opts['walltime'] = 600
+        submitter.track(task)
+    write_fake_queue(['11 R a-abc run/11.sh', '13 PD c-abc run/13.sh'])
+    assert submitter.check_queue(False) == []
+    assert submitter.check_queue(False) == [(tasks[1], 'finished')]
+    assert not submitter.is_ending(tasks[0], time.time())
+    assert submitter.is_ending(tasks[0], time.time() + 300)
+    # Tasks depending on a failed one are skipped or cancelled.
+    submitter.finish(tasks[0], 'failed')
+    submitter.dependencies[tasks[2]] = [tasks[0]]
+    submitter.upstream[tasks[3]] = [tasks[0]]
+    assert submitter.submit_ready() == [(tasks[3], 'skipped')]
+    assert submitter.cancel_early() == [(tasks[2], 'cancelled')]
+    with open('run/fake-scancel.log') as fr:
+        assert fr.read().split() == ['13']
+    os.remove('run/fake-queue')
+    try:
+        next(DeferredSubmitter(CeleryTaskManager(
+            setup_file='local-setup.json')).run(tasks))
+    except ValueError:
+        pass
+    else:
+        assert False, 'A queue that cannot be queried was accepted.'
+
+
+def test_local_up_to_date():
+    task_manager = LocalTaskManager(setup_file='local-setup.json')
+    make_run_dir()
+    for filename in ['run/copy-b.yatamana', 'run/copy-c']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    with open('run/copy-a', 'w') as fw:
+        fw.write('a')
+    with open('run/copy-b', 'w') as fw:
+        fw.write('outdated')
+    tasks = [CopyTask('run/copy-a', 'run/copy-b'),
+             CopyTask('run/copy-b', 'run/copy-c')]
+    assert find_unfinished(tasks) == tasks
+    # Both commands are rendered before the first one rewrites copy-b.
+    task_manager.enqueue(tasks)
+    assert find_unfinished(tasks) == []
+    with open('run/copy-a', 'w') as fw:
+        fw.write('changed')
+    assert find_unfinished(tasks) == [tasks[0]]
+    # The digests are cached only while checking.
+    assert up_to_date_finished_mixin._digests == {}
+    assert tasks[0].get_command_digest() in tasks[0].render_command()
+    os.remove('run/copy-b.yatamana')
+    assert not tasks[0].is_finished() and tasks[1].is_finished()
+
+
+def test_local_resumable_chunk():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['shared_tmp'] = 'run'
+    setup['tasks']['ChunkOfTasksTask'] = {
+        'resumable': True, 'continue_on_error': True}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+    for filename in ['run/chunk-log', 'run/chunk-flag']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    tasks = [AppendTask(0), AppendTask(1, 'test -e run/chunk-flag'),
+             AppendTask(2)]
+    try:
+        list(task_manager.enqueue_chunked(tasks, n=3))
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'The failing task did not fail the chunk.'
+    markers = os.path.join('run', 'markers', task_manager.kwargs['salt'])
+    done = sorted(os.listdir(markers))
+    assert done == sorted(task.get_key() + '.done' for task in tasks[::2])
+    with open('run/chunk-flag', 'w'):
+        pass
+    # The rerun skips the tasks that already finished.
+    chunks = list(task_manager.enqueue_chunked(tasks, n=3))
+    with open('run/chunk-log') as fr:
+        assert fr.read().split() == ['0', '2', '1']
+    assert os.listdir(markers) == []
+    assert chunks[0].markers_dir == markers
+
+
+def test_local_profiled_chunk():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['runner']['template'][1:1] = ['runner_function () { true; }']
+    setup['tasks']['ChunkOfTasksTask'] = {
+        'profile_stats': 'run/chunk-stats.jsonl'}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+    if os.path.exists('run/chunk-stats.jsonl'):
+        os.remove('run/chunk-stats.jsonl')
+    # The tasks run by the profiler can call functions of the runner.
+    tasks = [AppendTask(i, 'runner_function') for i in range(2)]
+    list(task_manager.enqueue_chunked(tasks, n=2))
+    stats = read_stats('run/chunk-stats.jsonl')
+    assert [record['exit_code'] for record in stats] == [0, 0]
+
+
+def test_local_metrics():
+    make_run_dir()
+    metrics = {'prometheus': 'run/metrics/yatamana.prom',
+               'json': 'run/metrics/metrics.json',
+               'profile': 'run/metrics/enqueue.prof'}
+    for filename in metrics.values():
+        if os.path.exists(filename):
+            os.remove(filename)
+    task_manager = LocalTaskManager(
+            setup_file='local-setup.json', metrics=metrics)
+    tasks = [AppendTask(i) for i in range(3)]
+    list(task_manager.enqueue_chunked(tasks, n=2))
+    try:
+        task_manager.enqueue(AppendTask(3, 'false'))
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'The failing job did not fail.'
+    task_manager.export_metrics()
+    with open(metrics['json']) as fr:
+        exported = json.load(fr)
+    assert exported['labels']['manager'] == 'LocalTaskManager'
+    assert exported['counters']['tasks_enqueued'] == 4
+    assert exported['counters']['jobs_submitted'] == 2
+    assert exported['counters']['errors.submit'] == 1
+    histograms = exported['histograms']
+    assert histograms['tasks_per_chunk']['sum'] == 3
+    assert histograms['submit']['count'] == 3
+    with open(metrics['prometheus']) as fr:
+        lines = fr.read().splitlines()
+    assert 'yatamana_submit_seconds_count{manager="LocalTaskManager",' \
+        'salt="%s"} 3' % task_manager.kwargs['salt'] in lines
+    assert os.path.getsize(metrics['profile']) > 0
+
+
+def test_local_log_archive():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['tasks']['ChunkOfTasksTask'] = {
+        'log_archive': 'run/logs/%(salt)s.log'}
+    task_manager = LocalTaskManager(setup_file=setup)
+    archive = 'run/logs/%s.log' % task_manager.kwargs['salt']
+    for filename in [archive, archive + '.idx', archive + '.lock']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    tasks = [AppendTask(i, 'echo out-%d' % i) for i in range(3)]
+    list(task_manager.enqueue_chunked(tasks, n=2))
+    # Every task has its own segment, appended by two jobs.
+    archive = LogArchive(archive)
+    assert len(archive) == 3
+    assert [archive.get_log(task) for task in tasks] == [
+        'out-%d\n' % i for i in range(3)]
+
+
+def test_local_scratch_staging():
+    task_manager = LocalTaskManager(setup_file='local-setup.json')
+    make_run_dir()
+    for filename in ['run/chunk-log', 'run/stage-out', 'run/stage-out-0',
+                     'run/stage-out-1']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    with open('run/stage-in', 'w') as fw:
+        fw.write('in')
+
+    def read(filename):
+        with open(filename) as fr:
+            return fr.read()
+
+    # The command sees node-local copies of the files.
+    task = StagedTask('run/stage-in', 'run/stage-out')
+    task.command += ['&&', 'echo', 'run/stage-in', 'run/stage-out', '>>',
+                     'run/chunk-log']
+    task_manager.enqueue(task)
+    assert read('run/stage-out') == 'in'
+    local_in, local_out = read('run/chunk-log').split()
+    scratch = local_in[:local_in.index('/in/')]
+    assert 'yatamana-scratch.' in scratch
+    assert local_out.startswith(scratch + '/out/')
+    # The scratch directory is removed at the end of the job.
+    assert not os.path.exists(scratch)
+    # A failing command leaves the outputs untouched.
+    task = StagedTask('run/stage-in', 'run/stage-out')
+    task.command = ['echo', 'partial', '>', 'run/stage-out', '&&', 'false']
+    try:
+        task_manager.enqueue(task)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'The failing command did not fail.'
+    assert read('run/stage-out') == 'in'
+    # The tasks of a chunk share the copies of their inputs.
+    os.remove('run/chunk-log')
+    tasks = [StagedTask('run/stage-in', 'run/stage-out-%d' % i)
+             for i in range(2)]
+    for task in tasks:
+        task.command += ['&&', 'echo', 'run/stage-in', '>>', 'run/chunk-log']
+    list(task_manager.enqueue_chunked(tasks, n=2))
+    assert read('run/stage-out-0') == read('run/stage-out-1') == 'in'
+    local_ins = read('run/chunk-log').split()
+    assert len(local_ins) == 2 and local_ins[0] == local_ins[1]
+
+
+def test_local_heartbeat():
+    task_manager = LocalTaskManager(
+            setup_file='local-setup.json',
+            heartbeat={'dir': 'run/heartbeats', 'interval': 1})
+    make_run_dir()
+    watchdog = Watchdog(task_manager, stall_timeout=5, idle_timeout=1,
+                        min_cpu=0.5)
+    task = AppendTask(0, 'echo half > $yatamana_progress && sleep 4')
+    thread = threading.Thread(target=task_manager.enqueue, args=(task,))
+    thread.start()
+    heartbeat = None
+    reason = None
+    deadline = time.time() + 10
+    while thread.is_alive() and time.time() < deadline:
+        if task.runner_name is not None:
+            heartbeat = watchdog.read_heartbeat(task) or heartbeat
+            reason = watchdog.is_hung(task, time.time()) or reason
+        time.sleep(0.2)
+    thread.join()
+    # The job reported its progress and did not use the CPU.
+    assert heartbeat['runner'] == task.runner_name
+    assert heartbeat['progress'] == 'half' and heartbeat['host']
+    assert reason is not None and reason.startswith('CPU use')
+    # The heartbeat is removed at exit, so the job would appear stalled.
+    assert not os.path.exists(
+            task_manager.get_heartbeat_filename(task.runner_name))
+    now = time.time()
+    assert watchdog.is_hung(task, now) is None
+    assert watchdog.is_hung(task, now + 6).startswith('no heartbeat')
+
+
+def test_local_speculation():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['completion'] = {'sentinel_dir': 'run/sentinels'}
+    setup['speculation'] = {
+        'after': 0.5, 'min_samples': 1, 'factor': 1, 'interval': 0.2}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+    for filename in ['run/spec-flag', 'run/spec-out-0', 'run/spec-out-1',
+                     'run/spec-out-2']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    with open('run/stage-in', 'w') as fw:
+        fw.write('in')
+    tasks = [StagedTask('run/stage-in', 'run/spec-out-%d' % i)
+             for i in range(3)]
+    # The original job straggles, its copy finishes at once.
+    tasks[2].command = [
+        '{', 'test', '-e', 'run/spec-flag', '&&', 'echo', 'copy', '>',
+        'run/spec-out-2;', '}', '||', '{', 'touch', 'run/spec-flag;', 'sleep',
+        '3;', 'echo', 'original', '>', 'run/spec-out-2;', '}']
+    for task in tasks[:2]:
+        task_manager.enqueue(task)
+    thread = threading.Thread(target=task_manager.enqueue, args=(tasks[2],))
+    thread.start()
+    while not os.path.exists('run/spec-flag'):
+        time.sleep(0.1)
+    # The local queue is always empty, report the jobs as running.
+    task_manager.get_task_states = lambda jobs: dict(
+            (job, 'running') for job in jobs)
+    finished = dict(Speculator(task_manager).run(tasks, timeout=10))
+    thread.join()
+    assert sorted(finished, key=tasks.index) == tasks
+    assert all(record['exit_code'] == 0 for record in finished.values())
+    runner = os.path.splitext(os.path.basename(tasks[2].runner_name))[0]
+    assert finished[tasks[2]]['name'] != runner
+    # The outputs of the winning copy are kept.
+    with open('run/spec-out-2') as fr:
+        assert fr.read() == 'copy\n'
+
+
+def test_local_environment():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['runner']['template'][:0] = ['set -e', '%(environment)s']
+    # SHELLOPTS is readonly, sourcing it would fail the job.
+    setup['runner']['environment'] = {
+        'setup': ['export TEST_LINES="$(printf "a\\ndeclare -x TMPDIR=b")"',
+                  'export TEST_EXCLUDED=1 SHELLOPTS'],
+        'snapshot_dir': 'run/environments', 'modulepath': [],
+        'exclude': ['TEST_EXCLUDED']}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+    filenames = ['run/chunk-log']
+    if os.path.isdir('run/environments'):
+        filenames += [os.path.join('run/environments', f)
+                      for f in os.listdir('run/environments')]
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+    # The first job saves the snapshot, the second one sources it.
+    for i in range(2):
+        task_manager.enqueue(
+            AppendTask('"$TEST_LINES" ${TEST_EXCLUDED:-unset}'))
+    assert len(os.listdir('run/environments')) == 1
+    with open('run/chunk-log') as fr:
+        assert fr.read().split('\n') == [
+            'a', 'declare -x TMPDIR=b 1', 'a', 'declare -x TMPDIR=b unset', '']
+
+
+def test_local_control():
+    make_run_dir()
+    if os.path.exists('run/fake-scancel.log'):
+        os.remove('run/fake-scancel.log')
+    kwargs = {
+        'status_command': './fake-squeue', 'cancel_command': './fake-scancel',
+        'transport': {'type': 'shell'}, 'salt': 'abcdef'}
+    task_manager = SlurmTaskManager(setup_file='slurm-setup.json', **kwargs)
+    task_manager.max_job_ids = 2
+    write_fake_queue(['1 R a-abcdef run/a.sh', '2 PD b-abcdef run/b.sh',
+                      '3 PD c-xabcdef run/c.sh', '4 R d-abcdef run/d.sh'])
+    assert task_manager.cancel() == 3
+    # The tasks of a chunk share a job.
+    tasks = [Test2Task(i) for i in range(3)]
+    for task, job_id in zip(tasks, [5, 5, 6]):
+        task.job_id, task.member = job_id, 'slurm'
+    assert task_manager.cancel(tasks) == 2
+    task_manager.transport.close()
+    task_manager = FederatedTaskManager(setup_file={'members': {
+        'local': {'setup_file': 'local-setup.json'},
+        'slurm': {'setup_file': 'slurm-setup.json', 'kwargs': kwargs}}})
+    assert task_manager.control('cancel', tasks[2:]) == 1
+    try:
+        task_manager.cancel_jobs([7])
+    except ValueError:
+        pass
+    else:
+        assert False, 'Job IDs were cancelled without their members.'
+    task_manager.members['slurm'].transport.close()
+    with open('run/fake-scancel.log') as fr:
+        assert fr.read().splitlines() == ['1 2', '4', '5 6', '6']
+
+
+def test_local_segmented():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['segmentation'] = {'walltime': '0:05', 'grace': 2}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+    for n in (1, 4, 5, 6):
+        for filename in ['run/checkpoint-%d' % n, 'run/checkpoint-%d.done' % n,
+                         'run/checkpoint-log']:
+            if os.path.exists(filename):
+                os.remove(filename)
+    # Short enough to run as a single job.
+    task = CountTask(1, '0:02')
+    assert len(task_manager.enqueue_segmented(task)) == 1
+    assert task.is_finished()
+    # Stopped after three seconds and resumed by the second segment.
+    task = CountTask(4, '0:08')
+    assert len(task_manager.enqueue_segmented(task)) == 3
+    assert task.is_finished()
+    with open('run/checkpoint-log') as fr:
+        counts = fr.read().split()
+    assert counts[:2] == ['0', '0'] and len(counts) == 3
+    # Killed before its time was up, e.g. out of memory.
+    task = CountTask(5, '0:08')
+    task.command = ['echo', 'killed', '>>', 'run/checkpoint-log;',
+                    'kill', '-9', '$$']
+    try:
+        task_manager.enqueue_segmented(task)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'The killed segment did not fail.'
+    with open('run/checkpoint-log') as fr:
+        assert fr.read().split().count('killed') == 1
+    # HTCondor chains the segments by a DAG.
+    with open('condor-setup.json') as fr:
+        setup = json.load(fr)
+    setup['segmentation'] = {'walltime': '0:05', 'grace': 2}
+    task_manager = CondorTaskManager(setup_file=setup)
+    task = CountTask(6, '0:08')
+    segments = task_manager.enqueue_segmented(task)
+    assert len(segments) == 3 and task.is_finished()
+    assert all(segment.job_id == 1 for segment in segments + [task])
+
+
+def test_local_claims():
+    with open('local-setup.json') as fr:
+        setup = json.load(fr)
+    setup['speculation'] = {}
+    task_manager = LocalTaskManager(setup_file=setup)
+    make_run_dir()
+
+    def stage(content):
+        with open('run/stage-in', 'w') as fw:
+            fw.write(content)
+
+    def staged():
+        with open('run/stage-out') as fr:
+            return fr.read()
+
+    stage('first')
+    task = StagedTask('run/stage-in', 'run/stage-out')
+    task_manager.enqueue(task)
+    assert staged() == 'first'
+    claims = os.path.splitext(task.runner_name)[0] + '.claims'
+    claim = os.path.join(claims, os.listdir(claims)[0])
+    # A copy finishing later keeps the outputs of the first one.
+    stage('second')
+    task_manager.enqueue_copy(task)
+    assert staged() == 'first'
+    # A copy waits for the commit of the claiming copy.
+    os.remove(os.path.join(claim, 'done'))
+    timer = threading.Timer(
+            1, lambda: open(os.path.join(claim, 'done'), 'w').close())
+    timer.start()
+    task_manager.enqueue_copy(task)
+    timer.join()
+    assert staged() == 'first'
+    # and commits itself if the claiming copy failed.
+    os.remove(os.path.join(claim, 'done'))
+    timer = threading.Timer(1, os.rmdir, [claim])
+    timer.start()
+    task_manager.enqueue_copy(task)
+    timer.join()
+    assert staged() == 'second'
+    # A stale claim is removed and fails the waiting copy.
+    os.remove(os.path.join(claim, 'done'))
+    try:
+        task_manager.enqueue_copy(task)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'A copy succeeded without the outputs committed.'
+    assert not os.path.exists(claim)
+
+
+def test_local_federation():
+    task_manager = FederatedTaskManager(setup_file={'members': {
+        'a': {'setup_file': 'local-setup.json'},
+        'b': {'setup_file': 'local-setup.json', 'queue_wait': 60},
+        'slurm': {
+            'setup_file': 'slurm-setup.json', 'max_cores': 0,
+            'kwargs': {'status_command': './fake-squeue'}}}})
+    tasks = [Test2Task(i) for i in range(7)]
+    chunks = list(task_manager.enqueue_chunked(tasks))
+    assert [len(chunk.tasks) for chunk in chunks] == [5, 2]
+    assert all(chunk.member == 'a' for chunk in chunks)
+    assert task_manager.get_task_states(chunks) == {}
+    # Jobs of a member are found by their IDs on that member only.
+    write_fake_queue(['11 R a-abc run/a.sh'])
+    task = Test2Task(0)
+    task.job_id, task.member = 11, 'slurm'
+    chunks[0].job_id = 11
+    assert task_manager.get_task_states([task, chunks[0]]) == {
+        task: 'running'}
+    assert task_manager.get_job_states() == {('slurm', 11): 'running'}
+    assert task_manager.count_in_flight() == 1
+    os.remove('run/fake-queue')
+    # The defaults of a member are looked up once per class.
+    task_manager = FederatedTaskManager(setup_file={
+        'status_interval': 0.1, 'members': {
+            'a': {'setup_file': 'local-setup.json'},
+            'slurm': {
+                'setup_file': 'slurm-setup.json', 'max_cores': 0,
+                'kwargs': {'status_command': './fake-squeue'}}}})
+    member = task_manager.members['a']
+    lookups = []
+    get_task_defaults = member.get_task_defaults
+
+    def lookup(clsname):
+        lookups.append(clsname)
+        return get_task_defaults(clsname)
+
+    member.get_task_defaults = lookup
+    for task in tasks:
+        task_manager.get_size('a', [task])
+    assert lookups == ['Test2Task']
+    # Foreign dependencies are polled together, the queue empties after the
+    # first query.
+    write_fake_queue(['11 R a-abc run/a.sh', '12 PD b-abc run/b.sh'])
+    member = task_manager.members['slurm']
+    queries = []
+    get_job_states = member.get_job_states
+
+    def query():
+        states = get_job_states()
+        if not queries:
+            os.remove('run/fake-queue')
+        queries.append(states)
+        return states
+
+    member.get_job_states = query
+    dependencies = [Test2Task(i) for i in range(2)]
+    for d, job_id in zip(dependencies, [11, 12]):
+        d.job_id, d.member = job_id, 'slurm'
+    task = Test2Task(2)
+    task.opts['dependencies'] = dependencies
+    task_manager.enqueue(task)
+    assert len(queries) == 2 and queries[-1] == {}
+    assert task.member == 'a' and task.job_id is not None
+
+
+def test_local_submission_governor():
+    governor = SubmissionGovernor(
+            rate=40., burst=1, rate_increase=1., backoff=0.01,
+            max_backoff=0.02, max_retries=2, transient_errors=['busy'],
+            ambiguous_errors=['timed out'])
+    errors = []
+    calls = []
+
+    def submit(cmd):
+        calls.append(cmd)
+        if errors:
+            raise RuntimeError(errors.pop(0))
+        return 'submitted ' + cmd
+
+    assert 0.005 <= governor.get_backoff(0) <= 0.01
+    assert 0.01 <= governor.get_backoff(10) <= 0.02
+    errors[:] = ['busy', 'busy']
+    assert governor.run(submit, 'a') == 'submitted a'
+    assert len(calls) == 3
+    # Halved after each failure, increased after the fast success.
+    assert governor.rate == 40. / 4 + 1.
+    errors[:] = ['busy'] * 3
+    try:
+        governor.run(submit, 'b')
+        assert False
+    except RuntimeError:
+        assert len(calls) == 6
+    for lookup, found in [(lambda: 'submitted c', 1), (lambda: None, 2)]:
+        del calls[:]
+        errors[:] = ['Socket timed out']
+        assert governor.run(submit, 'c', lookup=lookup) == 'submitted c'
+        assert len(calls) == found
+    errors[:] = ['Socket timed out']
+    try:
+        governor.run(submit, 'd')
+        assert False
+    except RuntimeError:
+        assert not errors
+
+
 if __name__ == '__main__':
     setup_log(logging.DEBUG)
     if os.environ.get('IMPIMBA_MACHINE_NAME') == 'IMPIMBA-2':
@@ -84,3 +937,28 @@ if __name__ == '__main__':
         test_sge()
     else:
         test_local()
+        test_local_allocation()
+        test_local_task_table()
+        test_local_sweep()
+        test_local_shell_transport()
+        test_local_condor_dag()
+        test_local_graph()
+        test_local_plan()
+        test_local_placement()
+        test_local_result_store()
+        test_local_backpressure()
+        test_local_deferred()
+        test_local_control()
+        test_local_federation()
+        test_local_submission_governor()
+        test_local_up_to_date()
+        test_local_segmented()
+        test_local_resumable_chunk()
+        test_local_claims()
+        test_local_profiled_chunk()
+        test_local_environment()
+        test_local_metrics()
+        test_local_log_archive()
+        test_local_scratch_staging()
+        test_local_heartbeat()
+        test_local_speculation()
@@ -11,23 +11,66 @@ from __future__ import (
         print_function, division, absolute_import, unicode_literals)
 
 __all__ = [
+        'AllocationOfTasksTask',
         'CeleryTaskManager',
+        'CheckpointingMixin',
         'ChunkOfTasksTask',
+        'CondorTaskManager',
+        'CompletionWatcher',
+        'DeferredSubmitter',
         'LocalTaskManager',
+        'LogArchive',
+        'Metrics',
+        'PlacementPolicy',
+        'Plan',
+        'ResultStore',
+        'ScratchStagingMixin',
+        'SegmentOfTaskTask',
         'SgeTaskManager',
         'SlurmTaskManager',
+        'Speculator',
+        'Sweep',
+        'SubmissionGovernor',
         'Task',
         'TaskManager',
+        'TaskTable',
+        'FederatedTaskManager',
         'FileExistsFinishedMixin',
-        'get_task_manager'
+        'UpToDateFinishedMixin',
+        'Watchdog',
+        'find_unfinished',
+        'get_task_manager',
+        'read_stats',
+        'summarize_stats'
         ]
 
 from .task import Task
+from .task_table import TaskTable
+from .sweep import Sweep
+from .submission_governor import SubmissionGovernor
+from .metrics import Metrics
+from .placement_policy import PlacementPolicy
+from .plan import Plan
+from .log_archive import LogArchive
+from .result_store import ResultStore
+from .resource_profiler import read_stats, summarize_stats
+from .completion_watcher import CompletionWatcher
+from .watchdog import Watchdog
+from .speculator import Speculator
+from .deferred_submitter import DeferredSubmitter
 from .file_exists_finished_mixin import FileExistsFinishedMixin
+from .scratch_staging_mixin import ScratchStagingMixin
+from .checkpointing_mixin import CheckpointingMixin
+from .up_to_date_finished_mixin import (
+        UpToDateFinishedMixin, find_unfinished)
 from .chunk_of_tasks_task import ChunkOfTasksTask
+from .allocation_of_tasks_task import AllocationOfTasksTask
+from .segment_of_task_task import SegmentOfTaskTask
 from .task_manager import TaskManager
 from .task_manager_factory import get_task_manager
 from .celery_task_manager import CeleryTaskManager
 from .sge_task_manager import SgeTaskManager
 from .slurm_task_manager import SlurmTaskManager
+from .condor_task_manager import CondorTaskManager
 from .local_task_manager import LocalTaskManager
+from .federated_task_manager import FederatedTaskManager
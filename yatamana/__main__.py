@@ -0,0 +1,85 @@
+"""
+Command-line interface of yatamana.
+
+Submit a plan prepared by a dry run, see :py:class:`.Plan`::
+
+    python -m yatamana submit plan.json
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import argparse
+import logging
+import sys
+from .plan import Plan
+from .task_manager_factory import get_task_manager
+
+
+def submit(args):
+    """Submit a plan.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments.
+
+    Returns
+    -------
+    returncode : int
+        Exit code.
+    """
+    plan = Plan.load(args.plan)
+    manager = get_task_manager(plan.setup)
+    journal = args.journal
+    if journal is None:
+        journal = args.plan + '.ids'
+    try:
+        job_ids = plan.submit(manager, journal=journal,
+                              batch_size=args.batch_size)
+    finally:
+        manager.transport.close()
+    manager.export_metrics()
+    print('Submitted %d jobs, IDs in %s' % (len(job_ids), journal))
+    return 0
+
+
+def main(argv=None):
+    """Run the command-line interface.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        Arguments. Default: ``sys.argv[1:]``.
+
+    Returns
+    -------
+    returncode : int
+        Exit code.
+    """
+    parser = argparse.ArgumentParser(prog='yatamana')
+    parser.add_argument(
+            '-v', '--verbose', action='store_true', help='log progress')
+    commands = parser.add_subparsers(dest='command')
+    parser_submit = commands.add_parser(
+            'submit', help='submit a plan prepared by a dry run')
+    parser_submit.add_argument('plan', help='filename of the plan')
+    parser_submit.add_argument(
+            '--journal', help='file recording the submitted job IDs, jobs '
+            'recorded in it are skipped (default: PLAN.ids)')
+    parser_submit.add_argument(
+            '--batch-size', type=int, default=100,
+            help='maximum number of submissions in a batch (default: 100)')
+    parser_submit.set_defaults(func=submit)
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+            level=logging.INFO if args.verbose else logging.WARNING)
+    if getattr(args, 'func', None) is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+import heapq
+import logging
+from .chunk_of_tasks_task import ChunkOfTasksTask
+from .utils import parse_walltime, quote, render_export_functions
+
+
+class AllocationOfTasksTask(ChunkOfTasksTask):
+    """Task requesting a multi-node allocation running tasks as job steps.
+
+    Instead of running the contained tasks one after another, each of them
+    is launched as a separate job step by ``srun --exclusive`` sized by the
+    task's `cores` and `memory`. The steps run in parallel as long as they fit
+    into the allocation.
+
+    The allocation is configured by the defaults of this class, i.e., the
+    ``tasks.AllocationOfTasksTask`` section of the setup:
+
+    - `nodes` - number of nodes to allocate, default: 1,
+    - `cores_per_node` - number of cores of a node, default: 1,
+    - `srun_command` - command launching a job step, default: 'srun',
+    - `srun_options` - list of additional options of the job steps,
+    - `walltime` - walltime of the allocation, estimated from the walltimes of
+      the contained tasks if not given here or in the options of the
+      allocation. A walltime in ``runner.opts`` is not used.
+
+    The job steps run the tasks by a new ``bash``. The shell functions of the
+    runner are exported to them, but variables have to be exported by the
+    runner template to be seen by the tasks.
+
+    The settings of :py:class:`.ChunkOfTasksTask` changing how the tasks are
+    run one after another are not supported and ignored with a warning.
+
+    Parameters
+    ----------
+    tasks : list of Task
+        Tasks to run inside the allocation.
+    """
+
+    settings = ChunkOfTasksTask.settings + (
+            'nodes', 'cores_per_node', 'srun_command', 'srun_options')
+    unsupported_settings = (
+            'resumable', 'continue_on_error', 'log_archive', 'profile_stats',
+            'collect_results')
+    __slots__ = settings[len(ChunkOfTasksTask.settings):]
+
+    def __init__(self, tasks):
+        super(AllocationOfTasksTask, self).__init__(tasks)
+        self.nodes = 1
+        self.cores_per_node = 1
+        self.srun_command = 'srun'
+        self.srun_options = []
+
+    def resolve_opts(self, values, update_self=True):
+        """Resolve options of all the contained tasks and the allocation.
+
+        Unless the walltime is set in the ``tasks.AllocationOfTasksTask``
+        section or the options of the allocation, it is estimated by
+        simulating the greedy dispatch of the tasks, in order, to the cores of
+        the allocation.
+
+        Parameters
+        ----------
+        values : dict-like
+            Values to use for format string resolution.
+        update_self : bool
+            Whether or not to update `self.opts`.
+
+        Returns
+        -------
+        resolved : dict-like
+            Resolved options. Also assigned to this task.
+        """
+        # The defaults include runner.opts meant for single tasks.
+        setup = values.get('tasks', {}).get(self.__class__.__name__, {})
+        walltime = self.opts.get('walltime', setup.get('walltime'))
+        resolved = super(AllocationOfTasksTask, self).resolve_opts(
+                values, update_self=False)
+        for name in self.unsupported_settings:
+            if getattr(self, name):
+                log = logging.getLogger(self.__class__.__name__)
+                log.warning('Ignoring %s, not supported by allocations', name)
+        for name in ('cores', 'memory'):
+            resolved.pop(name, None)
+        resolved['nodes'] = self.nodes
+        if walltime is not None:
+            resolved['walltime'] = parse_walltime(walltime)
+        else:
+            resolved.pop('walltime', None)
+            walltime = self.estimate_walltime()
+            if walltime:
+                resolved['walltime'] = walltime
+        if update_self is True:
+            self.opts = resolved
+        return resolved
+
+    def estimate_walltime(self):
+        """Estimate the walltime needed to run all the contained tasks.
+
+        The contained tasks have to be resolved already.
+
+        Returns
+        -------
+        walltime : int
+            Estimated walltime in seconds.
+        """
+        total = self.nodes * self.cores_per_node
+        free = total
+        now = 0
+        running = []
+        for task in self.tasks:
+            cores = min(task.opts.get('cores', 1), total)
+            while free < cores:
+                now, released = heapq.heappop(running)
+                free += released
+            free -= cores
+            heapq.heappush(
+                    running, (now + task.opts.get('walltime', 0), cores))
+        return max([now] + [end for end, _ in running])
+
+    def render_step(self, task):
+        """Render a command launching a task as a job step.
+
+        Parameters
+        ----------
+        task : Task
+            Resolved task.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        step = [self.srun_command, '--exclusive', '-N', '1', '-n', '1',
+                '-c', '%d' % task.opts.get('cores', 1)]
+        if 'memory' in task.opts:
+            step += ['--mem=%dG' % task.opts['memory']]
+        step += list(self.srun_options)
+        return ' '.join(
+                [quote(o) for o in step] +
+                ['"$BASH"', '-c', quote(task.render_command())])
+
+    def render_command(self):
+        """Render the job steps of all the contained tasks.
+
+        The steps are launched in the background and the command waits for
+        all of them. It fails if any of the steps failed.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        max_steps = self.nodes * self.cores_per_node
+        lines = render_export_functions() + [
+            'yatamana_failed=$(mktemp)',
+            'yatamana_throttle () {',
+            '\twhile [ $(jobs -rp | wc -l) -ge %d ]; do wait -n; done' % (
+                max_steps),
+            '}']
+        for i, task in enumerate(self.tasks):
+            lines += [
+                'yatamana_throttle',
+                '%s || echo %d >> "$yatamana_failed" &' % (
+                    self.render_step(task), i)]
+        lines += [
+            'wait',
+            '[ ! -s "$yatamana_failed" ]',
+            'yatamana_rv=$?',
+            'rm -f "$yatamana_failed"',
+            '(exit $yatamana_rv)']
+        return '\n'.join(lines)
+
+    def get_runner_prefix(self):
+        """Get a prefix for the runner file.
+
+        Returns
+        -------
+        prefix : str
+            Prefix for the runner file.
+        """
+        prefix = super(AllocationOfTasksTask, self).get_runner_prefix()
+        return 'AllocationOf' + prefix[len('ChunkOf'):]
@@ -5,5 +5,13 @@ from .task_manager import TaskManager
 
 
 class CeleryTaskManager(TaskManager):
+    def __init__(self, setup_file, **kwargs):
+        super(CeleryTaskManager, self).__init__(setup_file, **kwargs)
+        # The queue cannot be queried, see get_job_states.
+        if self.kwargs.get('backpressure', {}).get('max_in_flight'):
+            raise ValueError(
+                'Cannot limit the jobs in flight of %s' %
+                self.__class__.__name__)
+
     def enqueue_inner(self, task):
         raise NotImplementedError
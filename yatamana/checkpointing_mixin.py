@@ -0,0 +1,71 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import os
+from .utils import quote
+
+
+class CheckpointingMixin(object):
+    """Mixin of long tasks that can resume from a checkpoint.
+
+    Such a task can be split into a chain of shorter jobs, see
+    :py:meth:`.TaskManager.enqueue_segmented`. Every job runs the command for
+    at most its walltime and stops it by SIGTERM, on which the command is
+    expected to write its checkpoint. The next job resumes from it. Once the
+    command succeeds, a marker file is written and the rest of the chain
+    finishes immediately. The marker is written by tasks enqueued without
+    segments as well.
+
+    The task has to specify the following attributes:
+
+    - `checkpoint` - filename of the checkpoint, the task resumes if it
+      exists,
+    - `resume_command` - command resuming from the checkpoint, rendered like
+      the `command`, i.e., wrapped by the other mixins.
+    """
+
+    __slots__ = ()
+
+    def get_done_filename(self):
+        """Get the filename of the marker of the finished task.
+
+        Returns
+        -------
+        filename : str
+            The checkpoint filename with the ``.done`` suffix.
+        """
+        return self.checkpoint + '.done'
+
+    def is_finished(self):
+        """Return True if the marker of the finished task exists, or if the
+        other bases of the task consider it finished.
+        """
+        return os.path.exists(self.get_done_filename()) or \
+            super(CheckpointingMixin, self).is_finished()
+
+    def render_command(self):
+        """Render the command followed by writing the marker.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        command = super(CheckpointingMixin, self).render_command()
+        return '{ %s\n} && touch %s' % (
+                command, quote(self.get_done_filename()))
+
+    def render_resume_command(self):
+        """Render the command resuming from the checkpoint.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        command = self.command
+        self.command = self.resume_command
+        try:
+            return self.render_command()
+        finally:
+            self.command = command
@@ -1,23 +1,109 @@
 from __future__ import (
         division, print_function, unicode_literals, absolute_import)
 import logging
+import os
 from copy import deepcopy
 from .task import Task
+from .utils import quote, render_export_functions
+from .log_archive import render_log_buffering
+from .resource_profiler import render_profiled, render_stats_buffering
+from .scratch_staging_mixin import ScratchStagingMixin, render_make_scratch
 
 
 class ChunkOfTasksTask(Task):
     """Task containing multiple tasks.
 
+    The contained tasks are run one after another. By default, the chunk
+    stops at the first failing task. This can be changed by the defaults of
+    this class, i.e., the ``tasks.ChunkOfTasksTask`` section of the setup:
+
+    - `resumable` - mark every successfully finished task by a file named by
+      :py:meth:`.Task.get_key` and skip the marked tasks when the chunk is
+      run again, e.g., after hitting its walltime. Default: False.
+    - `continue_on_error` - run the remaining tasks after a task fails and
+      report the exit codes of all the tasks at the end. Default: False.
+    - `markers_dir` - directory of the markers of finished tasks. Default:
+      ``%(shared_tmp)s/markers/%(salt)s``, so that a rerun of the campaign
+      resumes, but a new campaign with the same commands does not skip them.
+      The markers of a chunk are removed once all its tasks succeeded.
+    - `log_archive` - filename of an archive the logs of the tasks are
+      appended to, e.g. ``%(shared_tmp)s/logs/%(salt)s.log``. The logs are
+      buffered on the node-local disk (``$TMPDIR``) and appended as one
+      segment per task at the end of the job. They can be read by
+      :py:class:`.LogArchive`. Default: None, the logs of the tasks go to the
+      log of the job.
+    - `profile_stats` - filename of a file the wall time, CPU time, maximum
+      RSS, and I/O of every task are appended to, e.g.
+      ``%(shared_tmp)s/stats/%(salt)s.jsonl``. See
+      :py:mod:`.resource_profiler`. Default: None, no profiling. The tasks
+      are then run by a new ``bash``, which inherits the shell functions of
+      the runner, but only the exported variables.
+    - `profiler_python` - python interpreter on the nodes running the
+      profiler. Default: 'python'.
+    - `collect_results` - commit the result of every successful task, see
+      :py:func:`.result_store.render_results`. Default: True if the
+      ``results.dir`` option of the setup is set.
+
+    Attributes
+    ----------
+    own_opts : tuple of str
+        Options set on the chunk itself that override those collected from the
+        contained tasks.
+    settings : tuple of str
+        Names of the defaults configuring the chunk itself rather than the
+        job. They are set as attributes of the chunk when resolving options.
+
     Parameters
     ----------
     tasks : list of Task
         Tasks to put inside this chunk of tasks.
     """
+
+    own_opts = ('nice',)
+    settings = (
+            'resumable', 'continue_on_error', 'markers_dir', 'log_archive',
+            'profile_stats', 'profiler_python', 'collect_results')
+    __slots__ = ('tasks',) + settings
+
     def __init__(self, tasks):
         super(ChunkOfTasksTask, self).__init__()
         if not tasks:
             raise ValueError('There has to be atleast one task in a chunk.')
         self.tasks = tasks
+        self.resumable = False
+        self.continue_on_error = False
+        self.markers_dir = None
+        self.log_archive = None
+        self.profile_stats = None
+        self.profiler_python = 'python'
+        self.collect_results = None
+
+    def resolve_settings(self, values):
+        """Set the settings of the chunk from its defaults and options.
+
+        Parameters
+        ----------
+        values : dict-like
+            Values to use for format string resolution.
+        """
+        own = self._defaults.copy()
+        own.update(self.opts)
+        for name in self.settings:
+            if name in own:
+                setattr(self, name, own[name])
+        if self.markers_dir is None:
+            self.markers_dir = os.path.join(
+                    values.get('shared_tmp', '.'), 'markers', values['salt'])
+        else:
+            self.markers_dir = self.markers_dir % values
+        self.markers_dir = os.path.expandvars(self.markers_dir)
+        if self.log_archive is not None:
+            self.log_archive = os.path.expandvars(self.log_archive % values)
+        if self.profile_stats is not None:
+            self.profile_stats = os.path.expandvars(
+                    self.profile_stats % values)
+        if self.collect_results is None:
+            self.collect_results = bool(values.get('results', {}).get('dir'))
 
     def resolve_opts(self, values, update_self=True):
         """Resolve options of all the contained tasks and itself.
@@ -40,6 +126,7 @@ class ChunkOfTasksTask(Task):
         resolved : dict-like
             Resolved options. Also assigned to this task.
         """
+        self.resolve_settings(values)
         cores = 0
         dependencies = set()
         memory = 0
@@ -69,6 +156,9 @@ class ChunkOfTasksTask(Task):
             resolved['memory'] = memory
         if walltime:
             resolved['walltime'] = walltime
+        for name in self.own_opts:
+            if name in self.opts:
+                resolved[name] = self.opts[name]
         if update_self is True:
             self.opts = resolved
         return resolved
@@ -81,12 +171,118 @@ class ChunkOfTasksTask(Task):
         command : str
             Rendered command.
         """
-        # TODO: allow setting the separator in the config. The values could be:
-        # ' && '
-        # '\n'
-        # '\nrv=$?\nif [ $rv != 0 ]; then log Error $rv; exit $rv; fi\n'
-        #
-        return ' && \\\n'.join([task.render_command() for task in self.tasks])
+        staged = [
+            task for task in self.tasks
+            if isinstance(task, ScratchStagingMixin)]
+        if not self.resumable and not self.continue_on_error and \
+                self.log_archive is None and self.profile_stats is None and \
+                not self.collect_results and not staged:
+            return ' && \\\n'.join(
+                    [task.render_command() for task in self.tasks])
+        lines = ['yatamana_rv=0', 'yatamana_codes=']
+        if self.resumable:
+            lines += ['mkdir -p %s' % quote(self.markers_dir)]
+        flush = []
+        if staged:
+            # Share the scratch directory so that inputs are staged once.
+            lines += [
+                render_make_scratch(staged[0].scratch_dir),
+                'export yatamana_scratch']
+            flush += ['rm -rf "$yatamana_scratch"']
+        if self.log_archive is not None:
+            lines += render_log_buffering(self.log_archive)
+            flush += ['yatamana_flush_logs']
+        if self.profile_stats is not None:
+            lines += render_export_functions()
+            lines += render_stats_buffering(self.profile_stats)
+            flush += ['yatamana_flush_stats']
+        if flush:
+            lines += ['trap \'%s; exit 143\' TERM' % '; '.join(flush)]
+        for i, task in enumerate(self.tasks):
+            lines += self.render_subtask(i, task)
+        lines += [
+            'echo >&2 "[chunk] Exit codes of the tasks:$yatamana_codes"']
+        if self.resumable:
+            lines += [
+                'if [ $yatamana_rv -eq 0 ]; then',
+                '\trm -f %s' % ' '.join(
+                    quote(self.get_marker(task)) for task in self.tasks),
+                'fi']
+        if flush:
+            lines += flush + ['trap - TERM']
+        lines += ['(exit $yatamana_rv)']
+        return '\n'.join(lines)
+
+    def render_subtask(self, i, task):
+        """Render the command of a contained task with its bookkeeping.
+
+        Parameters
+        ----------
+        i : int
+            Index of the task in the chunk.
+        task : Task
+            Contained task.
+
+        Returns
+        -------
+        lines : list of str
+            Lines of the rendered command. The exit code of the task is
+            appended to ``$yatamana_codes`` and the first non-zero one is kept
+            in ``$yatamana_rv``.
+        """
+        command = task.render_command()
+        key = task.get_key()
+        if self.profile_stats is not None:
+            run = [render_profiled(
+                command, key, task.__class__.__name__,
+                self.profiler_python)]
+        else:
+            # Run in a subshell so that an exit of the task does not end the
+            # chunk.
+            run = ['( %s' % command, ')']
+        if self.log_archive is not None:
+            run[-1] += ' > "$yatamana_logs/%s.log" 2>&1' % key
+        run += ['yatamana_task_rv=$?']
+        done = []
+        if self.collect_results:
+            done += ['\tyatamana_commit_result %s' % key]
+        if self.resumable:
+            marker = quote(self.get_marker(task))
+            done += ['\ttouch %s' % marker]
+            run = [
+                'if [ -e %s ]; then' % marker,
+                '\techo >&2 "[chunk] Skipping finished task %d"' % i,
+                '\tyatamana_task_rv=0',
+                'else'] + ['\t' + line for line in run] + ['fi']
+        lines = run + [
+            'if [ $yatamana_task_rv -eq 0 ]; then'] + (done or ['\t:']) + [
+            'elif [ $yatamana_rv -eq 0 ]; then',
+            '\tyatamana_rv=$yatamana_task_rv',
+            'fi',
+            'yatamana_codes="$yatamana_codes %d:$yatamana_task_rv"' % i]
+        if self.collect_results:
+            # Drop the result of a failed task.
+            lines += [': > "$yatamana_result"']
+        if not self.continue_on_error:
+            # Skip the task after a failure.
+            lines = ['if [ $yatamana_rv -eq 0 ]; then'] + [
+                '\t' + line for line in lines] + ['fi']
+        return lines
+
+    def get_marker(self, task):
+        """Get the filename of the marker of a finished task.
+
+        Parameters
+        ----------
+        task : Task
+            Contained task.
+
+        Returns
+        -------
+        filename : str
+            Filename of the marker in `markers_dir`.
+        """
+        return os.path.join(self.markers_dir, task.get_key() + '.done')
 
     def get_runner_prefix(self):
         """Get a prefix for the runner file.
@@ -0,0 +1,308 @@
+"""
+yatamana.completion_watcher
+---------------------------
+
+Detection of finished jobs by sentinel files written by their runners.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import select
+import struct
+import time
+from .utils import makedirs, quote
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: File systems on which inotify does not see changes made by other hosts.
+NETWORK_FILESYSTEMS = (
+        'nfs', 'nfs4', 'lustre', 'gpfs', 'cifs', 'smbfs', 'smb3', 'beegfs',
+        'panfs', 'ceph', 'glusterfs', 'fuse.sshfs', 'fuse.glusterfs')
+
+_event_header = struct.Struct(str('iIII'))
+
+
+def get_filesystem_type(path):
+    """Get the type of the file system a path resides on.
+
+    Parameters
+    ----------
+    path : str
+        Existing path.
+
+    Returns
+    -------
+    fstype : str | None
+        Type of the file system as listed in ``/proc/mounts``, or None if it
+        cannot be determined.
+    """
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as fr:
+            for line in fr:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point.rstrip('/') + '/'
+                if (path == mount_point or path.startswith(prefix)) and \
+                        len(mount_point) >= len(best):
+                    best, fstype = mount_point, fields[2]
+    except IOError:
+        return None
+    return fstype
+
+
+class Inotify(object):
+    """Minimal wrapper of the Linux inotify API watching a directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to watch for files being moved in or closed after writing.
+
+    Raises
+    ------
+    OSError
+        If inotify is not available.
+    """
+    def __init__(self, directory):
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(
+                self.fd, os.fsencode(directory) if hasattr(os, 'fsencode')
+                else directory, IN_MOVED_TO | IN_CLOSE_WRITE)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def read(self, timeout):
+        """Read names of the files changed in the directory.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum number of seconds to wait for a change.
+
+        Returns
+        -------
+        names : list of str | None
+            Names of the changed files, or None if events were lost.
+        """
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = _event_header.unpack_from(buf, offset)
+            offset += _event_header.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            names += [name.decode('utf-8', 'replace')]
+        return names
+
+    def close(self):
+        """Stop watching.
+        """
+        os.close(self.fd)
+
+
+class CompletionWatcher(object):
+    """Watch a directory for sentinel files of finished jobs.
+
+    Runners write the sentinel files atomically when they exit, see
+    :py:func:`render_sentinel`. Each sentinel is a json record
+    with the name of the runner, the job ID, the exit code, the host, and the
+    start and end times.
+
+    Changes are detected by inotify where it works. On network file systems,
+    where inotify does not see files written on other hosts, the directory is
+    scanned every `scan_interval` seconds instead.
+
+    Parameters
+    ----------
+    directory : str
+        Directory with the sentinel files.
+    scan_interval : float, optional
+        Seconds between directory scans without inotify. Default: 5.
+    use_inotify : bool, optional
+        Whether to use inotify. Default: use it if available and the
+        directory is not on a network file system.
+    """
+    def __init__(self, directory, scan_interval=5., use_inotify=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.scan_interval = scan_interval
+        self.seen = set()
+        self.inotify = None
+        makedirs(directory)
+        if use_inotify is None:
+            use_inotify = get_filesystem_type(directory) not in \
+                NETWORK_FILESYSTEMS
+        if use_inotify:
+            try:
+                self.inotify = Inotify(directory)
+            except OSError as e:
+                self.log.info('Falling back to directory scans: %s', e)
+        self.pending_scan = True
+
+    def read_sentinel(self, name):
+        """Read a sentinel file.
+
+        Parameters
+        ----------
+        name : str
+            Name of the sentinel file inside the watched directory.
+
+        Returns
+        -------
+        record : dict | None
+            Contents of the sentinel with the `name` of the runner, or None if
+            it cannot be read.
+        """
+        try:
+            with open(os.path.join(self.directory, name)) as fr:
+                record = json.load(fr)
+        except (IOError, OSError, ValueError) as e:
+            self.log.warning('Cannot read sentinel %s: %s', name, e)
+            return None
+        record.setdefault('name', name[:-len('.json')])
+        return record
+
+    def collect(self, names):
+        """Read the new sentinels among given file names.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of files inside the watched directory.
+
+        Returns
+        -------
+        records : list of dict
+            Records of the sentinels not seen before.
+        """
+        records = []
+        for name in names:
+            if name.startswith('.') or not name.endswith('.json') or \
+                    name in self.seen:
+                continue
+            record = self.read_sentinel(name)
+            if record is not None:
+                self.seen.add(name)
+                records += [record]
+        return records
+
+    def poll(self, timeout=None):
+        """Get records of the jobs that finished since the last poll.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait for a finished job. Default:
+            wait until a job finishes.
+
+        Returns
+        -------
+        records : list of dict
+            Records of the finished jobs, see :py:meth:`read_sentinel`.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.pending_scan:
+                self.pending_scan = False
+                records = self.collect(os.listdir(self.directory))
+                if records:
+                    return records
+            if deadline is None:
+                wait = self.scan_interval
+            else:
+                wait = max(0, min(self.scan_interval, deadline - time.time()))
+            if self.inotify is not None:
+                names = self.inotify.read(None if timeout is None else wait)
+                if names is None:
+                    self.pending_scan = True
+                    continue
+                records = self.collect(names)
+            else:
+                time.sleep(wait)
+                self.pending_scan = True
+                records = []
+            if records:
+                return records
+            if deadline is not None and time.time() >= deadline:
+                if self.pending_scan:
+                    self.pending_scan = False
+                    return self.collect(os.listdir(self.directory))
+                return []
+
+    def close(self):
+        """Stop watching.
+        """
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def render_sentinel(runner_name, filename, job_id=''):
+    """Render commands writing the sentinel of a finished job.
+
+    Parameters
+    ----------
+    runner_name : str
+        Filename of the runner script.
+    filename : str
+        Filename of the sentinel.
+    job_id : str, optional
+        Shell word expanding to the job ID inside the job.
+
+    Returns
+    -------
+    start : list of str
+        Commands recording the start time.
+    stop : list of str
+        Commands run at exit with the exit code in ``$rv``.
+    """
+    directory = os.path.dirname(filename)
+    sentinel = quote(filename)
+    tmp = quote(os.path.join(
+        directory, '.%s.tmp' % os.path.basename(runner_name)))
+    start = ['yatamana_start=$(date +%s)']
+    stop = [
+        'mkdir -p %s' % quote(directory or '.'),
+        'printf \'{"runner": "%s", "job_id": "%s", "exit_code": %d, '
+        '"host": "%s", "start": %d, "end": %d}\\n\' \\',
+        '\t%s "%s" $rv "$(hostname)" $yatamana_start $(date +%%s) \\' % (
+            quote(runner_name), job_id),
+        '\t> %s.$$ && mv %s.$$ %s' % (tmp, tmp, sentinel)]
+    return start, stop
@@ -0,0 +1,398 @@
+from __future__ import (
+        print_function, division, absolute_import, unicode_literals)
+
+import getpass
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from .utils import which, decode_output, makedirs
+from .critical_path import analyze_critical_path, get_dependencies
+from .task_manager import TaskManager
+
+
+def quote_value(value):
+    """Quote a value of a submit description the HTCondor way.
+
+    Parameters
+    ----------
+    value : str
+        Value to be quoted.
+
+    Returns
+    -------
+    quoted : str
+        Value in double quotes with the quotes inside doubled.
+    """
+    return '"%s"' % value.replace('"', '""')
+
+
+class CondorTaskManager(TaskManager):
+    """Task manager for HTCondor.
+
+    Every job is described by a submit description file written next to its
+    runner. Single tasks are submitted by `condor_submit`, whole graphs of
+    dependent tasks by a single `condor_submit_dag` call, see
+    :py:meth:`enqueue_dag`.
+
+    Attributes
+    ----------
+    default_submit_command : str
+        Full path to `condor_submit`.
+    default_dag_command : str
+        Full path to `condor_submit_dag`. Can be overridden by the
+        ``dag_command`` configuration option.
+    transient_errors : tuple of str
+        Errors of `condor_submit` caused by an overloaded or unreachable
+        schedd.
+    ambiguous_errors : tuple of str
+        Errors of `condor_submit` after which the job may have been queued,
+        see :py:meth:`find_submission`.
+    supports_dependencies : bool
+        False, single jobs cannot depend on each other, only the nodes of a
+        DAG, see :py:meth:`enqueue_dag`.
+
+    Parameters
+    ----------
+    setup_file : str
+        Filename of the setup file with HTCondor options to use.
+    kwargs
+        Additional configuration options. See :obj:`TaskManager`.
+
+    See Also
+    --------
+    TaskManager
+    """
+
+    default_submit_command = which('condor_submit')
+    default_dag_command = which('condor_submit_dag')
+    transient_errors = (
+            'Failed to connect to (the )?(local )?queue manager',
+            'Could not connect to (the )?(local )?schedd',
+            'SECMAN:2007')
+    ambiguous_errors = ('Timed out',)
+    supports_dependencies = False
+    job_id_variable = 'CONDOR_JOB_ID'
+    status_command = which('condor_q')
+    cancel_command = which('condor_rm')
+    hold_command = which('condor_hold')
+    release_command = which('condor_release')
+    renice_command = which('condor_prio')
+    job_states = {
+            '1': 'pending',
+            '2': 'running',
+            '5': 'held',
+            '6': 'running'}
+
+    def __init__(self, setup_file, **kwargs):
+        super(CondorTaskManager, self).__init__(setup_file, **kwargs)
+        if 'dag_command' not in self.kwargs:
+            self.kwargs['dag_command'] = self.__class__.default_dag_command
+        self.event_log = os.path.abspath(os.path.join(
+                self.runner_dir, 'condor-%s.log' % self.kwargs['salt']))
+
+    def map_opts(self, opts):
+        """Map resolved task options into HTCondor submit commands.
+
+        Parameters
+        ----------
+        opts : dict-like
+            Resolved options to be mapped.
+
+        Returns
+        -------
+        mapped : dict-like
+            Options mapped into lines of a submit description file.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+        mapped = OrderedDict()
+        for name, value in opts.items():
+            if name == 'raw':
+                mapped['raw'] = value
+            elif name == 'current_working_directory':
+                mapped[name] = ['initialdir = %s' % os.getcwd()]
+            elif name == 'log_filename':
+                value = value.replace('%(job_id)s', '$(Cluster)')
+                mapped[name] = ['output = %s' % value, 'error = %s' % value]
+            elif name == 'name':
+                mapped[name] = ['batch_name = %s' % quote_value(value)]
+            elif name == 'walltime':
+                mapped[name] = [
+                    'periodic_remove = (JobStatus == 2) && '
+                    '(time() - EnteredCurrentStatus > %d)' % value]
+            elif name == 'cores':
+                mapped[name] = ['request_cpus = %d' % value]
+            elif name == 'memory':
+                mapped[name] = ['request_memory = %dGB' % value]
+            elif name == 'nice':
+                mapped[name] = ['priority = %d' % -value]
+            elif name == 'exclude_hosts':
+                mapped[name] = ['requirements = %s' % ' && '.join(
+                    '(Machine != %s)' % quote_value(h) for h in value)]
+            elif name == 'dependencies':
+                log.error(
+                    'Dependencies of single jobs are not supported by '
+                    'HTCondor, use enqueue_dag')
+                raise ValueError('Cannot map option: %s' % name)
+            elif name == 'modules':
+                pass
+            else:
+                log.error('Cannot map option: %s', name)
+        return mapped
+
+    def make_submit_cmd(self, task, mapped):
+        """Write the submit description of a task and make its submission.
+
+        The description is written next to the runner with the ``.sub``
+        suffix. The runner is run by `/bin/bash` on a shared file system.
+
+        Parameters
+        ----------
+        task : Task
+            Task with its runner already made.
+        mapped : dict-like
+            Options mapped by :py:meth:`map_opts`.
+
+        Returns
+        -------
+        enqueue_cmd : list of str
+            Submission command.
+        """
+        submit_name = os.path.splitext(task.runner_name)[0] + '.sub'
+        lines = [
+            'universe = vanilla',
+            'executable = /bin/bash',
+            'arguments = %s' % quote_value(task.runner_name),
+            'transfer_executable = false',
+            'log = %s' % self.event_log,
+            'environment = "%s=$(Cluster)"' % self.job_id_variable]
+        lines += [o for oo in mapped.values() for o in oo]
+        lines += ['queue']
+        with self.metrics.timer('write_submit_description'), \
+                open(submit_name, 'w') as fw:
+            fw.write('\n'.join(lines) + '\n')
+        return [self.kwargs['submit_command'], submit_name]
+
+    def enqueue_dag(self, tasks, max_jobs=None, max_idle=None, max_nice=None):
+        """Enqueue a graph of dependent tasks as a single DAGMan job.
+
+        All the jobs are described by one DAG file submitted by a single call
+        of `condor_submit_dag`. DAGMan then submits the jobs as their
+        dependencies finish successfully, at most `max_jobs` at a time. The
+        tasks on the critical path get the highest DAGMan priority, see
+        :py:meth:`.TaskManager.enqueue_graph`.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Tasks forming the graph linked by their `dependencies` option.
+            They can depend only on tasks of the same graph.
+        max_jobs : int, optional
+            Maximum number of jobs of the DAG in the queue. Default:
+            ``dag.max_jobs`` from the setup, or no limit.
+        max_idle : int, optional
+            Maximum number of idle jobs of the DAG. Default: ``dag.max_idle``
+            from the setup, or the DAGMan default.
+        max_nice : int, optional
+            Priority of the task with the largest slack is lower by this value
+            than that of the critical path. Default: ``critical_path.max_nice``
+            from the setup, or 1000.
+
+        Returns
+        -------
+        enqueued : list of Task
+            Enqueued tasks in a topological order. Their `job_id` is the
+            cluster ID of the DAGMan job, which stays in the queue until the
+            whole graph finishes.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+        setup = self.kwargs.get('dag', {})
+        if max_jobs is None:
+            max_jobs = setup.get('max_jobs')
+        if max_idle is None:
+            max_idle = setup.get('max_idle')
+        if max_nice is None:
+            max_nice = self.kwargs.get(
+                    'critical_path', {}).get('max_nice', 1000)
+        tasks = list(tasks)
+        for task in tasks:
+            for t in list(getattr(task, 'tasks', [])) + [task]:
+                t.update_defaults(self.get_shared_defaults(
+                    t.__class__.__name__))
+        order, slack, makespan = analyze_critical_path(tasks)
+        nodes = OrderedDict()
+        parents = OrderedDict()
+        for i, task in enumerate(order):
+            nodes[task] = 'N%d_%s' % (i, task.get_runner_prefix())
+            parents[task] = get_dependencies(task)
+            for dependency in parents[task]:
+                if dependency not in nodes:
+                    raise ValueError(
+                        '%s depends on %s outside of the DAG' % (
+                            task, dependency))
+            # Dependencies are expressed by the DAG, not by the jobs.
+            for t in list(getattr(task, 'tasks', [])) + [task]:
+                t.opts.pop('dependencies', None)
+        lines = []
+        for task, node in nodes.items():
+            enqueue_cmd = self.prepare_job(task)
+            lines += ['JOB %s %s' % (node, enqueue_cmd[-1])]
+            if makespan > 0:
+                lines += ['PRIORITY %s %d' % (node, int(round(
+                    max_nice * (makespan - slack[task]) / makespan)))]
+        for task, node in nodes.items():
+            if parents[task]:
+                lines += ['PARENT %s CHILD %s' % (
+                    ' '.join(nodes[d] for d in parents[task]), node)]
+        makedirs(self.runner_dir)
+        with NamedTemporaryFile(
+                mode='w', suffix='.dag', prefix='Dag-', dir=self.runner_dir,
+                delete=False) as fw:
+            fw.write('\n'.join(lines) + '\n')
+        enqueue_cmd = [self.kwargs['dag_command'], '-batch-name',
+                       'Dag-%s' % self.kwargs['salt']]
+        if max_jobs is not None:
+            enqueue_cmd += ['-maxjobs', str(max_jobs)]
+        if max_idle is not None:
+            enqueue_cmd += ['-maxidle', str(max_idle)]
+        enqueue_cmd += [fw.name]
+        log.info('Prepared a DAG of %d jobs: %s', len(nodes), fw.name)
+        if self.dryrun is True:
+            log.info('Would run %s', enqueue_cmd)
+            job_id = self.record_job(enqueue_cmd, order, files=[
+                os.path.splitext(t.runner_name)[0] + '.sub' for t in order])
+        else:
+            out = self.submit(enqueue_cmd)
+            job_id = self.get_job_id(out)
+            self.metrics.increment('jobs_submitted', len(nodes))
+            if self.in_flight is not None:
+                self.in_flight += 1
+            log.info('Enqueued a DAG of %d jobs as %d', len(nodes), job_id)
+        for task in order:
+            task.job_id = job_id
+        return order
+
+    def enqueue_graph(self, tasks, max_nice=None):
+        """Enqueue a graph of dependent tasks as a single DAGMan job.
+
+        See :py:meth:`enqueue_dag`.
+        """
+        return self.enqueue_dag(tasks, max_nice=max_nice)
+
+    def enqueue_segmented(self, task, segment_walltime=None):
+        """Enqueue a long task as a DAG of shorter jobs.
+
+        The chain of segments is enqueued by :py:meth:`enqueue_dag`, see
+        :py:meth:`.TaskManager.enqueue_segmented`.
+        """
+        segments = self.make_segments(task, segment_walltime)
+        if not segments:
+            return [self.enqueue(task)]
+        self.enqueue_dag(segments)
+        task.job_id = segments[-1].job_id
+        task.runner_name = segments[-1].runner_name
+        return segments
+
+    def find_submission(self, cmd):
+        """Find a job submitted by a command that failed ambiguously.
+
+        A single job is looked up in the queue by the runner in its
+        arguments, a DAG by the DAG file in the arguments of DAGMan. Both
+        filenames are unique. A job that already left the queue is not found.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Submission command ending with the submit description or the DAG
+            file.
+
+        Returns
+        -------
+        out : str
+            Output `condor_submit` would have printed, or None if the job is
+            not in the queue.
+        """
+        if cmd[-1].endswith('.dag'):
+            constraint = 'stringListMember(%s, Arguments, " ")' % json.dumps(
+                    cmd[-1])
+        else:
+            constraint = 'Arguments == %s' % json.dumps(
+                    os.path.splitext(cmd[-1])[0] + '.sh')
+        out = self.run_cmd([
+            self.status_command, getpass.getuser(),
+            '-constraint', constraint, '-af', 'ClusterId'])
+        for line in decode_output(out).splitlines():
+            if line.strip().isdigit():
+                return '1 job(s) submitted to cluster %s.' % line.strip()
+        return None
+
+    def get_job_id(self, output):
+        """Get job ID from the submission ouput.
+
+        Parameters
+        ----------
+        output : string
+            Output of condor_submit or condor_submit_dag.
+
+        Returns
+        -------
+        job_id : int
+            Extracted cluster ID.
+        """
+        match = re.search(r'submitted to cluster (\d+)', decode_output(output))
+        if match is None:
+            raise RuntimeError('Cannot parse job ID: %s' % output)
+        return int(match.group(1))
+
+    def get_job_states(self):
+        """Get states of all the jobs of the user in the queue.
+
+        Returns
+        -------
+        states : dict
+            Mapping of cluster IDs to one of 'pending', 'running', 'held',
+            'error', or 'other'.
+        """
+        out = self.run_cmd([
+            self.status_command, getpass.getuser(),
+            '-af', 'ClusterId', 'JobStatus'])
+        states = {}
+        for line in decode_output(out).splitlines():
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            states[int(fields[0])] = self.job_states.get(fields[1], 'other')
+        return states
+
+    def get_job_names(self):
+        """Get batch names of all the jobs of the user in the queue.
+
+        Node jobs of a DAG share the batch name of DAGMan, see
+        :py:meth:`enqueue_dag`.
+
+        Returns
+        -------
+        names : dict
+            Mapping of cluster IDs to batch names.
+        """
+        out = self.run_cmd([
+            self.status_command, getpass.getuser(),
+            '-af', 'ClusterId', 'JobBatchName'])
+        names = {}
+        for line in decode_output(out).splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                names[int(fields[0])] = fields[1].strip()
+        return names
+
+    def render_control_cmd(self, action, job_ids, value=None):
+        """Render a command controlling jobs.
+
+        See :py:meth:`.TaskManager.render_control_cmd`.
+        """
+        if action == 'renice':
+            return [self.renice_command, '-p', '%d' % -value] + job_ids
+        return super(CondorTaskManager, self).render_control_cmd(
+                action, job_ids, value)
@@ -0,0 +1,130 @@
+"""
+yatamana.critical_path
+----------------------
+
+Critical path analysis of a graph of tasks.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import heapq
+from .utils import parse_walltime
+
+
+def get_walltime(task):
+    """Get the walltime of an unresolved task.
+
+    Parameters
+    ----------
+    task : Task
+        Task with its defaults already updated. A task containing other tasks
+        (i.e., with the `tasks` attribute) takes the sum of their walltimes.
+
+    Returns
+    -------
+    walltime : int
+        Walltime in seconds, 0 if not specified.
+    """
+    if hasattr(task, 'tasks'):
+        return sum(get_walltime(t) for t in task.tasks)
+    value = task.opts.get('walltime', task.defaults.get('walltime'))
+    if value is None:
+        return 0
+    return parse_walltime(value)
+
+
+def get_dependencies(task):
+    """Get the tasks an unresolved task depends on.
+
+    Parameters
+    ----------
+    task : Task
+        Task. A task containing other tasks (i.e., with the `tasks` attribute)
+        depends on the union of their dependencies.
+
+    Returns
+    -------
+    dependencies : list of Task
+        Tasks the task depends on.
+    """
+    if hasattr(task, 'tasks'):
+        dependencies = []
+        for t in task.tasks:
+            dependencies += [d for d in get_dependencies(t)
+                             if d not in dependencies]
+        return dependencies
+    return list(task.opts.get('dependencies') or [])
+
+
+def analyze_critical_path(tasks):
+    """Compute slack of each task in a graph of tasks.
+
+    The slack of a task is the time by which it can be delayed without
+    delaying the completion of the whole graph. The tasks on the critical path
+    have zero slack. Dependencies on tasks outside of the graph are ignored.
+
+    Parameters
+    ----------
+    tasks : list of Task
+        Unresolved tasks forming the graph.
+
+    Returns
+    -------
+    order : list of Task
+        Tasks in a topological order, i.e., every task comes after the tasks
+        it depends on. Among the tasks that are ready at the same time, the
+        ones with the lowest slack come first.
+    slack : dict
+        Slack of each task in seconds.
+    makespan : int
+        Length of the critical path in seconds.
+
+    Raises
+    ------
+    ValueError
+        If the dependencies contain a cycle.
+    """
+    index = dict((task, i) for i, task in enumerate(tasks))
+    walltime = [get_walltime(task) for task in tasks]
+    parents = [[index[d] for d in get_dependencies(task) if d in index]
+               for task in tasks]
+    children = [[] for _ in tasks]
+    for i, ps in enumerate(parents):
+        for p in ps:
+            children[p].append(i)
+    # Topological order by Kahn's algorithm.
+    n_parents = [len(ps) for ps in parents]
+    topo = [i for i, n in enumerate(n_parents) if n == 0]
+    for i in topo:
+        for c in children[i]:
+            n_parents[c] -= 1
+            if n_parents[c] == 0:
+                topo.append(c)
+    if len(topo) != len(tasks):
+        raise ValueError('Dependencies of the tasks contain a cycle.')
+    finish = [0] * len(tasks)
+    for i in topo:
+        start = max([finish[p] for p in parents[i]] + [0])
+        finish[i] = start + walltime[i]
+    makespan = max(finish + [0])
+    latest_finish = [makespan] * len(tasks)
+    for i in reversed(topo):
+        for c in children[i]:
+            latest_finish[i] = min(
+                    latest_finish[i], latest_finish[c] - walltime[c])
+    slack = [latest_finish[i] - finish[i] for i in range(len(tasks))]
+    # Order the ready tasks by their slack.
+    n_parents = [len(ps) for ps in parents]
+    ready = [(slack[i], i) for i, n in enumerate(n_parents) if n == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        order.append(tasks[i])
+        for c in children[i]:
+            n_parents[c] -= 1
+            if n_parents[c] == 0:
+                heapq.heappush(ready, (slack[c], c))
+    return order, dict(zip(tasks, slack)), makespan
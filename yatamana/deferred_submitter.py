@@ -0,0 +1,295 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import logging
+import os
+import time
+from collections import OrderedDict
+
+
+class DeferredSubmitter(object):
+    """Submit the tasks of a graph just in time.
+
+    Instead of enqueueing a whole graph of dependent tasks upfront, the graph
+    is kept by the driver and every task is enqueued only when all the tasks
+    it depends on have finished, so that the queue holds no jobs waiting for
+    dependencies. With `lead` set, a task is enqueued already when the jobs
+    of the unfinished tasks it depends on are running and expected to end
+    within `lead` seconds by their walltime, with scheduler dependencies on
+    them, to hide the queue wait.
+
+    The finished jobs are detected by the sentinels of the runners if the
+    ``completion.sentinel_dir`` option is set, see
+    :py:meth:`.TaskManager.watch_completions`, and tasks depending on failed
+    ones are not enqueued. Otherwise jobs leaving the queue are considered
+    finished, since the schedulers do not tell whether they succeeded. The
+    queue is queried by :py:meth:`.TaskManager.get_task_states`, so the
+    manager has to support it, and `lead` requires jobs depending on each
+    other, which HTCondor does not support. The defaults of the parameters
+    are taken from the ``deferred`` section::
+
+        "deferred": {
+          "lead": 300,
+          "interval": 60
+        }
+
+    Parameters
+    ----------
+    manager : TaskManager
+        Manager enqueueing the tasks.
+    lead : float, optional
+        Seconds before the expected end of the jobs of the tasks a task
+        depends on at which it is enqueued. Default: 0, enqueue once they
+        finished.
+    interval : float, optional
+        Seconds between queries of the queue. Default: 60.
+
+    Attributes
+    ----------
+    records : dict
+        Records of the sentinels of the finished tasks.
+    """
+
+    def __init__(self, manager, lead=None, interval=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        setup = manager.kwargs.get('deferred', {})
+        self.manager = manager
+        self.lead = lead if lead is not None else setup.get('lead', 0)
+        self.interval = interval if interval is not None \
+            else setup.get('interval', 60)
+        self.records = {}
+        self.dependencies = {}
+        self.upstream = OrderedDict()
+        self.submitted = OrderedDict()
+        self.by_name = {}
+        self.running_since = {}
+        self.missing = {}
+        self.status = {}
+
+    def track(self, task):
+        """Start tracking the job of an enqueued task.
+
+        Parameters
+        ----------
+        task : Task
+            Enqueued task.
+        """
+        self.submitted[task] = True
+        name = os.path.splitext(os.path.basename(task.runner_name))[0]
+        self.by_name[name] = task
+
+    def finish(self, task, status):
+        """Record the final status of a task.
+
+        Parameters
+        ----------
+        task : Task
+            Task whose job finished or which will not run.
+        status : str
+            One of 'succeeded', 'failed', 'finished' (the job left the queue),
+            'skipped' (a task it depends on failed), or 'cancelled' (enqueued
+            early, but a task it depends on failed).
+        """
+        self.status[task] = status
+        self.submitted.pop(task, None)
+        self.running_since.pop(task, None)
+        self.missing.pop(task, None)
+
+    def is_ending(self, task, now):
+        """Check whether the job of a task is expected to end within `lead`.
+
+        Parameters
+        ----------
+        task : Task
+            Enqueued task.
+        now : float
+            Current time.
+
+        Returns
+        -------
+        ending : bool
+            True if the job runs and its walltime ends within `lead` seconds.
+        """
+        since = self.running_since.get(task)
+        walltime = task.opts.get('walltime')
+        return since is not None and walltime is not None and \
+            since + walltime - self.lead <= now
+
+    def check_queue(self, watching):
+        """Query the queue for running jobs and jobs that left it.
+
+        Parameters
+        ----------
+        watching : bool
+            Whether finished jobs are detected by their sentinels. Jobs
+            leaving the queue without one are then considered failed, e.g.
+            because they were killed.
+
+        Returns
+        -------
+        finished : list of tuple
+            Tasks whose jobs left the queue, with their status.
+        """
+        states = self.manager.get_task_states(list(self.submitted))
+        now = time.time()
+        finished = []
+        for task in list(self.submitted):
+            state = states.get(task)
+            if state is not None:
+                self.missing.pop(task, None)
+                if state == 'running':
+                    self.running_since.setdefault(task, now)
+                continue
+            # Tolerate a lag of the listing behind the submissions.
+            self.missing[task] = self.missing.get(task, 0) + 1
+            if self.missing[task] < 2:
+                continue
+            if watching:
+                self.log.warning('Job %s of %s left the queue without a '
+                                 'sentinel', task.job_id, task)
+                status = 'failed'
+            else:
+                status = 'finished'
+            self.finish(task, status)
+            finished += [(task, status)]
+        return finished
+
+    def submit_ready(self):
+        """Enqueue the waiting tasks whose dependencies allow it.
+
+        Returns
+        -------
+        finished : list of tuple
+            Tasks that will not run because a task they depend on failed,
+            with their status.
+        """
+        now = time.time()
+        finished = []
+        for task, dependencies in list(self.upstream.items()):
+            failed = [
+                d for d in dependencies
+                if self.status.get(d) not in (None, 'succeeded', 'finished')]
+            if failed:
+                self.log.warning('Skipping %s, %s did not succeed', task,
+                                 failed[0])
+                del self.upstream[task]
+                self.finish(task, 'skipped')
+                finished += [(task, 'skipped')]
+                continue
+            pending = [d for d in dependencies if d not in self.status]
+            if pending and not self.lead or any(
+                    d not in self.submitted or not self.is_ending(d, now)
+                    for d in pending):
+                continue
+            del self.upstream[task]
+            task.opts['dependencies'] = pending
+            self.manager.enqueue(task)
+            self.track(task)
+        return finished
+
+    def cancel_early(self):
+        """Cancel tasks enqueued early whose dependencies failed.
+
+        Returns
+        -------
+        finished : list of tuple
+            Cancelled tasks with their status.
+        """
+        cancelled = [
+            task for task in self.submitted
+            if any(self.status.get(d) in ('failed', 'skipped', 'cancelled')
+                   for d in self.dependencies.get(task, ()))]
+        if not cancelled:
+            return []
+        self.manager.control('cancel', cancelled)
+        for task in cancelled:
+            self.finish(task, 'cancelled')
+        return [(task, 'cancelled') for task in cancelled]
+
+    def run(self, tasks, timeout=None, watcher=None):
+        """Enqueue tasks just in time and iterate over them as they finish.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Tasks forming the graph. The tasks they depend on have to be
+            either enqueued already or contained in `tasks`.
+        timeout : float, optional
+            Maximum number of seconds to wait in total. Default: no limit.
+        watcher : CompletionWatcher, optional
+            Watcher to use if the ``completion.sentinel_dir`` option is set.
+            Default: create one by :py:meth:`.TaskManager.watch_completions`.
+
+        Returns
+        -------
+        finished : iterator of (Task, str)
+            Tasks with their final status, see :py:meth:`finish`, in the
+            order of finishing.
+
+        Raises
+        ------
+        ValueError
+            If the queue of the manager cannot be queried, or if `lead` is
+            set and its jobs cannot depend on each other.
+        """
+        try:
+            self.manager.get_job_states()
+        except NotImplementedError as e:
+            raise ValueError('%s, cannot submit just in time' % e)
+        if self.lead and not self.manager.supports_dependencies:
+            raise ValueError(
+                'Jobs of %s cannot depend on each other, cannot submit '
+                'before the dependencies finish, use lead=0' %
+                self.manager.__class__.__name__)
+        tasks = list(tasks)
+        wanted = set(tasks)
+        for task in tasks:
+            if task.job_id is not None:
+                self.track(task)
+                continue
+            dependencies = list(task.opts.get('dependencies', []))
+            self.dependencies[task] = dependencies
+            self.upstream[task] = dependencies
+        for dependencies in self.dependencies.values():
+            for d in dependencies:
+                if d in self.upstream or d in self.submitted:
+                    continue
+                if d.job_id is None:
+                    raise ValueError('%s is neither enqueued nor given' % d)
+                self.track(d)
+        watching = self.manager.sentinel_dir is not None
+        own_watcher = watching and watcher is None
+        if own_watcher:
+            watcher = self.manager.watch_completions()
+        deadline = None if timeout is None else time.time() + timeout
+        next_check = time.time()
+        try:
+            while self.upstream or not wanted.isdisjoint(self.submitted):
+                finished = self.submit_ready()
+                if time.time() >= next_check:
+                    finished += self.check_queue(watching)
+                    next_check = time.time() + self.interval
+                if watching:
+                    wait = next_check - time.time()
+                    if deadline is not None:
+                        wait = min(wait, deadline - time.time())
+                    for record in watcher.poll(max(0, wait)):
+                        task = self.by_name.pop(record['name'], None)
+                        if task is None or task not in self.submitted:
+                            continue
+                        self.records[task] = record
+                        status = 'succeeded' if record['exit_code'] == 0 \
+                            else 'failed'
+                        self.finish(task, status)
+                        finished += [(task, status)]
+                elif not finished:
+                    time.sleep(max(0, next_check - time.time()))
+                finished += self.cancel_early()
+                for task, status in finished:
+                    if task in wanted:
+                        yield task, status
+                if deadline is not None and time.time() >= deadline:
+                    break
+        finally:
+            if own_watcher:
+                watcher.close()
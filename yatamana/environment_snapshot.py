@@ -0,0 +1,110 @@
+"""
+yatamana.environment_snapshot
+-----------------------------
+
+Snapshots of the environment set up by environment modules.
+
+Loading environment modules at the start of every job is slow on a busy
+shared file system. Instead, the first job with a given set of modules saves
+the resulting environment into a snapshot file and the following jobs just
+source it.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import hashlib
+import os
+from .utils import quote
+
+#: Environment variables specific to a job that are never snapshotted.
+EXCLUDED_VARIABLES = (
+        'SLURM_[A-Za-z0-9_]*', 'SGE_[A-Za-z0-9_]*', 'JOB_ID', 'JOB_NAME',
+        'NSLOTS', 'NHOSTS', 'NQUEUES', 'PE', 'PE_HOSTFILE', 'QUEUE',
+        'RESTARTED', 'TMPDIR', 'TMP', 'HOSTNAME', 'HOST', 'PWD', 'OLDPWD',
+        'SHLVL', '_', 'CUDA_VISIBLE_DEVICES', 'GPU_DEVICE_ORDINAL',
+        'OMP_NUM_THREADS', 'yatamana_[A-Za-z0-9_]*')
+
+
+def get_modules_fingerprint(modules, modulepath, watch=()):
+    """Get a fingerprint of the module files providing given modules.
+
+    The fingerprint changes whenever a module file of the given modules is
+    changed, or a version of a module is added or removed.
+
+    Parameters
+    ----------
+    modules : list of str
+        Names of the modules, optionally with versions, e.g. 'python/2.7.13'.
+    modulepath : list of str
+        Directories with module files.
+    watch : list of str, optional
+        Additional files whose changes should change the fingerprint, e.g.
+        a script setting up the modules.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest.
+    """
+    sha1 = hashlib.sha1()
+    candidates = []
+    for module in modules:
+        for directory in modulepath:
+            path = os.path.join(directory, module)
+            candidates += [path, path + '.lua']
+            # Default versions are given by the contents of the directory.
+            candidates += [os.path.join(directory, module.split('/')[0])]
+    for path in list(candidates) + list(watch):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        sha1.update(('%s %r\n' % (path, mtime)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def render_environment(setup, modules, filename, exclude=()):
+    """Render commands sourcing or creating an environment snapshot.
+
+    Parameters
+    ----------
+    setup : list of str
+        Commands setting up the environment, may contain ``%(modules)s``.
+    modules : str
+        Space separated modules to substitute for ``%(modules)s``.
+    filename : str
+        Filename of the snapshot.
+    exclude : list of str, optional
+        Regular expressions matching names of additional environment
+        variables not to be snapshotted.
+
+    Returns
+    -------
+    lines : list of str
+        Lines of the rendered commands.
+    """
+    excluded = '|'.join(EXCLUDED_VARIABLES + tuple(exclude))
+    snapshot = quote(filename)
+    # Values are quoted by %q, so that multi-line values survive, and
+    # readonly variables are skipped, since sourcing cannot set them.
+    return [
+        'if [ -r %s ]; then' % snapshot,
+        '\tsource %s' % snapshot,
+        'else'] + [
+        '\t' + line % {'modules': modules} for line in setup] + [
+        '\tmkdir -p %s' % quote(os.path.dirname(filename) or '.'),
+        '\t{',
+        '\t\tyatamana_excluded=%s' % quote('^(%s)$' % excluded),
+        "\t\tyatamana_readonly='^declare -[a-zA-Z]*r'",
+        '\t\tfor yatamana_name in $(compgen -e); do',
+        '\t\t\t[[ $yatamana_name =~ $yatamana_excluded ]] && continue',
+        '\t\t\t[[ $(declare -p "$yatamana_name") =~ $yatamana_readonly ]] &&',
+        '\t\t\t\tcontinue',
+        '\t\t\tprintf \'export %s=%q\\n\' "$yatamana_name" '
+        '"${!yatamana_name}"',
+        '\t\tdone',
+        '\t\tdeclare -f',
+        '\t} > %s.$$ && mv %s.$$ %s' % (snapshot, snapshot, snapshot),
+        'fi']
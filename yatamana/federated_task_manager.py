@@ -0,0 +1,502 @@
+from __future__ import (
+        print_function, division, absolute_import, unicode_literals)
+
+import logging
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from .utils import parse_walltime
+from .task import Task, DEFAULTS
+from .chunk_of_tasks_task import ChunkOfTasksTask
+from .critical_path import get_dependencies
+from .task_manager import TaskManager
+
+
+class MemberLoad(object):
+    """Load of a member of :py:class:`FederatedTaskManager`.
+
+    Parameters
+    ----------
+    queue_wait : float, optional
+        Initial estimate of the time a job waits in the queue in seconds.
+    """
+    def __init__(self, queue_wait=0.):
+        self.in_flight = 0
+        self.queue_wait = queue_wait
+        self.pending = {}
+        self.last_refresh = None
+
+    def record_submission(self, job_id):
+        """Record a newly submitted job.
+        """
+        self.in_flight += 1
+        self.pending[job_id] = time.time()
+
+    def update(self, states, alpha=0.3):
+        """Update the load from the states of the jobs in the queue.
+
+        Jobs that are neither pending nor held anymore are considered started
+        and their queue wait updates the moving average of queue waits.
+
+        Parameters
+        ----------
+        states : dict
+            Job states, see :py:meth:`.TaskManager.get_job_states`.
+        alpha : float
+            Weight of a new observation in the moving average.
+        """
+        now = time.time()
+        self.in_flight = len(states)
+        for job_id, submitted in list(self.pending.items()):
+            if states.get(job_id) not in ('pending', 'held'):
+                wait = now - submitted
+                self.queue_wait = (1 - alpha) * self.queue_wait + alpha * wait
+                del self.pending[job_id]
+        self.last_refresh = now
+
+
+class FederatedTaskManager(TaskManager):
+    """Task manager spreading tasks across several other task managers.
+
+    Each task is routed to one of the member managers. Tasks depending on
+    tasks enqueued to a member are routed to the same member if possible.
+    Small tasks can take a fast path to a dedicated member, typically a
+    :py:class:`.LocalTaskManager`, avoiding the queue latency of a cluster.
+    The other tasks are routed to the member with the lowest expected delay
+    estimated from the recent queue waits and the number of jobs in flight
+    relative to the member's capacity. Members whose limits do not fit the
+    size of the task are skipped.
+
+    The setup file lists the members in the ``members`` section::
+
+        "members": {
+          "slurm-a": {"setup_file": "slurm-a.json", "capacity": 2000},
+          "sge": {
+            "setup_file": "sge.json", "capacity": 500,
+            "max_walltime": "2-00", "max_cores": 16, "queue_wait": 600},
+          "local": {"setup_file": "local.json"}
+        },
+        "fast_path": {"member": "local", "max_walltime": 2, "max_cores": 1}
+
+    Member setups can also contain `max_memory` and `kwargs` passed to the
+    member manager. The member managers share the salt of this manager. The
+    setup of the federation needs no runner section, the tasks get the
+    defaults of the member they are routed to. Optional ``runner.opts`` and
+    ``tasks`` sections give defaults used before routing, e.g., by
+    :py:meth:`.enqueue_graph`.
+
+    Dependencies across members cannot be expressed to the schedulers. A task
+    depending on tasks of another member is enqueued only after those leave
+    the queue of their member. Note that the schedulers do not tell whether
+    the jobs succeeded.
+
+    Parameters
+    ----------
+    setup_file : str
+        Filename of the setup file with the members.
+    kwargs
+        Additional configuration options. See :obj:`TaskManager`.
+    """
+
+    def __init__(self, setup_file, dryrun=False, **kwargs):
+        super(FederatedTaskManager, self).__init__(
+                setup_file, dryrun=dryrun, **kwargs)
+        from .task_manager_factory import get_task_manager
+        self.members = OrderedDict()
+        self.loads = {}
+        for name, setup in self.kwargs['members'].items():
+            member_kwargs = dict(setup.get('kwargs', {}))
+            member_kwargs.setdefault('salt', self.kwargs['salt'])
+            self.members[name] = get_task_manager(
+                    setup['setup_file'], dryrun=dryrun, **member_kwargs)
+            self.loads[name] = MemberLoad(setup.get('queue_wait', 0.))
+        self.fast_path = self.kwargs.get('fast_path', {})
+        self.status_interval = self.kwargs.get('status_interval', 60)
+
+    def enqueue(self, task, wrapper=ChunkOfTasksTask):
+        """Route a given task to one of the members and enqueue it there.
+
+        Parameters
+        ----------
+        task : Task | iterable of Task
+            One or more tasks to be computed, see
+            :py:meth:`.TaskManager.enqueue`.
+        wrapper : type, optional
+            Class of the wrapper task used for multiple tasks.
+
+        Returns
+        -------
+        enqueued_task : Task
+            Enqueued task. Its `member` attribute is set to the name of the
+            member it was enqueued to.
+        """
+        if not issubclass(task.__class__, Task):
+            task = list(task)
+            tasks = task
+        else:
+            tasks = [task]
+        name = self.route(tasks)
+        member = self.members[name]
+        self.wait_for_foreign_dependencies(tasks, name)
+        self.log.info('Routing %d task(s) to %s', len(tasks), name)
+        enqueued = member.enqueue(task, wrapper=wrapper)
+        enqueued.member = name
+        for t in tasks:
+            t.member = name
+        if not member.dryrun:
+            self.loads[name].record_submission(enqueued.job_id)
+        return enqueued
+
+    def start_plan(self):
+        """Refuse to record a plan, the jobs go to the members.
+
+        Raises
+        ------
+        ValueError
+            Always, a plan is submitted by a single task manager. Plans can
+            be recorded with the member managers instead.
+        """
+        raise ValueError('Plans cannot be recorded by a federation')
+
+    def enqueue_inner(self, task):
+        """Route a task to one of the members and enqueue it there.
+
+        Parameters
+        ----------
+        task : Task
+            Task to be enqueued.
+
+        Returns
+        -------
+        task : Task
+            Enqueued task.
+        """
+        return self.enqueue(task)
+
+    def get_task_defaults(self, clsname):
+        """Get default opts for a task of a given class before routing.
+
+        Parameters
+        ----------
+        clsname : string
+            Name of the task class.
+
+        Returns
+        -------
+        defaults : dict-like
+            Options from the optional ``runner.opts`` and ``tasks.clsname``
+            sections of the setup of the federation.
+        """
+        opts = deepcopy(self.kwargs.get('runner', {}).get('opts', {}))
+        opts.update(deepcopy(self.kwargs.get('tasks', {}).get(clsname, {})))
+        return opts
+
+    def get_shared_defaults(self, clsname):
+        """Get defaults shared by all the tasks of a given class before
+        routing.
+
+        Without defaults of the federation, the tasks keep the defaults of
+        every task, so that they share the defaults of their member once
+        enqueued.
+
+        Parameters
+        ----------
+        clsname : string
+            Name of the task class.
+
+        Returns
+        -------
+        defaults : SharedDefaults
+            Read-only default options.
+        """
+        if not self.get_task_defaults(clsname):
+            return DEFAULTS
+        return super(FederatedTaskManager, self).get_shared_defaults(clsname)
+
+    def get_chunk_size(self, clsname, default=5,
+                       wrapper_clsname='ChunkOfTasksTask'):
+        """Get chunk size from the defaults of the federation or members.
+
+        The chunks are formed before routing, so unless the federation sets
+        the chunk size, the smallest chunk size of the members is used.
+
+        See :py:meth:`.TaskManager.get_chunk_size` for the parameters.
+        """
+        sizes = self.get_task_defaults(wrapper_clsname).get('chunk_size', {})
+        if clsname in sizes:
+            return sizes[clsname]
+        return min(
+            member.get_chunk_size(clsname, default, wrapper_clsname)
+            for member in self.members.values())
+
+    def get_size(self, name, tasks):
+        """Get the resources requested by tasks from a given member.
+
+        Parameters
+        ----------
+        name : str
+            Name of the member whose defaults are used.
+        tasks : list of Task
+            Tasks to be run one after another inside a single job.
+
+        Returns
+        -------
+        walltime : int
+            Sum of the walltimes in seconds.
+        cores : int
+            Maximum number of cores.
+        memory : int
+            Maximum memory in GB.
+        """
+        member = self.members[name]
+        walltime, cores, memory = 0, 0, 0
+        for task in tasks:
+            opts = dict(member.get_shared_defaults(task.__class__.__name__))
+            opts.update(task.opts)
+            walltime += parse_walltime(opts.get('walltime', 0))
+            cores = max(cores, opts.get('cores', 1))
+            memory = max(memory, opts.get('memory', 0))
+        return walltime, cores, memory
+
+    def fits(self, setup, size):
+        """Check whether the size of a job fits limits of a member.
+
+        Parameters
+        ----------
+        setup : dict
+            Setup with optional `max_walltime`, `max_cores`, and `max_memory`.
+        size : tuple
+            Walltime, cores, and memory as returned by :py:meth:`get_size`.
+
+        Returns
+        -------
+        fits : bool
+            True if all the limits are satisfied.
+        """
+        walltime, cores, memory = size
+        if 'max_walltime' in setup and \
+                walltime > parse_walltime(setup['max_walltime']):
+            return False
+        if cores > setup.get('max_cores', cores):
+            return False
+        if memory > setup.get('max_memory', memory):
+            return False
+        return True
+
+    def refresh(self, name, force=False):
+        """Update the load of a member if it was not updated recently.
+
+        Parameters
+        ----------
+        name : str
+            Name of the member.
+        force : bool, optional
+            Update regardless of the time of the last update.
+        """
+        load = self.loads[name]
+        if force is False and load.last_refresh is not None and \
+                time.time() - load.last_refresh < self.status_interval:
+            return
+        load.update(self.members[name].get_job_states())
+
+    def route(self, tasks):
+        """Choose a member for a job consisting of given tasks.
+
+        Parameters
+        ----------
+        tasks : list of Task
+            Tasks to be run inside a single job.
+
+        Returns
+        -------
+        name : str
+            Name of the chosen member.
+        """
+        dependency_members = {}
+        for task in tasks:
+            for dependency in get_dependencies(task):
+                name = getattr(dependency, 'member', None)
+                if name is not None:
+                    dependency_members[name] = \
+                        dependency_members.get(name, 0) + 1
+        fast = self.fast_path.get('member')
+        if fast is not None and set(dependency_members) <= set([fast]) and \
+                self.fits(self.fast_path, self.get_size(fast, tasks)):
+            return fast
+        while True:
+            candidates = []
+            for name, setup in self.kwargs['members'].items():
+                if name == fast:
+                    continue
+                if not self.fits(setup, self.get_size(name, tasks)):
+                    continue
+                self.refresh(name)
+                load = self.loads[name]
+                capacity = setup.get('capacity', 1000)
+                if load.in_flight >= capacity:
+                    continue
+                delay = (load.queue_wait + 1) * (
+                        1 + load.in_flight / capacity)
+                candidates += [(-dependency_members.get(name, 0), delay, name)]
+            if candidates:
+                return min(candidates)[2]
+            if not any(self.fits(setup, self.get_size(name, tasks))
+                       for name, setup in self.kwargs['members'].items()
+                       if name != fast):
+                raise ValueError('No member can run the tasks: %s' % tasks)
+            self.log.info(
+                    'All members are full, waiting %ds', self.status_interval)
+            time.sleep(self.status_interval)
+            for name in self.members:
+                self.refresh(name, force=True)
+
+    def wait_for_foreign_dependencies(self, tasks, name):
+        """Wait for dependencies enqueued to other members.
+
+        The satisfied dependencies are removed from the tasks.
+
+        Parameters
+        ----------
+        tasks : list of Task
+            Tasks to be enqueued to a member.
+        name : str
+            Name of the member.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+        pending = OrderedDict()
+        local = []
+        for task in tasks:
+            for t in [task] + list(getattr(task, 'tasks', [])):
+                dependencies = t.opts.get('dependencies')
+                if not dependencies:
+                    continue
+                for d in dependencies:
+                    if getattr(d, 'member', name) != name:
+                        pending.setdefault(d.member, set()).add(d.job_id)
+                local += [(t, [
+                    d for d in dependencies
+                    if getattr(d, 'member', name) == name])]
+        # A single query per member and interval for all the dependencies.
+        while pending:
+            for member, job_ids in list(pending.items()):
+                job_ids &= set(self.members[member].get_job_states())
+                if not job_ids:
+                    del pending[member]
+            if pending:
+                log.info(
+                        'Waiting for %d jobs on %s to finish',
+                        sum(len(job_ids) for job_ids in pending.values()),
+                        ', '.join(pending))
+                time.sleep(self.status_interval)
+        for t, dependencies in local:
+            t.opts['dependencies'] = dependencies
+
+    def group_by_member(self, tasks):
+        """Group enqueued tasks by the members they were routed to.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks, tasks without a member are skipped with a
+            warning.
+
+        Returns
+        -------
+        by_member : OrderedDict
+            Mapping of names of the members to lists of their tasks.
+        """
+        by_member = OrderedDict()
+        for task in tasks:
+            name = getattr(task, 'member', None)
+            if name is None:
+                self.log.warning('%s was not enqueued by a member', task)
+                continue
+            by_member.setdefault(name, []).append(task)
+        return by_member
+
+    def get_task_states(self, tasks):
+        """Get states of the jobs of given tasks in the queues of their
+        members.
+
+        Only the members of the tasks are queried, each of them once.
+
+        See :py:meth:`.TaskManager.get_task_states`.
+        """
+        states = {}
+        for name, member_tasks in self.group_by_member(tasks).items():
+            states.update(self.members[name].get_task_states(member_tasks))
+        return states
+
+    def resubmit(self, task):
+        """Submit the runner of an enqueued task again on its member.
+
+        See :py:meth:`.TaskManager.resubmit`.
+        """
+        return self.members[task.member].resubmit(task)
+
+    def enqueue_copy(self, task, exclude_hosts=None):
+        """Enqueue a copy of an enqueued task on its member.
+
+        See :py:meth:`.TaskManager.enqueue_copy`.
+        """
+        duplicate = self.members[task.member].enqueue_copy(
+                task, exclude_hosts=exclude_hosts)
+        duplicate.member = task.member
+        return duplicate
+
+    def get_job_states(self):
+        """Get states of all the jobs of the user in the queues of all
+        members.
+
+        Job IDs are unique within a member only, so the states are keyed by
+        the names of the members too.
+
+        Returns
+        -------
+        states : dict
+            Mapping of (member, job ID) tuples to states, see
+            :py:meth:`.TaskManager.get_job_states`.
+        """
+        states = {}
+        for name, member in self.members.items():
+            for job_id, state in member.get_job_states().items():
+                states[(name, job_id)] = state
+        return states
+
+    def count_in_flight(self):
+        """Count jobs of the user in the queues of all members.
+
+        Returns
+        -------
+        n : int
+            Number of jobs in the queues in any state, see
+            :py:meth:`.TaskManager.count_in_flight`.
+        """
+        return sum(m.count_in_flight() for m in self.members.values())
+
+    def control_jobs(self, action, job_ids, value=None):
+        """Refuse to control jobs by their IDs, which are ambiguous across
+        the members.
+
+        Raises
+        ------
+        ValueError
+            Always, the jobs of tasks are controlled on their members by
+            :py:meth:`control`.
+        """
+        raise ValueError('Job IDs are ambiguous across members, control '
+                         'the jobs of tasks instead')
+
+    def control(self, action, tasks=None, salt=None, value=None):
+        """Control the jobs of tasks on their members, or all the jobs with a
+        salt on all the members.
+
+        See :py:meth:`.TaskManager.control`.
+        """
+        if tasks is None:
+            return sum(m.control(action, salt=salt, value=value)
+                       for m in self.members.values())
+        if salt is not None:
+            raise ValueError('Give either tasks or a salt')
+        return sum(self.members[name].control(action, tasks, value=value)
+                   for name, tasks in self.group_by_member(tasks).items())
@@ -7,6 +7,7 @@ import os
 class FileExistsFinishedMixin(object):
     """Mixin checking for the existance of the output file.
     """
+    __slots__ = ()
 
     def is_finished(self):
         """Return True if the output file exists.
@@ -43,6 +43,14 @@ class LocalTaskManager(TaskManager):
                 pass
             elif name == 'dependencies':
                 pass
+            elif name == 'nodes':
+                pass
+            elif name == 'walltime':
+                pass
+            elif name == 'nice':
+                pass
+            elif name == 'exclude_hosts':
+                pass
             else:
                 log.warning('Cannot map option: %s', name)
         return mapped
@@ -63,3 +71,42 @@ class LocalTaskManager(TaskManager):
         with self._last_job_id_lock:
             self.last_job_id += 1
         return self.last_job_id
+
+    def get_job_states(self):
+        """Get states of the jobs in the queue.
+
+        Returns
+        -------
+        states : dict
+            Always empty, local jobs are run in a blocking fashion.
+        """
+        return {}
+
+    def get_job_names(self):
+        """Get names of the jobs in the queue.
+
+        Returns
+        -------
+        names : dict
+            Always empty, local jobs are run in a blocking fashion.
+        """
+        return {}
+
+    def control_jobs(self, action, job_ids, value=None):
+        """Do nothing, local jobs finish before they are enqueued.
+
+        Parameters
+        ----------
+        action : str
+            Ignored.
+        job_ids : iterable of int
+            Ignored.
+        value : int, optional
+            Ignored.
+
+        Returns
+        -------
+        count : int
+            Always 0.
+        """
+        return 0
@@ -0,0 +1,158 @@
+"""
+yatamana.log_archive
+--------------------
+
+Consolidated archives of logs of many tasks.
+
+An archive is a single file of framed segments, one per task, accompanied by
+an index file (the archive filename with the ``.idx`` suffix) with a line
+``key offset length`` per segment. Runners append to an archive under an
+exclusive lock (``flock``) on the archive filename with the ``.lock`` suffix.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import os
+from .utils import quote
+
+
+def read_index(filename):
+    """Read the index of an archive.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the index.
+
+    Returns
+    -------
+    index : dict
+        Mapping of keys to pairs of the offset and length of their segments.
+        If a key occurs multiple times, the last segment wins.
+    """
+    index = {}
+    with open(filename) as fr:
+        for line in fr:
+            fields = line.split()
+            if len(fields) == 3:
+                index[fields[0]] = (int(fields[1]), int(fields[2]))
+    return index
+
+
+class LogArchive(object):
+    """Reader of a log archive.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the archive.
+
+    Examples
+    --------
+    >>> archive = LogArchive('logs/abc123.log')  # doctest: +SKIP
+    >>> print(archive.get_log(task))  # doctest: +SKIP
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = read_index(filename + '.idx')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        """Get the keys of all the segments.
+        """
+        return self.index.keys()
+
+    def read(self, key):
+        """Read the segment of a given key.
+
+        Parameters
+        ----------
+        key : str
+            Key of the segment.
+
+        Returns
+        -------
+        contents : str
+            Contents of the segment.
+
+        Raises
+        ------
+        KeyError
+            If there is no segment of the given key.
+        """
+        offset, length = self.index[key]
+        with open(self.filename, 'rb') as fr:
+            fr.seek(offset)
+            contents = fr.read(length)
+        return contents.decode('utf-8', 'replace')
+
+    def get_log(self, task):
+        """Read the log of a given task.
+
+        Parameters
+        ----------
+        task : Task
+            Task run inside a chunk, see :py:meth:`.Task.get_key`.
+
+        Returns
+        -------
+        log : str
+            Contents of the log.
+        """
+        return self.read(task.get_key())
+
+
+def render_log_buffering(filename):
+    """Render shell commands buffering logs to be appended to an archive.
+
+    The rendered commands create a node-local directory
+    ``$yatamana_logs`` for the logs of the individual tasks named
+    ``<key>.log`` and define a function ``yatamana_flush_logs`` appending them
+    to the archive. It holds the lock of the archive only once per job. The
+    function has to be called at the end of the job and when the job is
+    terminated.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the archive.
+
+    Returns
+    -------
+    lines : list of str
+        Lines of the rendered commands.
+    """
+    archive = quote(filename)
+    index = quote(filename + '.idx')
+    lock = quote(filename + '.lock')
+    return [
+        'yatamana_logs=$(mktemp -d "${TMPDIR:-/tmp}/yatamana-logs.XXXXXX")',
+        'yatamana_flush_logs () {',
+        '\tmkdir -p %s' % quote(os.path.dirname(filename) or '.'),
+        '\t(',
+        '\t\tflock 9',
+        '\t\ttouch %s' % archive,
+        '\t\toffset=$(stat -c %%s %s)' % archive,
+        '\t\tfor f in "$yatamana_logs"/*.log; do',
+        '\t\t\t[ -e "$f" ] || continue',
+        '\t\t\tkey=$(basename "$f" .log)',
+        '\t\t\tsize=$(stat -c %s "$f")',
+        '\t\t\theader="### yatamana-log $key $size"',
+        '\t\t\toffset=$((offset + ${#header} + 1))',
+        '\t\t\techo "$header"',
+        '\t\t\tcat "$f"',
+        '\t\t\techo "$key $offset $size" >> "$yatamana_logs/index"',
+        '\t\t\toffset=$((offset + size))',
+        '\t\tdone >> %s' % archive,
+        '\t\t[ -e "$yatamana_logs/index" ] && '
+        'cat "$yatamana_logs/index" >> %s' % index,
+        '\t) 9>> %s' % lock,
+        '\trm -rf "$yatamana_logs"',
+        '}']
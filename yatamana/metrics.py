@@ -0,0 +1,281 @@
+"""
+yatamana.metrics
+----------------
+
+Timings and counters of the enqueueing.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from .utils import makedirs
+
+
+#: Upper bounds of the histogram buckets of timings in seconds.
+TIME_BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.,
+        10., 30., 60.)
+
+#: Upper bounds of the histogram buckets of counts.
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values.
+
+    Parameters
+    ----------
+    buckets : tuple of float
+        Sorted upper bounds of the buckets. An implicit ``+Inf`` bucket is
+        added.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value to the histogram.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        """Represent the histogram as a dictionary.
+
+        Returns
+        -------
+        histogram : dict
+            Cumulative counts per bucket, sum, and count of the values.
+        """
+        cumulative = OrderedDict()
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative['%s' % bound] = total
+        return OrderedDict([
+            ('buckets', cumulative),
+            ('sum', self.sum),
+            ('count', self.count)])
+
+
+class Metrics(object):
+    """Collect timings and counters of the phases of enqueueing.
+
+    Timings are collected into histograms named after the phase by
+    :py:meth:`timer`, errors raised inside a timed phase are counted by the
+    ``errors`` counter labeled by the phase.
+
+    Parameters
+    ----------
+    labels : dict, optional
+        Constant labels added to all exported metrics, e.g. the salt.
+    profile : str, optional
+        If given, the outermost timed phases are profiled by cProfile and the
+        statistics are dumped to this file by :py:meth:`export_profile`.
+    """
+
+    #: Buckets of histograms that do not hold timings.
+    buckets = {
+            'tasks_per_chunk': COUNT_BUCKETS}
+
+    def __init__(self, labels=None, profile=None):
+        self.labels = OrderedDict(sorted((labels or {}).items()))
+        self.histograms = OrderedDict()
+        self.counters = OrderedDict()
+        self.hooks = []
+        self.profile = profile
+        self.profiler = None if profile is None else cProfile.Profile()
+        self._depth = threading.local()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Register a function called with every observation.
+
+        Parameters
+        ----------
+        hook : callable
+            Called as ``hook(kind, name, value)`` where `kind` is
+            'histogram' or 'counter'.
+        """
+        self.hooks.append(hook)
+
+    def observe(self, name, value):
+        """Add a value to a histogram.
+
+        Parameters
+        ----------
+        name : str
+            Name of the histogram.
+        value : float
+            Observed value.
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(self.buckets.get(name, TIME_BUCKETS))
+                self.histograms[name] = histogram
+            histogram.observe(value)
+        for hook in self.hooks:
+            hook('histogram', name, value)
+
+    def increment(self, name, value=1):
+        """Increment a counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter.
+        value : int, optional
+            Increment. Default: 1.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for hook in self.hooks:
+            hook('counter', name, value)
+
+    @contextmanager
+    def timer(self, phase):
+        """Time a phase of the enqueueing.
+
+        Parameters
+        ----------
+        phase : str
+            Name of the phase, e.g. 'submit'.
+        """
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        if self.profiler is not None and depth == 0:
+            self.profiler.enable()
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.increment('errors.%s' % phase)
+            raise
+        finally:
+            self.observe(phase, time.time() - start)
+            self._depth.value = depth
+            if self.profiler is not None and depth == 0:
+                self.profiler.disable()
+
+    def to_dict(self):
+        """Represent the metrics as a dictionary.
+
+        Returns
+        -------
+        metrics : dict
+            Labels, histograms, and counters.
+        """
+        with self._lock:
+            return OrderedDict([
+                ('labels', self.labels),
+                ('histograms', OrderedDict(
+                    (name, histogram.to_dict())
+                    for name, histogram in self.histograms.items())),
+                ('counters', OrderedDict(self.counters))])
+
+    def to_prometheus(self):
+        """Format the metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        text : str
+            Metrics in the text format.
+        """
+        metrics = self.to_dict()
+        lines = []
+        for name, histogram in metrics['histograms'].items():
+            metric = 'yatamana_%s' % name
+            if name not in self.buckets:
+                metric += '_seconds'
+            lines += ['# TYPE %s histogram' % metric]
+            for bound, count in histogram['buckets'].items():
+                lines += ['%s_bucket%s %d' % (
+                    metric, _format_labels(self.labels, le=bound), count)]
+            labels = _format_labels(self.labels)
+            lines += [
+                    '%s_sum%s %r' % (metric, labels, histogram['sum']),
+                    '%s_count%s %d' % (metric, labels, histogram['count'])]
+        errors = OrderedDict()
+        for name, value in metrics['counters'].items():
+            if name.startswith('errors.'):
+                errors[name[len('errors.'):]] = value
+                continue
+            metric = 'yatamana_%s_total' % name
+            lines += [
+                    '# TYPE %s counter' % metric,
+                    '%s%s %d' % (metric, _format_labels(self.labels), value)]
+        if errors:
+            lines += ['# TYPE yatamana_errors_total counter']
+            for phase, value in errors.items():
+                lines += ['yatamana_errors_total%s %d' % (
+                    _format_labels(self.labels, phase=phase), value)]
+        return '\n'.join(lines) + '\n'
+
+    def export_prometheus(self, filename):
+        """Write the metrics to a file in the Prometheus text format.
+
+        The file is replaced atomically so that it can be read by the textfile
+        collector of the node exporter at any time.
+
+        Parameters
+        ----------
+        filename : str
+            Output filename, conventionally with the ``.prom`` extension.
+        """
+        _write_atomically(filename, self.to_prometheus())
+
+    def export_json(self, filename):
+        """Write the metrics to a json file.
+
+        Parameters
+        ----------
+        filename : str
+            Output filename.
+        """
+        _write_atomically(filename, json.dumps(self.to_dict(), indent=2))
+
+    def export_profile(self, filename=None):
+        """Dump the collected profile.
+
+        Parameters
+        ----------
+        filename : str, optional
+            Output filename readable by :py:mod:`pstats`. Default: the
+            `profile` given to the constructor.
+        """
+        if self.profiler is None:
+            raise ValueError('Profiling is not enabled.')
+        if filename is None:
+            filename = self.profile
+        makedirs(os.path.dirname(filename))
+        self.profiler.dump_stats(filename)
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels.items()) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+            '%s="%s"' % (name, ('%s' % value).replace('"', '\\"'))
+            for name, value in labels)
+
+
+def _write_atomically(filename, contents):
+    makedirs(os.path.dirname(filename))
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as fw:
+        fw.write(contents)
+    os.rename(tmp, filename)
@@ -0,0 +1,270 @@
+"""
+yatamana.placement_policy
+-------------------------
+
+Choice of the partition (Slurm) or queue (SGE) of every job at submit time.
+
+The state of the candidates is queried in bulk, a single listing of the
+cluster and one of the pending jobs, and cached for a short time. Every job
+goes to the candidate with the most free cores among those whose limits fit
+its resolved `walltime`, `cores`, and `memory`. The cores of placed jobs are
+subtracted from the cached free cores, so that a burst of submissions is
+spread over the candidates.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import logging
+import time
+from collections import OrderedDict
+from .utils import which, decode_output, parse_walltime
+
+
+class PlacementPolicy(object):
+    """Base class of placement policies.
+
+    Parameters
+    ----------
+    run_cmd : callable
+        Function running a command and returning its output, e.g.
+        :py:meth:`.TaskManager.run_cmd`.
+    candidates : list of str or dict, optional
+        Candidates in the order of preference, by name or as dicts with the
+        `name` and optionally the `qos` to use and the limits `max_walltime`,
+        `max_cores` (per node), and `max_memory` (per node in GB) overriding
+        the queried ones. Default: all the queried candidates.
+    cache_ttl : float, optional
+        Seconds the queried state is used for. Default: 30.
+
+    Attributes
+    ----------
+    option : str
+        Task option set to the chosen candidate.
+    """
+
+    option = None
+
+    def __init__(self, run_cmd, candidates=(), cache_ttl=30):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.run_cmd = run_cmd
+        self.candidates = OrderedDict()
+        for candidate in candidates:
+            if not isinstance(candidate, dict):
+                candidate = {'name': candidate}
+            candidate = dict(candidate)
+            if 'max_walltime' in candidate:
+                candidate['max_walltime'] = parse_walltime(
+                        candidate['max_walltime'])
+            self.candidates[candidate.pop('name')] = candidate
+        self.cache_ttl = cache_ttl
+        self.state = None
+        self.queried = None
+
+    def query(self):
+        """Query the limits and free cores of the candidates.
+
+        Returns
+        -------
+        state : OrderedDict
+            Mapping of names to dicts with `max_walltime` in seconds,
+            `max_cores`, `max_memory` in GB (None if unlimited), and
+            `free_cores`.
+        """
+        raise NotImplementedError
+
+    def get_state(self):
+        """Get the cached state of the candidates, query it if too old.
+
+        Returns
+        -------
+        state : OrderedDict
+            See :py:meth:`query`, restricted to the candidates and with their
+            configured limits.
+        """
+        now = time.time()
+        if self.state is not None and now - self.queried < self.cache_ttl:
+            return self.state
+        queried = self.query()
+        if not self.candidates:
+            state = queried
+        else:
+            state = OrderedDict()
+            for name, candidate in self.candidates.items():
+                if name not in queried:
+                    self.log.warning('Unknown %s: %s', self.option, name)
+                    continue
+                state[name] = dict(queried[name])
+                state[name].update(candidate)
+        self.state = state
+        self.queried = now
+        return state
+
+    def fits(self, limits, opts):
+        """Check whether a job fits the limits of a candidate.
+
+        Parameters
+        ----------
+        limits : dict
+            State of the candidate.
+        opts : dict-like
+            Resolved options of the task.
+
+        Returns
+        -------
+        fits : bool
+            True if all the requested resources are within the limits.
+        """
+        for name, limit in (('walltime', 'max_walltime'),
+                            ('cores', 'max_cores'),
+                            ('memory', 'max_memory')):
+            value = opts.get(name)
+            if value is not None and limits.get(limit) is not None and \
+                    value > limits[limit]:
+                return False
+        return True
+
+    def place(self, opts):
+        """Choose the candidate for a job.
+
+        Options of tasks that already specify the :py:attr:`option` are left
+        untouched.
+
+        Parameters
+        ----------
+        opts : dict-like
+            Resolved options of the task, updated in place by the chosen
+            candidate and its `qos`, unless the task specifies it.
+
+        Returns
+        -------
+        name : str | None
+            Chosen candidate, or None if none fits.
+        """
+        if self.option in opts:
+            return opts[self.option]
+        best = None
+        for name, limits in self.get_state().items():
+            if not self.fits(limits, opts):
+                continue
+            if best is None or \
+                    limits['free_cores'] > self.state[best]['free_cores']:
+                best = name
+        if best is None:
+            self.log.warning('No %s fits %s', self.option, dict(opts))
+            return None
+        limits = self.state[best]
+        opts[self.option] = best
+        if limits.get('qos') is not None and 'qos' not in opts:
+            opts['qos'] = limits['qos']
+        limits['free_cores'] -= opts.get('cores', 1) * opts.get('nodes', 1)
+        return best
+
+
+class SlurmPlacementPolicy(PlacementPolicy):
+    """Placement of jobs to Slurm partitions.
+
+    The limits of the partitions are queried by `sinfo`, the free cores are
+    their idle cores minus the cores requested by pending jobs listed by
+    `squeue`.
+
+    Parameters
+    ----------
+    run_cmd : callable
+        See :py:class:`PlacementPolicy`.
+    sinfo_command : str, optional
+        Path to `sinfo`. Default: found on the path.
+    squeue_command : str, optional
+        Path to `squeue`. Default: found on the path.
+    kwargs
+        Arguments of :py:class:`PlacementPolicy`.
+
+    See Also
+    --------
+    PlacementPolicy
+    """
+
+    option = 'partition'
+    sinfo_command = which('sinfo')
+    squeue_command = which('squeue')
+
+    def __init__(self, run_cmd, sinfo_command=None, squeue_command=None,
+                 **kwargs):
+        super(SlurmPlacementPolicy, self).__init__(run_cmd, **kwargs)
+        if sinfo_command is not None:
+            self.sinfo_command = sinfo_command
+        if squeue_command is not None:
+            self.squeue_command = squeue_command
+
+    def query(self):
+        state = OrderedDict()
+        out = self.run_cmd([self.sinfo_command, '-h', '-o', '%R|%l|%c|%m|%C'])
+        for line in decode_output(out).splitlines():
+            fields = line.strip().split('|')
+            if len(fields) != 5:
+                continue
+            name, timelimit, cores, memory, cpus = fields
+            # Partitions are listed once per group of similar nodes.
+            s = state.setdefault(name, {
+                'max_walltime': None if timelimit in ('infinite', 'n/a')
+                else parse_walltime(timelimit),
+                'max_cores': 0, 'max_memory': 0, 'free_cores': 0})
+            s['max_cores'] = max(s['max_cores'], int(cores.rstrip('+')))
+            s['max_memory'] = max(
+                    s['max_memory'], int(memory.rstrip('+')) // 1024)
+            s['free_cores'] += int(cpus.split('/')[1])
+        out = self.run_cmd([
+            self.squeue_command, '-h', '-t', 'PD', '-o', '%P|%C'])
+        for line in decode_output(out).splitlines():
+            fields = line.strip().split('|')
+            if len(fields) != 2:
+                continue
+            # Jobs pending in several partitions count for each of them.
+            for name in fields[0].split(','):
+                if name in state:
+                    state[name]['free_cores'] -= int(fields[1])
+        return state
+
+
+class SgePlacementPolicy(PlacementPolicy):
+    """Placement of jobs to SGE cluster queues.
+
+    The free cores are the available slots of the queues listed by
+    ``qstat -g c``. SGE does not report the limits of the queues in bulk,
+    they have to be configured with the candidates.
+
+    Parameters
+    ----------
+    run_cmd : callable
+        See :py:class:`PlacementPolicy`.
+    qstat_command : str, optional
+        Path to `qstat`. Default: found on the path.
+    kwargs
+        Arguments of :py:class:`PlacementPolicy`.
+
+    See Also
+    --------
+    PlacementPolicy
+    """
+
+    option = 'queue'
+    qstat_command = which('qstat')
+
+    def __init__(self, run_cmd, qstat_command=None, **kwargs):
+        super(SgePlacementPolicy, self).__init__(run_cmd, **kwargs)
+        if qstat_command is not None:
+            self.qstat_command = qstat_command
+
+    def query(self):
+        state = OrderedDict()
+        out = self.run_cmd([self.qstat_command, '-g', 'c'])
+        for line in decode_output(out).splitlines():
+            fields = line.split()
+            # CLUSTER QUEUE, CQLOAD, USED, RES, AVAIL, TOTAL, ...
+            if len(fields) < 6 or not fields[4].isdigit():
+                continue
+            state[fields[0]] = {
+                'max_walltime': None, 'max_cores': None, 'max_memory': None,
+                'free_cores': int(fields[4])}
+        return state
@@ -0,0 +1,270 @@
+"""
+yatamana.plan
+-------------
+
+Submission plans, i.e., jobs prepared by a dry run to be submitted later.
+
+A plan holds the setup of the task manager and, for every job, the mapped
+submission command, the rendered runner and other files the command refers
+to, and the directories of its logs. Dependencies between the jobs are given
+by symbolic IDs, placeholders in the submission commands replaced by the real
+job IDs when the plan is submitted::
+
+    manager = get_task_manager('setup.json', dryrun=True)
+    plan = manager.start_plan()
+    ... enqueue the tasks ...
+    plan.save('plan.json')
+
+and on the login node::
+
+    python -m yatamana submit plan.json
+
+The runners and the submission commands embed the absolute paths of the
+runners and logs as expanded on the host preparing the plan, e.g., ``$USER``
+in `shared_tmp`. They have to be valid on the login node too.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import io
+import json
+import logging
+import os
+import re
+import stat
+from .utils import makedirs
+
+PLACEHOLDER = '{yatamana-job:%d}'
+PLACEHOLDER_RE = re.compile(r'\{yatamana-job:(\d+)\}')
+
+
+class Plan(object):
+    """Jobs prepared but not submitted.
+
+    Parameters
+    ----------
+    setup : dict
+        Setup of the task manager, including its type under ``manager``.
+    jobs : list of dict, optional
+        Planned jobs, see :py:meth:`add`.
+    """
+
+    def __init__(self, setup, jobs=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.setup = setup
+        self.jobs = [] if jobs is None else jobs
+
+    def add(self, enqueue_cmd, files=(), directories=()):
+        """Add a job to the plan.
+
+        Parameters
+        ----------
+        enqueue_cmd : list of str
+            Submission command, referring to the jobs it depends on by their
+            symbolic IDs.
+        files : iterable of str, optional
+            Files needed by the job, e.g. its runner, read into the plan.
+        directories : iterable of str, optional
+            Directories to create before the submission.
+
+        Returns
+        -------
+        job_id : str
+            Symbolic ID of the job.
+        """
+        job = len(self.jobs)
+        dependencies = sorted(set(
+            int(m) for arg in enqueue_cmd
+            for m in PLACEHOLDER_RE.findall(arg)))
+        contents = {}
+        for filename in files:
+            filename = os.path.abspath(filename)
+            with io.open(filename, encoding='utf-8') as fr:
+                contents[filename] = {
+                    'contents': fr.read(),
+                    'executable': os.access(filename, os.X_OK)}
+        self.jobs += [{
+            'id': job,
+            'command': list(enqueue_cmd),
+            'dependencies': dependencies,
+            'files': contents,
+            'directories': sorted(set(
+                os.path.abspath(d) for d in directories if d))}]
+        return PLACEHOLDER % job
+
+    def save(self, filename):
+        """Write the plan to a json file.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the plan.
+        """
+        with open(filename, 'w') as fw:
+            json.dump({'setup': self.setup, 'jobs': self.jobs}, fw)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a plan from a json file.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the plan.
+
+        Returns
+        -------
+        plan : Plan
+            Loaded plan.
+        """
+        with open(filename) as fr:
+            data = json.load(fr)
+        return cls(data['setup'], data['jobs'])
+
+    def write_files(self, job):
+        """Write the files of a job and create its directories.
+
+        Files with the same contents are not rewritten.
+
+        Parameters
+        ----------
+        job : dict
+            Planned job.
+        """
+        for directory in job['directories']:
+            makedirs(directory)
+        for filename, f in job['files'].items():
+            try:
+                with io.open(filename, encoding='utf-8') as fr:
+                    if fr.read() == f['contents']:
+                        continue
+            except (IOError, OSError):
+                pass
+            makedirs(os.path.dirname(filename))
+            with io.open(filename, 'w', encoding='utf-8') as fw:
+                fw.write(f['contents'])
+            if f['executable']:
+                mode = os.stat(filename).st_mode
+                os.chmod(filename, mode | stat.S_IXUSR | stat.S_IXGRP)
+
+    def resolve(self, job, job_ids):
+        """Replace the symbolic IDs in the submission command of a job.
+
+        Parameters
+        ----------
+        job : dict
+            Planned job.
+        job_ids : dict
+            Mapping of symbolic IDs to the IDs of the submitted jobs.
+
+        Returns
+        -------
+        enqueue_cmd : list of str
+            Submission command.
+        """
+        return [PLACEHOLDER_RE.sub(
+            lambda m: str(job_ids[int(m.group(1))]), arg)
+            for arg in job['command']]
+
+    def submit(self, manager, journal=None, batch_size=100):
+        """Submit the jobs of the plan in bulk.
+
+        The jobs whose dependencies are submitted already are submitted in
+        batches through the transport of the manager, see
+        :py:meth:`.ShellTransport.run_many`, unless the submissions are
+        governed, see :py:class:`.SubmissionGovernor`.
+
+        Parameters
+        ----------
+        manager : TaskManager
+            Manager created from the setup of the plan.
+        journal : str, optional
+            File recording the IDs of the submitted jobs. Jobs recorded in it
+            by an earlier, interrupted submission are skipped.
+        batch_size : int, optional
+            Maximum number of submissions in a batch.
+
+        Returns
+        -------
+        job_ids : dict
+            Mapping of symbolic IDs to the IDs of the submitted jobs.
+        """
+        job_ids = {}
+        if journal is not None and os.path.exists(journal):
+            with open(journal) as fr:
+                for line in fr:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        job_ids[int(fields[0])] = int(fields[1])
+            self.log.info('Skipping %d submitted jobs', len(job_ids))
+        fw = None if journal is None else open(journal, 'a')
+        try:
+            batch = []
+            for job in self.jobs:
+                if job['id'] in job_ids:
+                    continue
+                if len(batch) >= batch_size or any(
+                        d not in job_ids for d in job['dependencies']):
+                    self.submit_batch(manager, batch, job_ids, fw)
+                    batch = []
+                batch += [job]
+            self.submit_batch(manager, batch, job_ids, fw)
+        finally:
+            if fw is not None:
+                fw.close()
+        return job_ids
+
+    def submit_batch(self, manager, batch, job_ids, journal=None):
+        """Submit jobs independent of each other.
+
+        Parameters
+        ----------
+        manager : TaskManager
+            Manager created from the setup of the plan.
+        batch : list of dict
+            Planned jobs.
+        job_ids : dict
+            Mapping of symbolic IDs to the IDs of the submitted jobs, updated
+            by the submitted ones.
+        journal : file, optional
+            Open journal, see :py:meth:`submit`.
+        """
+        if not batch:
+            return
+        cmds = []
+        for job in batch:
+            self.write_files(job)
+            cmds += [self.resolve(job, job_ids)]
+
+        def record(job, out):
+            job_ids[job['id']] = manager.get_job_id(out)
+            manager.metrics.increment('jobs_submitted')
+            if journal is not None:
+                journal.write('%d %d\n' % (job['id'], job_ids[job['id']]))
+                journal.flush()
+
+        # Record the other submissions before failing.
+        error = None
+        if manager.governor is None:
+            results = manager.transport.run_many(cmds)
+            for job, cmd, (returncode, out) in zip(batch, cmds, results):
+                if returncode != 0:
+                    error = error or RuntimeError(
+                        'Error running "%s" (%d): %s' % (
+                            ' '.join(cmd), returncode, out))
+                    continue
+                record(job, out)
+        else:
+            # Journal every submission as soon as it succeeded.
+            for job, cmd in zip(batch, cmds):
+                try:
+                    out = manager.submit(cmd)
+                except RuntimeError as e:
+                    error = error or e
+                    continue
+                record(job, out)
+        if error is not None:
+            raise error
+        self.log.info('Submitted %d jobs', len(batch))
@@ -0,0 +1,249 @@
+"""
+yatamana.resource_profiler
+--------------------------
+
+Measurement of resources used by the individual tasks of a job.
+
+The module is run as a script wrapping a command of a task inside a runner::
+
+    python resource_profiler.py STATS KEY CLASS -- COMMAND...
+
+It runs the command and appends a json record with its wall time, CPU time,
+maximum resident set size, and I/O to the file STATS. The script depends only
+on the standard library, so it runs with any python found on the node.
+
+The records of many jobs are read by :py:func:`read_stats` and aggregated
+per task class by :py:func:`summarize_stats`.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def read_io_counters():
+    """Read I/O counters of this process including its waited-for children.
+
+    Returns
+    -------
+    counters : dict
+        Counters from ``/proc/self/io``, empty if not available.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as fr:
+            for line in fr:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def profile_command(cmd):
+    """Run a command and measure the resources it used.
+
+    Parameters
+    ----------
+    cmd : list of str
+        Command to run.
+
+    Returns
+    -------
+    record : dict
+        Exit code, wall time and user and system CPU time in seconds, maximum
+        resident set size in kB, and bytes read and written from storage.
+    """
+    # Not available on every platform, needed only when run as a script.
+    import resource
+    io_before = read_io_counters()
+    start = time.time()
+    returncode = subprocess.call(cmd)
+    wall = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = read_io_counters()
+    record = {
+        'exit_code': returncode,
+        'wall': round(wall, 3),
+        'user': round(usage.ru_utime, 3),
+        'sys': round(usage.ru_stime, 3),
+        'maxrss': usage.ru_maxrss}
+    if io_after:
+        for name in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+            record[name] = io_after.get(name, 0) - io_before.get(name, 0)
+    else:
+        record['read_bytes'] = usage.ru_inblock * 512
+        record['write_bytes'] = usage.ru_oublock * 512
+    return record
+
+
+def main(argv):
+    """Run a command of a task and append its record to a stats file.
+
+    Parameters
+    ----------
+    argv : list of str
+        Stats filename, key and class name of the task, ``--``, and the
+        command.
+
+    Returns
+    -------
+    returncode : int
+        Exit code of the command, 128 + number of the signal if killed.
+    """
+    if len(argv) < 5 or argv[3] != '--':
+        print('Usage: resource_profiler.py STATS KEY CLASS -- COMMAND...',
+              file=sys.stderr)
+        return 2
+    stats, key, clsname = argv[:3]
+    record = profile_command(argv[4:])
+    record.update({'key': key, 'task': clsname, 'host': socket.gethostname()})
+    with open(stats, 'a') as fw:
+        fw.write(json.dumps(
+            record, sort_keys=True, separators=(',', ':')) + '\n')
+    returncode = record['exit_code']
+    if returncode < 0:
+        returncode = 128 - returncode
+    return returncode
+
+
+def get_wrapper_filename():
+    """Get the filename of this module to be run as a script.
+
+    Returns
+    -------
+    filename : str
+        Absolute filename of the source of this module.
+    """
+    return os.path.abspath(os.path.splitext(__file__)[0] + '.py')
+
+
+def render_profiled(command, key, clsname, python='python'):
+    """Render a command measured by this module.
+
+    Parameters
+    ----------
+    command : str
+        Shell command of a task.
+    key : str
+        Key of the task, see :py:meth:`.Task.get_key`.
+    clsname : str
+        Class name of the task.
+    python : str, optional
+        Python interpreter on the nodes.
+
+    Returns
+    -------
+    command : str
+        Wrapped command appending its record to ``$yatamana_stats``.
+    """
+    return '%s %s "$yatamana_stats" %s %s -- "$BASH" -c %s' % (
+            python, quote(get_wrapper_filename()), key, quote(clsname),
+            quote(command))
+
+
+def render_stats_buffering(filename):
+    """Render shell commands buffering records to be appended to a stats file.
+
+    The records of a job are collected in the node-local file
+    ``$yatamana_stats``. The rendered function ``yatamana_flush_stats``
+    appends them to the stats file at once under an exclusive lock on the
+    stats filename with the ``.lock`` suffix.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the stats file.
+
+    Returns
+    -------
+    lines : list of str
+        Lines of the rendered commands.
+    """
+    return [
+        'yatamana_stats=$(mktemp "${TMPDIR:-/tmp}/yatamana-stats.XXXXXX")',
+        'yatamana_flush_stats () {',
+        '\tmkdir -p %s' % quote(os.path.dirname(filename) or '.'),
+        '\t( flock 9; cat "$yatamana_stats" >> %s ) 9>> %s' % (
+            quote(filename), quote(filename + '.lock')),
+        '\trm -f "$yatamana_stats"',
+        '}']
+
+
+def read_stats(filename):
+    """Read records of a stats file.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the stats file.
+
+    Returns
+    -------
+    records : list of dict
+        Records of the profiled tasks, see :py:func:`profile_command`.
+        Truncated records, e.g. of a killed job, are skipped.
+    """
+    records = []
+    with open(filename) as fr:
+        for line in fr:
+            try:
+                records += [json.loads(line)]
+            except ValueError:
+                continue
+    return records
+
+
+def summarize_stats(records):
+    """Aggregate records of profiled tasks per task class.
+
+    Parameters
+    ----------
+    records : iterable of dict
+        Records as returned by :py:func:`read_stats`.
+
+    Returns
+    -------
+    summary : dict
+        For each task class the number of tasks (`count`) and failed tasks
+        (`failed`), the mean and maximum wall time (`wall_mean`,
+        `wall_max`) and CPU time (`cpu_mean`, `cpu_max`) in seconds, the
+        maximum resident set size in kB (`maxrss_max`), and the mean bytes
+        read and written (`read_bytes_mean`, `write_bytes_mean`).
+    """
+    summary = {}
+    for record in records:
+        s = summary.setdefault(record['task'], {
+            'count': 0, 'failed': 0, 'wall_sum': 0., 'wall_max': 0.,
+            'cpu_sum': 0., 'cpu_max': 0., 'maxrss_max': 0,
+            'read_bytes_sum': 0, 'write_bytes_sum': 0})
+        cpu = record.get('user', 0.) + record.get('sys', 0.)
+        s['count'] += 1
+        s['failed'] += int(record.get('exit_code', 0) != 0)
+        s['wall_sum'] += record.get('wall', 0.)
+        s['wall_max'] = max(s['wall_max'], record.get('wall', 0.))
+        s['cpu_sum'] += cpu
+        s['cpu_max'] = max(s['cpu_max'], cpu)
+        s['maxrss_max'] = max(s['maxrss_max'], record.get('maxrss', 0))
+        s['read_bytes_sum'] += record.get('read_bytes', 0)
+        s['write_bytes_sum'] += record.get('write_bytes', 0)
+    for s in summary.values():
+        for name in ('wall', 'cpu', 'read_bytes', 'write_bytes'):
+            s[name + '_mean'] = s.pop(name + '_sum') / s['count']
+    return summary
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
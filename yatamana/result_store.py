@@ -0,0 +1,251 @@
+"""
+yatamana.result_store
+---------------------
+
+Consolidated store of small results of many tasks.
+
+Runners enqueued with the ``results.dir`` option append the results of their
+tasks to a segment file per job in that directory, accompanied by an index
+file (the segment filename with the ``.idx`` suffix) with a line
+``key offset length`` per result, see :py:func:`render_results`.
+The segments are merged into a single sqlite database giving random access to
+the results by the keys of the tasks, instead of one small file per task.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import glob
+import logging
+import os
+import sqlite3
+from .utils import quote
+
+
+class ResultStore(object):
+    """Store of the results of tasks.
+
+    Merging is incremental, the store remembers how much of the index of
+    every segment it has read, so that the segments of running jobs can be
+    merged repeatedly.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the sqlite database, created if it does not exist.
+
+    Examples
+    --------
+    >>> store = ResultStore('results.db')  # doctest: +SKIP
+    >>> store.merge(manager.results_dir)  # doctest: +SKIP
+    >>> print(store.get_result(task))  # doctest: +SKIP
+    """
+
+    def __init__(self, filename):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value BLOB)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS segments ('
+            'name TEXT PRIMARY KEY, index_offset INTEGER)')
+        self.db.commit()
+
+    def close(self):
+        """Close the database.
+        """
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.db.execute(
+            'SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() \
+            is not None
+
+    def __getitem__(self, key):
+        row = self.db.execute(
+            'SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def keys(self):
+        """Get the keys of all the results.
+        """
+        return [row[0] for row in self.db.execute(
+            'SELECT key FROM results ORDER BY key')]
+
+    def get(self, key, default=None):
+        """Read the result of a given key.
+
+        Parameters
+        ----------
+        key : str
+            Key of the task.
+        default : optional
+            Returned if there is no result of the given key.
+
+        Returns
+        -------
+        value : bytes
+            Result as written by the task.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_result(self, task):
+        """Read the result of a given task.
+
+        Parameters
+        ----------
+        task : Task
+            Single task or a task run inside a chunk, see
+            :py:meth:`.Task.get_key`.
+
+        Returns
+        -------
+        value : bytes
+            Result as written by the task.
+
+        Raises
+        ------
+        KeyError
+            If there is no result of the given task.
+        """
+        return self[task.get_key()]
+
+    def merge_segment(self, filename):
+        """Merge the new results of a segment.
+
+        Only complete lines of the index are read, a result being appended
+        by a running job is merged by the next call.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the segment.
+
+        Returns
+        -------
+        count : int
+            Number of merged results.
+        """
+        name = os.path.basename(filename)
+        row = self.db.execute(
+            'SELECT index_offset FROM segments WHERE name = ?',
+            (name,)).fetchone()
+        index_offset = 0 if row is None else row[0]
+        with open(filename + '.idx', 'rb') as fr:
+            fr.seek(index_offset)
+            lines = fr.read().split(b'\n')
+        # The last item is empty or an incomplete line.
+        lines = lines[:-1]
+        if not lines:
+            return 0
+        index_offset += sum(len(line) + 1 for line in lines)
+        count = 0
+        with open(filename, 'rb') as fr:
+            for line in lines:
+                fields = line.decode('utf-8').split()
+                if len(fields) != 3:
+                    continue
+                key, offset, length = fields[0], int(fields[1]), int(fields[2])
+                fr.seek(offset)
+                value = fr.read(length)
+                if len(value) != length:
+                    self.log.warning('Truncated result %s in %s', key,
+                                     filename)
+                    continue
+                self.db.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?)',
+                    (key, sqlite3.Binary(value)))
+                count += 1
+        self.db.execute(
+            'INSERT OR REPLACE INTO segments VALUES (?, ?)',
+            (name, index_offset))
+        self.db.commit()
+        return count
+
+    def merge(self, results_dir, remove=False):
+        """Merge the new results of all the segments in a directory.
+
+        Parameters
+        ----------
+        results_dir : str
+            Directory of the segments, see ``results.dir``.
+        remove : bool, optional
+            Remove the segments after merging them. Only safe once their jobs
+            finished.
+
+        Returns
+        -------
+        count : int
+            Number of merged results.
+        """
+        count = 0
+        for index in sorted(glob.glob(os.path.join(results_dir, '*.seg.idx'))):
+            filename = index[:-len('.idx')]
+            count += self.merge_segment(filename)
+            if remove:
+                os.remove(filename)
+                os.remove(index)
+                self.db.execute('DELETE FROM segments WHERE name = ?',
+                                (os.path.basename(filename),))
+                self.db.commit()
+        self.log.info('Merged %d results', count)
+        return count
+
+
+def render_results(filename, key=None):
+    """Render commands collecting the results of tasks.
+
+    A task writes its result, e.g. a few kB of json, into the node-local file
+    ``$yatamana_result``. The function ``yatamana_commit_result`` appends it
+    to the segment and adds a line ``key offset length`` to the index of the
+    segment, see :py:class:`ResultStore`. It is called with the key of a
+    single task when the job succeeds, and after every successful task of a
+    :py:class:`.ChunkOfTasksTask`.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the segment of the job.
+    key : str, optional
+        Key of the single task run by the job. Default: None, a chunk of
+        tasks commits the results itself.
+
+    Returns
+    -------
+    start : list of str
+        Commands defining ``$yatamana_result`` and the function.
+    stop : list of str
+        Commands run at exit with the exit code in ``$rv``.
+    """
+    start = [
+        'yatamana_result=$(mktemp '
+        '"${TMPDIR:-/tmp}/yatamana-result.XXXXXX")',
+        'export yatamana_result',
+        'yatamana_commit_result () {',
+        '\tlocal size offset',
+        '\tsize=$(stat -c %s "$yatamana_result")',
+        '\tif [ "$size" -gt 0 ]; then',
+        '\t\tmkdir -p %s' % quote(os.path.dirname(filename) or '.'),
+        '\t\toffset=$(stat -c %%s %s 2>/dev/null || echo 0)' % (
+            quote(filename)),
+        '\t\tcat "$yatamana_result" >> %s && \\' % quote(filename),
+        '\t\t\techo "$1 $offset $size" >> %s' % quote(filename + '.idx'),
+        '\tfi',
+        '\t: > "$yatamana_result"',
+        '}']
+    stop = []
+    if key is not None:
+        stop += ['[ $rv -ne 0 ] || yatamana_commit_result %s' % key]
+    stop += ['rm -f "$yatamana_result"']
+    return start, stop
@@ -0,0 +1,232 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import hashlib
+import os
+import re
+from .utils import quote
+
+
+def render_make_scratch(scratch_dir):
+    """Render a command creating the scratch directory ``$yatamana_scratch``.
+
+    Parameters
+    ----------
+    scratch_dir : str
+        Node-local directory to create the scratch directory in, may refer to
+        environment variables of the job.
+
+    Returns
+    -------
+    command : str
+        Rendered command.
+    """
+    return 'yatamana_scratch=$(mktemp -d "%s/yatamana-scratch.XXXXXX")' % (
+            scratch_dir)
+
+
+class ScratchStagingMixin(object):
+    """Mixin running the command of a task on node-local copies of its files.
+
+    The runner copies the inputs into a scratch directory on the node-local
+    disk before the command runs and copies the outputs back after it
+    succeeds. The outputs are first copied next to their destinations and
+    then renamed, so that the destinations are either complete or untouched.
+    The command sees the local paths: every occurrence of an input or output
+    filename as a separate word (or after ``=``) in the rendered command is
+    replaced.
+
+    Inside a :py:class:`.ChunkOfTasksTask`, the tasks share one scratch
+    directory and every input is copied only once per job.
+
+    If ``$yatamana_claims`` is set, e.g. for speculative copies of a job, see
+    :py:class:`.Speculator`, only the first copy to finish claims the commit
+    of the outputs, the others discard theirs. They wait until the claiming
+    copy committed, and claim the commit themselves if it failed. A claim not
+    committed within `claim_wait` seconds is removed as stale and the waiting
+    copy fails.
+
+    The task has to specify the following attributes:
+
+    - `inputs` - list of input filenames,
+    - `outputs` - list of output filenames.
+
+    When combined with :py:class:`.UpToDateFinishedMixin`, put that one first
+    so that the stamp is written only after the outputs are copied back.
+
+    Attributes
+    ----------
+    scratch_dir : str
+        Node-local directory the scratch directories are created in. Default:
+        ``${TMPDIR:-/tmp}``.
+    claim_wait : int
+        Seconds to wait for the commit of another copy. Default: 600.
+    """
+
+    __slots__ = ()
+    scratch_dir = '${TMPDIR:-/tmp}'
+    claim_wait = 600
+
+    def get_local_filename(self, filename, kind):
+        """Get the path of a file inside the scratch directory.
+
+        Parameters
+        ----------
+        filename : str
+            Filename on the shared file system.
+        kind : str
+            Either 'in' or 'out'.
+
+        Returns
+        -------
+        local : str
+            Shell word expanding to the local path.
+        """
+        return '"$yatamana_scratch"' + quote(
+                '/%s%s' % (kind, os.path.abspath(filename)))
+
+    def localize(self, command):
+        """Replace the filenames of inputs and outputs by local paths.
+
+        Parameters
+        ----------
+        command : str
+            Rendered command.
+
+        Returns
+        -------
+        command : str
+            Command using the local paths.
+        """
+        replacements = {}
+        for filename in self.inputs:
+            replacements[filename] = self.get_local_filename(filename, 'in')
+        for filename in self.outputs:
+            replacements[filename] = self.get_local_filename(filename, 'out')
+        if not replacements:
+            return command
+        # Longer filenames first so that a prefix does not win.
+        pattern = re.compile(r'(?<![^\s=])(%s)(?![^\s;&|)])' % '|'.join(
+            re.escape(f) for f in sorted(replacements, key=len, reverse=True)))
+        return pattern.sub(lambda m: replacements[m.group(1)], command)
+
+    def render_stage_in(self):
+        """Render commands copying the inputs into the scratch directory.
+
+        Inputs already copied, e.g. by another task of the same chunk, are
+        skipped.
+
+        Returns
+        -------
+        lines : list of str
+            Commands, each succeeding only if the input is in place.
+        """
+        lines = []
+        for filename in self.inputs:
+            local = self.get_local_filename(filename, 'in')
+            lines += [
+                '{ [ -e %s ] || { mkdir -p "$(dirname %s)" && '
+                'cp -p %s %s.part && mv %s.part %s; }; }' % (
+                    local, local, quote(filename), local, local, local)]
+        for filename in self.outputs:
+            local = self.get_local_filename(filename, 'out')
+            lines += ['mkdir -p "$(dirname %s)"' % local]
+        return lines
+
+    def render_stage_out(self):
+        """Render commands copying the outputs back.
+
+        All the outputs are copied next to their destinations first, then
+        they are renamed.
+
+        Returns
+        -------
+        lines : list of str
+            Commands, each succeeding only if the output is in place.
+        """
+        copy = []
+        rename = []
+        for filename in self.outputs:
+            local = self.get_local_filename(filename, 'out')
+            part = quote(filename + '.yatamana-part') + '.$$'
+            copy += [
+                'mkdir -p %s' % quote(os.path.dirname(filename) or '.'),
+                'cp -p %s %s' % (local, part)]
+            rename += ['mv %s %s' % (part, quote(filename))]
+        return copy + rename
+
+    def render_commit(self):
+        """Render commands claiming the commit and copying the outputs back.
+
+        The claim is a directory named by a digest of the output filenames,
+        it contains a file ``done`` once the outputs are committed.
+
+        Returns
+        -------
+        command : str
+            Command succeeding if the outputs are in place.
+        """
+        stage_out = self.render_stage_out()
+        if not stage_out:
+            return 'true'
+        sha1 = hashlib.sha1('\n'.join(
+            os.path.abspath(f) for f in self.outputs).encode('utf-8'))
+        claim = '"$yatamana_claims"/%s' % sha1.hexdigest()[:20]
+        return '\n'.join([
+            '{ yatamana_commit_rv=',
+            'yatamana_waited=0',
+            'while [ -z "$yatamana_commit_rv" ]; do',
+            'if [ -z "$yatamana_claims" ] || mkdir %s 2>/dev/null; then' % (
+                claim),
+            ' && \\\n'.join(stage_out + [
+                '{ [ -z "$yatamana_claims" ] || touch %s/done; }' % claim]),
+            '\tyatamana_commit_rv=$?',
+            '\t[ $yatamana_commit_rv -eq 0 ] || rmdir %s 2>/dev/null' % claim,
+            'elif [ -e %s/done ]; then' % claim,
+            '\techo "Outputs committed by another copy" >&2',
+            '\tyatamana_commit_rv=0',
+            'elif [ $yatamana_waited -ge %d ]; then' % self.claim_wait,
+            '\techo "Removing a stale claim of another copy" >&2',
+            '\trm -rf %s' % claim,
+            '\tyatamana_commit_rv=1',
+            'else',
+            # The claiming copy is still committing.
+            '\tsleep 1',
+            '\tyatamana_waited=$((yatamana_waited + 1))',
+            'fi',
+            'done',
+            '(exit $yatamana_commit_rv); }'])
+
+    def render_command(self):
+        """Render the command wrapped by staging of its files.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        command = self.localize(
+                super(ScratchStagingMixin, self).render_command())
+        stage = self.render_stage_in() + [
+            '{ %s\n}' % command, self.render_commit()]
+        outputs = ' '.join(
+                self.get_local_filename(f, 'out') for f in self.outputs)
+        lines = [
+            '{',
+            'yatamana_own_scratch=',
+            'if [ -z "$yatamana_scratch" ]; then',
+            '\t' + render_make_scratch(self.scratch_dir),
+            '\tyatamana_own_scratch=$yatamana_scratch',
+            'fi',
+            ' && \\\n'.join(stage),
+            'yatamana_stage_rv=$?']
+        if outputs:
+            lines += ['rm -f %s' % outputs]
+        lines += [
+            'if [ -n "$yatamana_own_scratch" ]; then',
+            '\trm -rf "$yatamana_own_scratch"',
+            '\tyatamana_scratch=',
+            'fi',
+            '(exit $yatamana_stage_rv)',
+            '}']
+        return '\n'.join(lines)
@@ -0,0 +1,130 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+from collections import OrderedDict
+from .task import Task
+from .utils import quote, render_export_functions
+
+
+class SegmentOfTaskTask(Task):
+    """Task running a segment of a long checkpointing task.
+
+    The segment runs the command of the task, or its resume command if the
+    checkpoint exists, see :py:class:`.CheckpointingMixin`, for at most
+    `limit` seconds. Then the command gets SIGTERM to write its checkpoint and
+    SIGKILL `kill_after` seconds later. A segment running out of time
+    succeeds, so that the next one is started, except for the last one of the
+    chain. A command killed before the limit, e.g., out of memory, fails the
+    segment. A segment of a task finished by an earlier one does nothing. The
+    command is run by a new ``bash`` inheriting the shell functions of the
+    runner, but only its exported variables.
+
+    The segment takes the options and defaults of the task except for its
+    walltime, the segments of a chain are created by
+    :py:meth:`.TaskManager.enqueue_segmented`.
+
+    Parameters
+    ----------
+    task : CheckpointingMixin
+        Task to run.
+    index : int
+        Index of the segment in the chain.
+    count : int
+        Number of segments of the chain.
+    walltime : int
+        Walltime of the segment in seconds.
+    limit : int
+        Seconds after which the command is stopped.
+    kill_after : int
+        Seconds between SIGTERM and SIGKILL.
+    """
+
+    __slots__ = ('task', 'index', 'count', 'walltime', 'limit', 'kill_after')
+
+    def __init__(self, task, index, count, walltime, limit, kill_after):
+        super(SegmentOfTaskTask, self).__init__()
+        self.task = task
+        self.index = index
+        self.count = count
+        self.walltime = walltime
+        self.limit = limit
+        self.kill_after = kill_after
+        self.opts = OrderedDict(task.opts)
+        self.defaults = task.defaults
+
+    def update_defaults(self, defaults):
+        """Keep the defaults of the task.
+
+        Parameters
+        ----------
+        defaults : dict
+            Ignored.
+        """
+
+    def resolve_opts(self, values, update_self=True):
+        """Resolve the options of the task with the walltime of the segment.
+
+        Parameters
+        ----------
+        values : dict-like
+            Values to use for format string resolution.
+        update_self : bool
+            Whether or not to update `self.opts`.
+
+        Returns
+        -------
+        resolved : dict-like
+            Resolved options.
+        """
+        resolved = super(SegmentOfTaskTask, self).resolve_opts(
+                values, update_self=update_self)
+        resolved['walltime'] = self.walltime
+        return resolved
+
+    def get_runner_prefix(self):
+        """Return a prefix for the runner file.
+        """
+        return '%s-%d' % (self.task.get_runner_prefix(), self.index)
+
+    def render_command(self):
+        """Render the command of the task limited to the segment.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        timeout = 'timeout -k %d %d "$BASH" -c' % (
+                self.kill_after, self.limit)
+        checkpoint = quote(self.task.checkpoint)
+        done = quote(self.task.get_done_filename())
+        lines = render_export_functions() + [
+            'if [ -e %s ]; then' % done,
+            '\techo "Finished by an earlier segment" >&2',
+            'else',
+            '\tyatamana_segment_start=$SECONDS',
+            '\tif [ -e %s ]; then' % checkpoint,
+            '\t\t%s %s' % (timeout, quote(self.task.render_resume_command())),
+            '\telse',
+            '\t\t%s %s' % (timeout, quote(self.task.render_command())),
+            '\tfi',
+            '\tyatamana_segment_rv=$?',
+            # Exit codes of timeout after SIGTERM, and after SIGKILL unless
+            # the command was killed before, e.g., out of memory.
+            '\tif [ $yatamana_segment_rv -eq 124 ] || '
+            '{ [ $yatamana_segment_rv -eq 137 ] && '
+            '[ $((SECONDS - yatamana_segment_start)) -ge %d ]; }; then' % (
+                self.limit)]
+        if self.index + 1 < self.count:
+            lines += [
+                '\t\techo "Segment %d of %d out of time, resuming in the next '
+                'one" >&2' % (self.index + 1, self.count),
+                '\t\tyatamana_segment_rv=0']
+        else:
+            lines += [
+                '\t\techo "Not finished by the last of %d segments" >&2' % (
+                    self.count)]
+        lines += [
+            '\tfi',
+            '\t(exit $yatamana_segment_rv)',
+            'fi']
+        return '\n'.join(lines)
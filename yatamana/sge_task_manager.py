@@ -1,10 +1,13 @@
 from __future__ import (
         print_function, division, absolute_import, unicode_literals)
 
+import getpass
 import logging
 from collections import OrderedDict
-from .utils import which
+from xml.etree import ElementTree
+from .utils import which, decode_output
 from .task_manager import TaskManager
+from .placement_policy import SgePlacementPolicy
 
 
 class SgeTaskManager(TaskManager):
@@ -18,6 +21,8 @@ class SgeTaskManager(TaskManager):
     default_submit_command : str
         Full path to the binary that submits to the cluster. Set to the path to
         `qsub`.
+    transient_errors : tuple of str
+        Errors of `qsub` caused by an overloaded or unreachable qmaster.
 
     Parameters
     ----------
@@ -32,6 +37,18 @@ class SgeTaskManager(TaskManager):
     """
 
     default_submit_command = which('qsub')
+    transient_errors = (
+            'unable to contact qmaster',
+            'failed receiving gdi request',
+            'commlib error',
+            'qmaster is not alive')
+    job_id_variable = 'JOB_ID'
+    status_command = which('qstat')
+    cancel_command = which('qdel')
+    hold_command = which('qhold')
+    release_command = which('qrls')
+    renice_command = which('qalter')
+    placement_class = SgePlacementPolicy
 
     def __init__(self, setup_file, **kwargs):
         super(SgeTaskManager, self).__init__(setup_file, **kwargs)
@@ -63,6 +80,13 @@ class SgeTaskManager(TaskManager):
                 mapped[name] = ['-N', value]
             elif name == 'cores':
                 mapped[name] = ['-pe', 'smp', str(value)]
+            elif name == 'queue':
+                mapped[name] = ['-q', value]
+            elif name == 'nice':
+                # Users can only lower the priority down to -1023.
+                mapped[name] = ['-p', '%d' % -min(value, 1023)]
+            elif name == 'exclude_hosts':
+                mapped[name] = ['-l', 'h=!(%s)' % '|'.join(value)]
             elif name == 'dependencies':
                 mapped[name] = ['-hold_jid', ','.join(
                     [str(job_id) for job_id in value])]
@@ -85,4 +109,67 @@ class SgeTaskManager(TaskManager):
         job_id : int
             Extracted job ID.
         """
-        return int(output.split(' ')[2])
+        return int(decode_output(output).split(' ')[2])
+
+    def get_job_states(self):
+        """Get states of all the jobs of the user in the queue.
+
+        Returns
+        -------
+        states : dict
+            Mapping of job IDs to one of 'pending', 'running', 'held', 'error',
+            or 'other'.
+        """
+        out = self.run_cmd([self.status_command, '-u', getpass.getuser()])
+        states = {}
+        lines = decode_output(out).splitlines()
+        # Skip the header up to the line of dashes.
+        for line in lines[2:]:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            state = fields[4]
+            if 'E' in state:
+                state = 'error'
+            elif 'h' in state:
+                state = 'held'
+            elif 'r' in state or 't' in state:
+                state = 'running'
+            elif 'qw' in state:
+                state = 'pending'
+            else:
+                state = 'other'
+            states[int(fields[0])] = state
+        return states
+
+    def get_job_names(self):
+        """Get names of all the jobs of the user in the queue.
+
+        The names are read from the xml output of `qstat`, the plain one
+        truncates them.
+
+        Returns
+        -------
+        names : dict
+            Mapping of job IDs to job names.
+        """
+        out = self.run_cmd([
+            self.status_command, '-u', getpass.getuser(), '-xml'])
+        names = {}
+        for job in ElementTree.fromstring(out).iter('job_list'):
+            job_id = job.findtext('JB_job_number')
+            if job_id is not None:
+                names[int(job_id)] = job.findtext('JB_name', '')
+        return names
+
+    def render_control_cmd(self, action, job_ids, value=None):
+        """Render a command controlling jobs.
+
+        See :py:meth:`.TaskManager.render_control_cmd`.
+        """
+        if action == 'renice':
+            # Users can only lower the priority down to -1023.
+            return [self.renice_command, '-p', '%d' % -min(value, 1023)] + \
+                job_ids
+        return super(SgeTaskManager, self).render_control_cmd(
+                action, job_ids, value)
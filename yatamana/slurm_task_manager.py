@@ -1,11 +1,15 @@
 from __future__ import (
         print_function, division, absolute_import, unicode_literals)
 
+import getpass
 import logging
+import os
 from math import ceil
 from collections import OrderedDict
-from .utils import which
+from .utils import which, decode_output
 from .task_manager import TaskManager
+from .placement_policy import SlurmPlacementPolicy
+from .allocation_of_tasks_task import AllocationOfTasksTask
 
 
 def format_time(seconds):
@@ -36,6 +40,28 @@ class SlurmTaskManager(TaskManager):
     """
 
     default_submit_command = which('sbatch')
+    transient_errors = (
+            'Resource temporarily unavailable',
+            'Unable to contact slurm controller',
+            'temporarily unable to accept job')
+    # The controller may have accepted the job before the reply was lost.
+    ambiguous_errors = (
+            'Socket timed out',
+            'Zero Bytes were transmitted or received')
+    job_id_variable = 'SLURM_JOB_ID'
+    status_command = which('squeue')
+    cancel_command = which('scancel')
+    hold_command = which('scontrol')
+    release_command = which('scontrol')
+    renice_command = which('scontrol')
+    placement_class = SlurmPlacementPolicy
+    job_states = {
+            'PD': 'pending',
+            'CF': 'pending',
+            'R': 'running',
+            'CG': 'running',
+            'S': 'held',
+            'ST': 'held'}
 
     def __init__(self, setup_file, **kwargs):
         super(SlurmTaskManager, self).__init__(setup_file, **kwargs)
@@ -69,10 +95,18 @@ class SlurmTaskManager(TaskManager):
                 mapped[name] = ['-t', format_time(value)]
             elif name == 'qos':
                 mapped[name] = ['--qos=' + value]
+            elif name == 'partition':
+                mapped[name] = ['-p', value]
             elif name == 'cores':
                 mapped[name] = ['-c', str(value), '-N', '1-1']
+            elif name == 'nodes':
+                mapped[name] = ['-N', str(value), '--exclusive', '--mem=0']
             elif name == 'memory':
                 mapped[name] = ['--mem=%dG' % value]
+            elif name == 'nice':
+                mapped[name] = ['--nice=%d' % value]
+            elif name == 'exclude_hosts':
+                mapped[name] = ['--exclude=' + ','.join(value)]
             elif name == 'dependencies':
                 mapped[name] = ['-d', ':'.join(
                     ['afterok'] + [str(job_id) for job_id in value])]
@@ -82,6 +116,32 @@ class SlurmTaskManager(TaskManager):
                 log.error('Cannot map option: %s', name)
         return mapped
 
+    def enqueue_packed(self, tasks, n=None, max_in_flight=None):
+        """Enqueue tasks packed into multi-node allocations.
+
+        Each allocation runs its tasks as parallel job steps, see
+        :py:class:`.AllocationOfTasksTask`.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Tasks.
+        n : int, optional
+            Number of tasks per allocation. Default:
+            ``chunk_size.clsname_of_the_task`` from the defaults of
+            AllocationOfTasksTask, or 5.
+        max_in_flight : int, optional
+            See :py:meth:`.enqueue_chunked`.
+
+        Returns
+        -------
+        enqueued : iterator of AllocationOfTasksTask
+            Enqueued allocations.
+        """
+        return self.enqueue_chunked(
+                tasks, n=n, max_in_flight=max_in_flight,
+                wrapper=AllocationOfTasksTask)
+
     def get_job_id(self, output):
         """Get job ID from the submission ouput.
 
@@ -95,4 +155,85 @@ class SlurmTaskManager(TaskManager):
         job_id : int
             Extracted job ID.
         """
-        return int(output.split(' ')[3])
+        return int(decode_output(output).split(' ')[3])
+
+    def find_submission(self, cmd):
+        """Find a job submitted by a command that failed ambiguously.
+
+        The job is looked up in the queue by its runner script, whose
+        filename is unique. A job that already left the queue is not found.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Submission command ending with the runner.
+
+        Returns
+        -------
+        out : str
+            Output sbatch would have printed, or None if the job is not in the
+            queue.
+        """
+        runner = os.path.basename(cmd[-1])
+        out = self.run_cmd([
+            self.status_command, '-h', '-u', getpass.getuser(),
+            '-o', '%A %o'])
+        for line in decode_output(out).splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2 and \
+                    os.path.basename(fields[1].strip()) == runner:
+                return 'Submitted batch job %s' % fields[0]
+        return None
+
+    def get_job_states(self):
+        """Get states of all the jobs of the user in the queue.
+
+        Returns
+        -------
+        states : dict
+            Mapping of job IDs to one of 'pending', 'running', 'held', or
+            'other'.
+        """
+        out = self.run_cmd([
+            self.status_command, '-h', '-u', getpass.getuser(),
+            '-o', '%A %t'])
+        states = {}
+        for line in decode_output(out).splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                states[int(fields[0])] = self.job_states.get(
+                        fields[1], 'other')
+        return states
+
+    def get_job_names(self):
+        """Get names of all the jobs of the user in the queue.
+
+        Returns
+        -------
+        names : dict
+            Mapping of job IDs to job names.
+        """
+        out = self.run_cmd([
+            self.status_command, '-h', '-u', getpass.getuser(),
+            '-o', '%A %j'])
+        names = {}
+        for line in decode_output(out).splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                names[int(fields[0])] = fields[1].strip()
+        return names
+
+    def render_control_cmd(self, action, job_ids, value=None):
+        """Render a command controlling jobs.
+
+        Holding, releasing, and changing the nice value are done by
+        `scontrol` with a comma-separated list of job IDs. See
+        :py:meth:`.TaskManager.render_control_cmd`.
+        """
+        if action == 'cancel':
+            return [self.cancel_command] + job_ids
+        command = getattr(self, action + '_command')
+        if action == 'renice':
+            return [command, 'update', 'JobId=%s' % ','.join(job_ids),
+                    'Nice=%d' % value]
+        return [command, action, ','.join(job_ids)]
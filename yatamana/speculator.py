@@ -0,0 +1,277 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from .scratch_staging_mixin import ScratchStagingMixin
+from .utils import quote
+
+
+def is_speculative(task):
+    """Check whether copies of a task can run at the same time.
+
+    Parameters
+    ----------
+    task : Task
+        Single task or a chunk of tasks.
+
+    Returns
+    -------
+    speculative : bool
+        True if every task commits its outputs atomically, see
+        :py:class:`.ScratchStagingMixin`.
+    """
+    tasks = getattr(task, 'tasks', None) or [task]
+    return all(isinstance(t, ScratchStagingMixin) for t in tasks)
+
+
+def render_claims(runner_name):
+    """Render commands setting up the claims of the commits of outputs.
+
+    A task claims the commit of its outputs by creating a directory named by
+    a digest of their filenames in ``$yatamana_claims``. Only the first of
+    the copies of a job succeeds, the others discard their outputs, see
+    :py:class:`.ScratchStagingMixin`.
+
+    Parameters
+    ----------
+    runner_name : str
+        Filename of the runner script of the original job.
+
+    Returns
+    -------
+    lines : list of str
+        Commands exporting ``$yatamana_claims``.
+    """
+    claims = os.path.splitext(runner_name)[0] + '.claims'
+    return [
+        'yatamana_claims=%s' % quote(os.path.abspath(claims)),
+        'mkdir -p "$yatamana_claims"',
+        'export yatamana_claims']
+
+
+class Speculator(object):
+    """Run copies of straggling jobs at the tail of a batch of tasks.
+
+    Once the fraction `after` of the tasks of a batch finished, a running job
+    whose runtime exceeds `factor` times the `quantile` of the runtimes of the
+    finished tasks of the same class gets a copy, at most `max_copies` of
+    them. The copy avoids the hosts of the running ones as known from their
+    heartbeats, see :py:func:`.watchdog.render_heartbeat`. The first
+    copy to succeed wins, the others are cancelled.
+
+    Only tasks that commit their outputs atomically are copied, see
+    :py:func:`is_speculative`. Their commits are claimed, so that a late
+    copy never overwrites the outputs of the winner, see
+    :py:func:`render_claims`. The claims are set up by runners
+    enqueued with the ``speculation`` section in the setup, from which the
+    defaults of the parameters are taken::
+
+        "speculation": {
+          "after": 0.9,
+          "quantile": 0.9,
+          "factor": 1.5,
+          "min_samples": 5,
+          "max_copies": 1,
+          "interval": 60
+        }
+
+    Requires ``completion.sentinel_dir``. Tasks enqueued by
+    :py:meth:`.CondorTaskManager.enqueue_dag` share the job of DAGMan and
+    cannot be copied.
+
+    Parameters
+    ----------
+    manager : TaskManager
+        Manager that enqueued the tasks.
+    after : float, optional
+        Fraction of the tasks that has to finish first. Default: 0.9.
+    quantile : float, optional
+        Quantile of the runtimes of the finished tasks. Default: 0.9.
+    factor : float, optional
+        Multiple of the quantile a job has to run to get a copy. Default: 1.5.
+    min_samples : int, optional
+        Minimum number of finished tasks of a class. Default: 5.
+    max_copies : int, optional
+        Maximum number of copies of a task. Default: 1.
+    interval : float, optional
+        Seconds between queries of the queue. Default: 60.
+    """
+
+    def __init__(self, manager, after=None, quantile=None, factor=None,
+                 min_samples=None, max_copies=None, interval=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if 'speculation' not in manager.kwargs:
+            raise ValueError(
+                'Missing speculation section, runners do not claim commits')
+        setup = manager.kwargs['speculation']
+        self.manager = manager
+        self.after = after if after is not None \
+            else setup.get('after', 0.9)
+        self.quantile = quantile if quantile is not None \
+            else setup.get('quantile', 0.9)
+        self.factor = factor if factor is not None \
+            else setup.get('factor', 1.5)
+        self.min_samples = min_samples if min_samples is not None \
+            else setup.get('min_samples', 5)
+        self.max_copies = max_copies if max_copies is not None \
+            else setup.get('max_copies', 1)
+        self.interval = interval if interval is not None \
+            else setup.get('interval', 60)
+        self.runtimes = {}
+        self.running_since = {}
+
+    def get_threshold(self, clsname):
+        """Get the runtime after which a job of a class gets a copy.
+
+        Parameters
+        ----------
+        clsname : str
+            Class name of the task.
+
+        Returns
+        -------
+        threshold : float | None
+            Seconds, or None if too few tasks of the class finished.
+        """
+        runtimes = sorted(self.runtimes.get(clsname, []))
+        if not runtimes or len(runtimes) < self.min_samples:
+            return None
+        return self.factor * runtimes[int(self.quantile * (len(runtimes) - 1))]
+
+    def get_host(self, job):
+        """Get the host a job runs on from its heartbeat.
+
+        Parameters
+        ----------
+        job : Task
+            Enqueued task or its copy.
+
+        Returns
+        -------
+        host : str | None
+            Hostname, or None if unknown.
+        """
+        if self.manager.heartbeat_dir is None:
+            return None
+        try:
+            with open(self.manager.get_heartbeat_filename(
+                    job.runner_name)) as fr:
+                return json.load(fr).get('host') or None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def speculate(self, jobs, n_finished, n_total):
+        """Enqueue copies of straggling jobs.
+
+        Parameters
+        ----------
+        jobs : dict
+            Running jobs (the task and its copies) of unfinished tasks.
+        n_finished : int
+            Number of finished tasks.
+        n_total : int
+            Number of all tasks.
+
+        Returns
+        -------
+        copies : list of tuple
+            Tasks with their enqueued copies.
+        """
+        states = self.manager.get_task_states(
+                [job for attempts in jobs.values() for job in attempts])
+        now = time.time()
+        for attempts in jobs.values():
+            for job in attempts:
+                if states.get(job) == 'running':
+                    self.running_since.setdefault(job, now)
+        if n_finished < self.after * n_total:
+            return []
+        copies = []
+        for task, attempts in jobs.items():
+            if len(attempts) > self.max_copies or not is_speculative(task):
+                continue
+            threshold = self.get_threshold(task.__class__.__name__)
+            since = self.running_since.get(attempts[-1])
+            if threshold is None or since is None or \
+                    now - since <= threshold:
+                continue
+            hosts = [self.get_host(job) for job in attempts]
+            self.log.info('%s runs for %ds, enqueueing a copy', task,
+                          now - since)
+            duplicate = self.manager.enqueue_copy(
+                    task, exclude_hosts=[h for h in hosts if h is not None])
+            attempts += [duplicate]
+            copies += [(task, duplicate)]
+        return copies
+
+    def run(self, tasks, timeout=None, watcher=None):
+        """Iterate over enqueued tasks as their first copies finish.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks.
+        timeout : float, optional
+            Maximum number of seconds to wait in total. Default: no limit.
+        watcher : CompletionWatcher, optional
+            Watcher to use. Default: create one by
+            :py:meth:`.TaskManager.watch_completions`.
+
+        Returns
+        -------
+        finished : iterator of (Task, dict)
+            Finished tasks with the records of the sentinels of the winning
+            copies, see :py:meth:`.TaskManager.wait_for_tasks`. A task fails
+            only if all its copies fail.
+        """
+        tasks = list(tasks)
+        jobs = OrderedDict((task, [task]) for task in tasks)
+        by_name = dict(
+                (os.path.splitext(os.path.basename(t.runner_name))[0], (t, t))
+                for t in tasks)
+        own_watcher = watcher is None
+        if own_watcher:
+            watcher = self.manager.watch_completions()
+        deadline = None if timeout is None else time.time() + timeout
+        next_check = time.time()
+        try:
+            while jobs:
+                now = time.time()
+                if now >= next_check:
+                    for task, duplicate in self.speculate(
+                            jobs, len(tasks) - len(jobs), len(tasks)):
+                        name = os.path.splitext(
+                                os.path.basename(duplicate.runner_name))[0]
+                        by_name[name] = (task, duplicate)
+                    next_check = now + self.interval
+                wait = next_check - time.time()
+                if deadline is not None:
+                    wait = max(0, min(wait, deadline - time.time()))
+                for record in watcher.poll(max(0, wait)):
+                    task, job = by_name.pop(record['name'], (None, None))
+                    if task not in jobs:
+                        continue
+                    attempts = jobs[task]
+                    attempts.remove(job)
+                    self.running_since.pop(job, None)
+                    if record['exit_code'] != 0 and attempts:
+                        continue
+                    del jobs[task]
+                    if record['exit_code'] == 0:
+                        self.runtimes.setdefault(
+                            task.__class__.__name__, []).append(
+                            record['end'] - record['start'])
+                    if attempts:
+                        self.manager.control('cancel', attempts)
+                        for a in attempts:
+                            self.running_since.pop(a, None)
+                    yield task, record
+                if deadline is not None and time.time() >= deadline:
+                    break
+        finally:
+            if own_watcher:
+                watcher.close()
@@ -0,0 +1,239 @@
+"""
+yatamana.submission_governor
+----------------------------
+
+Rate limiting and retrying of submissions.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import logging
+import random
+import re
+import threading
+import time
+
+
+class SubmissionGovernor(object):
+    """Govern the rate of submissions to a cluster.
+
+    Submissions are rate limited by a token bucket. Submissions failing with a
+    transient error of the submitter (e.g., a timeout of the controller) are
+    retried after a jittered exponential backoff. The rate adapts to the
+    observed behaviour of the submitter: it is increased additively after
+    every fast submission and decreased multiplicatively after every slow or
+    failed one.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Initial number of submissions per second. Default: 10.
+    burst : int, optional
+        Maximum number of submissions that can be done at once after a period
+        of inactivity (capacity of the token bucket). Default: 10.
+    min_rate : float, optional
+        Lower bound of the adapted rate. Default: 0.1.
+    max_rate : float, optional
+        Upper bound of the adapted rate. Default: 100.
+    rate_increase : float, optional
+        Increase of the rate after a fast submission. Default: 0.5.
+    rate_decrease : float, optional
+        Factor the rate is multiplied by after a slow or failed submission.
+        Default: 0.5.
+    target_latency : float, optional
+        Submissions taking longer than this number of seconds are considered
+        slow. Default: 2.
+    max_retries : int, optional
+        Maximum number of retries of a single submission. Default: 8.
+    backoff : float, optional
+        Delay in seconds before the first retry, doubled with every further
+        retry. Default: 1.
+    max_backoff : float, optional
+        Maximum delay in seconds between two retries. Default: 60.
+    transient_errors : list of str, optional
+        Regular expressions matching error messages of the submitter that are
+        worth retrying. Other errors are raised immediately.
+    ambiguous_errors : list of str, optional
+        Regular expressions matching error messages of the submitter after
+        which the submission may have been accepted nevertheless (e.g., a
+        timeout of the reply of the controller). They are retried only if
+        a lookup of the submission, see :py:meth:`run`, does not find it,
+        and raised immediately without a lookup.
+
+    See Also
+    --------
+    TaskManager.submit
+    """
+
+    def __init__(self, rate=10., burst=10, min_rate=0.1, max_rate=100.,
+                 rate_increase=0.5, rate_decrease=0.5, target_latency=2.,
+                 max_retries=8, backoff=1., max_backoff=60.,
+                 transient_errors=(), ambiguous_errors=()):
+        if rate <= 0 or min_rate <= 0 or burst < 1:
+            raise ValueError('Rate and burst have to be positive.')
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.rate_increase = rate_increase
+        self.rate_decrease = rate_decrease
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.transient_errors = [
+                re.compile(pattern, re.IGNORECASE)
+                for pattern in transient_errors]
+        self.ambiguous_errors = [
+                re.compile(pattern, re.IGNORECASE)
+                for pattern in ambiguous_errors]
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a submission is allowed by the token bucket.
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Reserve the token now and sleep outside of the lock.
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_transient(self, error):
+        """Check whether an error of the submitter is worth retrying.
+
+        Parameters
+        ----------
+        error : Exception
+            Error raised by the submission.
+
+        Returns
+        -------
+        transient : bool
+            True if the error message matches any of the transient errors.
+        """
+        message = '%s' % error
+        return any(pattern.search(message) is not None
+                   for pattern in self.transient_errors)
+
+    def is_ambiguous(self, error):
+        """Check whether the submission may have succeeded despite an error.
+
+        Parameters
+        ----------
+        error : Exception
+            Error raised by the submission.
+
+        Returns
+        -------
+        ambiguous : bool
+            True if the error message matches any of the ambiguous errors.
+        """
+        message = '%s' % error
+        return any(pattern.search(message) is not None
+                   for pattern in self.ambiguous_errors)
+
+    def get_backoff(self, attempt):
+        """Get a jittered delay before a given retry.
+
+        Parameters
+        ----------
+        attempt : int
+            Number of the retry starting from 0.
+
+        Returns
+        -------
+        delay : float
+            Delay in seconds.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_success(self, latency):
+        """Adapt the rate after a successful submission.
+
+        Parameters
+        ----------
+        latency : float
+            Duration of the submission in seconds.
+        """
+        with self._lock:
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * self.rate_decrease)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.rate_increase)
+
+    def record_failure(self):
+        """Adapt the rate after a transient failure of a submission.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.rate_decrease)
+            # Drop the accumulated burst, the submitter is struggling.
+            self.tokens = min(self.tokens, 0)
+
+    def run(self, func, *args, **kwargs):
+        """Run a submission function respecting the rate limit.
+
+        Parameters
+        ----------
+        func : callable
+            Function doing the actual submission, e.g. :py:func:`.run_cmd`.
+        args, kwargs
+            Arguments passed to `func`.
+        lookup : callable, optional
+            Keyword argument not passed to `func`. Called without arguments
+            after an ambiguous error and the backoff, it returns the result
+            of the submission if it was accepted, or None if the submission
+            has to be retried. Default: raise ambiguous errors.
+
+        Returns
+        -------
+        result
+            Return value of `func`.
+
+        Raises
+        ------
+        RuntimeError
+            If `func` fails with a non-transient error, or if it keeps failing
+            with transient errors more than `max_retries` times, or if the
+            lookup after an ambiguous error fails.
+        """
+        lookup = kwargs.pop('lookup', None)
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except RuntimeError as e:
+                ambiguous = lookup is not None and self.is_ambiguous(e)
+                if not (ambiguous or self.is_transient(e)) or \
+                        attempt >= self.max_retries:
+                    raise
+                self.record_failure()
+                delay = self.get_backoff(attempt)
+                self.log.warning(
+                        'Transient submission error, retry %d/%d in %.1fs '
+                        '(rate %.2f/s): %s', attempt + 1, self.max_retries,
+                        delay, self.rate, e)
+                time.sleep(delay)
+                attempt += 1
+                if ambiguous:
+                    # Do not submit twice if the submission was accepted.
+                    result = lookup()
+                    if result is not None:
+                        self.log.warning('Submission accepted despite: %s', e)
+                        return result
+                continue
+            self.record_success(time.time() - start)
+            return result
@@ -0,0 +1,325 @@
+"""
+yatamana.sweep
+--------------
+
+Lazy parameter sweeps.
+
+A :py:class:`Sweep` is defined by its axes only, the values of its parameters
+are combined on demand. Its number of tasks and chunks is known upfront, and
+the tasks are created block by block while enqueueing them by
+:py:meth:`.TaskManager.enqueue_chunked`, so that the submission starts
+immediately and memory does not grow with the size of the sweep.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import random
+import re
+from array import array
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+TEMPLATE_RE = re.compile(r'%\((\w+)\)s')
+
+
+class Sweep(object):
+    """Sweep of tasks over parameter axes.
+
+    The axes are added by :py:meth:`product` and :py:meth:`zip`, each call
+    crossing the axes with the previous ones, the last axes varying fastest
+    as in nested loops. A random subset of the combinations can be taken by
+    :py:meth:`sample`.
+
+    Parameters
+    ----------
+    factory : callable
+        Called with the values of a row as keyword arguments to create its
+        task, typically the class of the tasks. If `command` is given, it is
+        called without arguments instead.
+    command : list of str, optional
+        Template of the command of the tasks, with the parameters given as
+        ``%(name)s``. Arguments without parameters are shared by all the
+        tasks.
+    block_size : int, optional
+        Number of tasks created at once while iterating. Default: 1000.
+
+    Examples
+    --------
+    >>> sweep = Sweep(FitTask).product([  # doctest: +SKIP
+    ...     ('sample', samples), ('alpha', alphas)])
+    >>> sweep.zip([('x', xs), ('y', ys)])  # doctest: +SKIP
+    >>> sweep.sample(100000, seed=1)  # doctest: +SKIP
+    >>> for job in task_manager.enqueue_chunked(sweep):  # doctest: +SKIP
+    ...     pass
+    """
+    __slots__ = ('factory', 'command', 'block_size', 'groups', 'indices')
+
+    def __init__(self, factory, command=None, block_size=1000):
+        self.factory = factory
+        self.command = None
+        if command is not None:
+            self.command = [
+                (arg, TEMPLATE_RE.search(arg) is not None)
+                for arg in command]
+        self.block_size = block_size
+        self.groups = []
+        self.indices = None
+
+    def add_group(self, axes):
+        """Cross the sweep with a group of axes varying together.
+
+        Parameters
+        ----------
+        axes : iterable of tuple
+            Names of the parameters and their values.
+        """
+        if self.indices is not None:
+            raise ValueError('Cannot add axes to a sampled sweep.')
+        names = set(name for g in self.groups for name, _ in g)
+        group = []
+        for name, values in axes:
+            if name in names:
+                raise ValueError('Duplicate axis: %s' % name)
+            names.add(name)
+            if not hasattr(values, '__getitem__') or \
+                    not hasattr(values, '__len__'):
+                values = list(values)
+            group += [(name, values)]
+        if len(set(len(values) for _, values in group)) > 1:
+            raise ValueError('Zipped axes differ in length: %s' % ', '.join(
+                '%s=%d' % (name, len(values)) for name, values in group))
+        if group:
+            self.groups += [group]
+
+    def product(self, axes):
+        """Cross the sweep with axes.
+
+        Parameters
+        ----------
+        axes : dict or list of tuple
+            Names of the parameters and sequences of their values.
+
+        Returns
+        -------
+        sweep : Sweep
+            This sweep.
+        """
+        items = axes.items() if hasattr(axes, 'items') else axes
+        for name, values in items:
+            self.add_group([(name, values)])
+        return self
+
+    def zip(self, axes):
+        """Cross the sweep with axes varying together.
+
+        Parameters
+        ----------
+        axes : dict or list of tuple
+            Names of the parameters and sequences of their values, all of the
+            same length.
+
+        Returns
+        -------
+        sweep : Sweep
+            This sweep.
+        """
+        self.add_group(axes.items() if hasattr(axes, 'items') else axes)
+        return self
+
+    def sample(self, n, seed=None):
+        """Restrict the sweep to a random subset of its combinations.
+
+        The combinations are drawn without replacement and kept in the order
+        of the full sweep. Only their indices are stored, a sweep not larger
+        than `n` is left as it is. Sampling a sampled sweep draws from its
+        subset.
+
+        Parameters
+        ----------
+        n : int
+            Number of combinations, all of them if the sweep is smaller.
+        seed : int, optional
+            Seed of the random generator.
+
+        Returns
+        -------
+        sweep : Sweep
+            This sweep.
+        """
+        total = len(self)
+        if n >= total:
+            return self
+        # The population is not materialized, the sweep can be huge.
+        indices = sorted(random.Random(seed).sample(xrange(total), n))
+        if self.indices is not None:
+            indices = [self.indices[i] for i in indices]
+        self.indices = array(str('l'), indices)
+        return self
+
+    def get_size(self):
+        """Get the number of combinations of the axes.
+
+        Returns
+        -------
+        size : int
+            Product of the lengths of the groups of axes, 0 without axes.
+        """
+        if not self.groups:
+            return 0
+        size = 1
+        for group in self.groups:
+            size *= len(group[0][1])
+        return size
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return self.get_size()
+
+    def count_chunks(self, n):
+        """Count the chunks of the sweep.
+
+        Parameters
+        ----------
+        n : int
+            Number of tasks per chunk.
+
+        Returns
+        -------
+        count : int
+            Number of chunks enqueued by
+            :py:meth:`.TaskManager.enqueue_chunked`.
+        """
+        return (len(self) + n - 1) // n
+
+    def get_digits(self, index):
+        """Get the positions of a combination on the groups of axes.
+
+        Parameters
+        ----------
+        index : int
+            Index of the combination in the full sweep.
+
+        Returns
+        -------
+        digits : list of int
+            Position on each group.
+        """
+        digits = [0] * len(self.groups)
+        for i in range(len(self.groups) - 1, -1, -1):
+            index, digits[i] = divmod(index, len(self.groups[i][0][1]))
+        return digits
+
+    def iter_rows(self, start=0, stop=None):
+        """Iterate over the parameters of a range of tasks.
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first task.
+        stop : int, optional
+            Index after the last task. Default: the length of the sweep.
+
+        Returns
+        -------
+        rows : iterator of dict
+            Values of all the parameters.
+        """
+        if stop is None:
+            stop = len(self)
+        if self.indices is not None:
+            for i in range(start, stop):
+                yield self.get_row_at(self.get_digits(self.indices[i]))
+            return
+        if start >= stop:
+            return
+        digits = self.get_digits(start)
+        for _ in range(start, stop):
+            yield self.get_row_at(digits)
+            # Advance the digits like an odometer.
+            for i in range(len(digits) - 1, -1, -1):
+                digits[i] += 1
+                if digits[i] < len(self.groups[i][0][1]):
+                    break
+                digits[i] = 0
+
+    def get_row_at(self, digits):
+        """Get parameters at given positions on the groups of axes.
+        """
+        row = {}
+        for group, digit in zip(self.groups, digits):
+            for name, values in group:
+                row[name] = values[digit]
+        return row
+
+    def get_row(self, i):
+        """Get parameters of a task.
+
+        Parameters
+        ----------
+        i : int
+            Index of the task.
+
+        Returns
+        -------
+        row : dict
+            Values of all the parameters.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Sweep index out of range.')
+        return next(self.iter_rows(i, i + 1))
+
+    def make_task(self, row):
+        """Create the task of a row.
+
+        Parameters
+        ----------
+        row : dict
+            Values of all the parameters.
+
+        Returns
+        -------
+        task : Task
+            Created task.
+        """
+        if self.command is None:
+            return self.factory(**row)
+        task = self.factory()
+        task.command = [
+            arg % row if has_params else arg
+            for arg, has_params in self.command]
+        return task
+
+    def get_block(self, start, stop):
+        """Create the tasks of a range.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first task.
+        stop : int
+            Index after the last task.
+
+        Returns
+        -------
+        tasks : list of Task
+            Created tasks.
+        """
+        return [self.make_task(row) for row in self.iter_rows(start, stop)]
+
+    def __getitem__(self, i):
+        return self.make_task(self.get_row(i))
+
+    def __iter__(self):
+        n = len(self)
+        for start in range(0, n, self.block_size):
+            for task in self.get_block(
+                    start, min(start + self.block_size, n)):
+                yield task
@@ -1,23 +1,168 @@
 from __future__ import (
         division, print_function, unicode_literals, absolute_import)
 
+import hashlib
 import os
 from collections import OrderedDict
 from .utils import parse_walltime
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class SharedDefaults(OrderedDict):
+    """Read-only defaults shared by many tasks.
+
+    Copies are ordinary (mutable) ordered dicts.
+
+    Parameters
+    ----------
+    items : dict-like or iterable of pairs
+        The defaults.
+    """
+    frozen = False
+
+    def __init__(self, *args, **kwargs):
+        super(SharedDefaults, self).__init__(*args, **kwargs)
+        self.frozen = True
+
+    def check_frozen(self):
+        if self.frozen:
+            raise TypeError('Shared defaults cannot be modified.')
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        self.check_frozen()
+        super(SharedDefaults, self).__setitem__(key, value, *args, **kwargs)
+
+    def __delitem__(self, key, *args, **kwargs):
+        self.check_frozen()
+        super(SharedDefaults, self).__delitem__(key, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self.check_frozen()
+        super(SharedDefaults, self).update(*args, **kwargs)
+
+    def pop(self, *args):
+        self.check_frozen()
+        return super(SharedDefaults, self).pop(*args)
+
+    def popitem(self, *args, **kwargs):
+        self.check_frozen()
+        return super(SharedDefaults, self).popitem(*args, **kwargs)
+
+    def setdefault(self, *args):
+        self.check_frozen()
+        return super(SharedDefaults, self).setdefault(*args)
+
+    def clear(self):
+        self.check_frozen()
+        super(SharedDefaults, self).clear()
+
+    def copy(self):
+        return OrderedDict(self)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
+
+
+#: Defaults of every task.
+DEFAULTS = SharedDefaults(current_working_directory=True)
+
+
+class CopyOnWriteDefaults(MutableMapping):
+    """Mutable view of the shared defaults of a task.
+
+    The first modification replaces the shared defaults of the task by a
+    private copy, which is modified instead.
+
+    Parameters
+    ----------
+    task : Task
+        Task whose defaults are viewed.
+    """
+    __slots__ = ('task',)
+
+    def __init__(self, task):
+        self.task = task
+
+    def __getitem__(self, key):
+        return self.task._defaults[key]
+
+    def __iter__(self):
+        return iter(self.task._defaults)
+
+    def __len__(self):
+        return len(self.task._defaults)
+
+    def __setitem__(self, key, value):
+        self.task.unshare_defaults()[key] = value
+
+    def __delitem__(self, key):
+        del self.task.unshare_defaults()[key]
+
+    def copy(self):
+        return OrderedDict(self.task._defaults)
+
+    def __repr__(self):
+        return '%s(%r)' % (
+                self.__class__.__name__, list(self.task._defaults.items()))
+
 
 class Task(object):
     """Base class for all tasks to be submitted.
+
+    To keep millions of tasks in memory, tasks use slots and share their
+    defaults. Subclasses can declare ``__slots__`` of their own attributes to
+    avoid a per-instance ``__dict__``, otherwise they get one as usual. The
+    defaults are a :py:class:`SharedDefaults` shared by all the tasks of the
+    same class enqueued by the same manager, they are copied on the first
+    modification, either by :py:meth:`update_defaults` or through the
+    `defaults` attribute.
     """
+    __slots__ = (
+            'opts', '_defaults', 'job_id', 'command', 'runner_name', 'member')
+
     def __init__(self):
         self.opts = OrderedDict([])
         self.job_id = None
+        self.runner_name = None
+        self.member = None
         name = self.__class__.__name__
         if name.endswith('Task'):
             name = name[:-len('Task')]
         name += '-%(salt)s'
         self.opts['name'] = name
-        self.defaults = OrderedDict(current_working_directory=True)
+        self.defaults = DEFAULTS
+
+    @property
+    def defaults(self):
+        """Defaults of the task, modifiable as a dict.
+
+        Shared defaults are viewed through a :py:class:`CopyOnWriteDefaults`.
+        """
+        if isinstance(self._defaults, SharedDefaults):
+            return CopyOnWriteDefaults(self)
+        return self._defaults
+
+    @defaults.setter
+    def defaults(self, defaults):
+        if isinstance(defaults, CopyOnWriteDefaults):
+            defaults = defaults.task._defaults
+        self._defaults = defaults
+
+    def unshare_defaults(self):
+        """Replace shared defaults by a private copy.
+
+        Returns
+        -------
+        defaults : OrderedDict
+            Private defaults of the task.
+        """
+        if isinstance(self._defaults, SharedDefaults):
+            self._defaults = self._defaults.copy()
+        return self._defaults
 
     def update_defaults(self, defaults):
         """Update the defaults.
@@ -25,9 +170,20 @@ class Task(object):
         Parameters
         ----------
         defaults : dict
-            New values for some of the defaults.
+            New values for some of the defaults. If they are
+            :py:class:`SharedDefaults` containing the defaults of every task
+            (as given by :py:meth:`.TaskManager.get_shared_defaults`) and the
+            defaults of this task were not changed yet, they are shared
+            rather than copied.
         """
-        self.defaults.update(defaults)
+        if defaults is self._defaults:
+            # Enqueueing a task again must not unshare its defaults.
+            return
+        if self._defaults is DEFAULTS and \
+                isinstance(defaults, SharedDefaults):
+            self._defaults = defaults
+            return
+        self.unshare_defaults().update(defaults)
 
     def is_finished(self):
         """Check whether the task has already successfully finished.
@@ -60,7 +216,7 @@ class Task(object):
         resolved : dict-like
             Resolved options.
         """
-        opts = self.defaults.copy()
+        opts = self._defaults.copy()
         opts.update(self.opts)
         resolved = OrderedDict()
         if 'name' in opts:
@@ -97,7 +253,32 @@ class Task(object):
         """
         return ' '.join(self.command)
 
-    def render_runner(self, template):
+    def get_key(self):
+        """Get a key identifying the task by its command.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal digest of the class name and the rendered command.
+        """
+        sha1 = hashlib.sha1(self.__class__.__name__.encode('utf-8'))
+        sha1.update(self.render_command().encode('utf-8'))
+        return sha1.hexdigest()[:20]
+
+    def render_modules(self):
+        """Render task's environment modules into a string.
+
+        Returns
+        -------
+        modules : str
+            Space separated modules.
+        """
+        modules = self.opts.get('modules')
+        if modules is None:
+            return ''
+        return ' '.join(modules)
+
+    def render_runner(self, template, values=None):
         """Render a runner script according to the template.
 
         Parameters
@@ -105,20 +286,19 @@ class Task(object):
         template : str
             Template of the runner script as a format string.  The template can
             contain ``'%(modules)s'`` and ``'%(command)s'``.
+        values : dict, optional
+            Additional values to substitute in the template.
 
         Returns
         -------
         runner_script : str
             Rendered runner script.
         """
-        modules = self.opts.get('modules')
-        if modules is None:
-            modules = ''
-        else:
-            modules = ' '.join(modules)
-        contents = template % {
+        values = dict(values or {})
+        values.update({
                 'command': self.render_command(),
-                'modules': modules}
+                'modules': self.render_modules()})
+        contents = template % values
         return contents
 
     def get_runner_prefix(self):
@@ -2,14 +2,33 @@ from __future__ import (
         print_function, division, absolute_import, unicode_literals)
 
 import os
+import hashlib
 import json
 import logging
-from copy import deepcopy
+import time
+from math import ceil
+from collections import OrderedDict
+from copy import copy, deepcopy
 from datetime import datetime
+from functools import partial
 from tempfile import NamedTemporaryFile
-from .utils import run_cmd, make_salt, makedirs, make_executable
-from .task import Task
+from .utils import (
+        make_salt, makedirs, make_executable, quote, decode_output,
+        parse_walltime)
+from .task import Task, SharedDefaults, DEFAULTS
 from .chunk_of_tasks_task import ChunkOfTasksTask
+from .segment_of_task_task import SegmentOfTaskTask
+from .submission_governor import SubmissionGovernor
+from .metrics import Metrics
+from .critical_path import analyze_critical_path
+from .completion_watcher import CompletionWatcher, render_sentinel
+from .watchdog import render_heartbeat
+from .result_store import render_results
+from .speculator import render_claims
+from .transport import get_transport
+from .plan import Plan
+from .environment_snapshot import (
+        get_modules_fingerprint, render_environment)
 
 
 class TaskManager(object):
@@ -22,13 +41,57 @@ class TaskManager(object):
     default_submit_command : str
         Full path to the binary that submits to the cluster. Subclasses have to
         redefine this class attribute providing a valid value.
+    transient_errors : tuple of str
+        Regular expressions matching transient errors of the submitter, see
+        :py:class:`.SubmissionGovernor`. If empty and the setup does not
+        contain a ``submission`` section, submissions are not governed.
+    ambiguous_errors : tuple of str
+        Regular expressions matching errors of the submitter after which the
+        job may have been submitted nevertheless. They are retried only if
+        :py:meth:`find_submission` does not find the job, see
+        :py:class:`.SubmissionGovernor`.
+    supports_dependencies : bool
+        Whether single jobs can depend on other jobs by the ``dependencies``
+        option.
+    status_command : str
+        Full path to the binary listing jobs in the queue. Used by
+        :py:meth:`.get_job_states`.
+    cancel_command : str
+        Full path to the binary cancelling jobs. Used by
+        :py:meth:`.cancel_jobs`.
+    control_actions : tuple of str
+        Actions of :py:meth:`.control_jobs`, each run by the binary in the
+        attribute of the same name with the ``_command`` suffix. The
+        binaries can be overridden by the options of the same names.
+    hold_command, release_command, renice_command : str
+        Full paths to the binaries holding, releasing, and changing the
+        priority of jobs. Used by :py:meth:`.control_jobs`.
+    max_job_ids : int
+        Maximum number of job IDs passed to a single call of the binaries
+        controlling jobs.
+    placement_class : type
+        Placement policy choosing where the jobs go, configured by the
+        optional ``placement`` section of the setup, see
+        :py:class:`.PlacementPolicy`. None if not supported.
+    job_id_variable : str
+        Name of the environment variable holding the job ID inside a job.
+    transport : LocalTransport
+        Transport running the submission and status commands, configured by
+        the optional ``transport`` section of the setup, see
+        :py:func:`.get_transport`.
+    metrics : Metrics
+        Timings of the phases of enqueueing and counters of enqueued tasks and
+        submitted jobs. Written to the files given in the ``metrics`` section
+        of the setup by :py:meth:`.export_metrics`.
 
     Parameters
     ----------
-    setup_file : str
-        Filename of the setup file with configuration options.
+    setup_file : str | dict
+        Filename of the setup file with configuration options, or the
+        options themselves.
     dryrun : bool, optional
-        Do not enqueue any jobs, only prepare them. Default: False.
+        Do not enqueue any jobs, only prepare them, see also
+        :py:meth:`start_plan`. Default: False.
     salt : str
         String unique to this instance used to avoid filename clashes. Default:
         use :py:func:`.make_salt` to generate the salt.
@@ -46,12 +109,30 @@ class TaskManager(object):
     """
 
     default_submit_command = None
+    transient_errors = ()
+    ambiguous_errors = ()
+    supports_dependencies = True
+    status_command = None
+    cancel_command = None
+    control_actions = ('cancel', 'hold', 'release', 'renice')
+    control_metrics = {
+            'cancel': 'cancelled', 'hold': 'held', 'release': 'released',
+            'renice': 'reniced'}
+    hold_command = None
+    release_command = None
+    renice_command = None
+    max_job_ids = 1000
+    placement_class = None
+    job_id_variable = None
 
     def __init__(self, setup_file, dryrun=False, **kwargs):
         self.log = logging.getLogger(self.__class__.__name__)
         self.dryrun = dryrun
-        with open(setup_file) as fr:
-            self.kwargs = json.load(fr)
+        if isinstance(setup_file, dict):
+            self.kwargs = deepcopy(setup_file)
+        else:
+            with open(setup_file) as fr:
+                self.kwargs = json.load(fr)
         self.kwargs.update(kwargs)
         if 'salt' not in self.kwargs:
             self.kwargs['salt'] = make_salt(6)
@@ -59,13 +140,61 @@ class TaskManager(object):
             cmd = self.__class__.default_submit_command
             self.kwargs['submit_command'] = cmd
             self.log.info('Using default submit command: %s', cmd)
+        self.status_command = self.kwargs.get(
+                'status_command', self.__class__.status_command)
+        for action in self.control_actions:
+            name = action + '_command'
+            setattr(self, name, self.kwargs.get(
+                name, getattr(self.__class__, name)))
+        self.transport = get_transport(self.kwargs.get('transport'))
         tmp = self.kwargs.get('shared_tmp')
         if tmp is None:
             self.runner_dir = 'run'
         else:
             self.runner_dir = os.path.expandvars(os.path.join(tmp, 'run'))
+        submission = self.kwargs.get('submission')
+        if submission is None and not self.transient_errors and \
+                not self.ambiguous_errors:
+            self.governor = None
+        else:
+            submission = dict(submission or {})
+            submission.setdefault(
+                    'transient_errors', self.__class__.transient_errors)
+            submission.setdefault(
+                    'ambiguous_errors', self.__class__.ambiguous_errors)
+            self.governor = SubmissionGovernor(**submission)
+        placement = self.kwargs.get('placement')
+        if placement is None or self.placement_class is None:
+            self.placement = None
+        else:
+            self.placement = self.placement_class(self.run_cmd, **placement)
+        self.in_flight = None
+        sentinel_dir = self.kwargs.get('completion', {}).get('sentinel_dir')
+        if sentinel_dir is not None:
+            sentinel_dir = os.path.expandvars(sentinel_dir % self.kwargs)
+        self.sentinel_dir = sentinel_dir
+        heartbeat_dir = self.kwargs.get('heartbeat', {}).get('dir')
+        if heartbeat_dir is not None:
+            heartbeat_dir = os.path.expandvars(heartbeat_dir % self.kwargs)
+        self.heartbeat_dir = heartbeat_dir
+        results_dir = self.kwargs.get('results', {}).get('dir')
+        if results_dir is not None:
+            results_dir = os.path.expandvars(results_dir % self.kwargs)
+        self.results_dir = results_dir
+        self.module_fingerprints = {}
+        self.shared_defaults = {}
+        self.copy_origins = {}
+        self.plan = None
+        profile = self.kwargs.get('metrics', {}).get('profile')
+        if profile is not None:
+            profile = os.path.expandvars(profile)
+        self.metrics = Metrics(
+                labels={
+                    'manager': self.__class__.__name__,
+                    'salt': self.kwargs['salt']},
+                profile=profile)
 
-    def enqueue(self, task):
+    def enqueue(self, task, wrapper=ChunkOfTasksTask):
         """Enqueue a given task to be computed.
 
         If mupltiple tasks are given, a single wrapper task
@@ -76,6 +205,9 @@ class TaskManager(object):
         ----------
         task : Task | iterable of Task
             One or more tasks to be computed.
+        wrapper : type, optional
+            Class of the wrapper task used for multiple tasks. Default:
+            :py:class:`.ChunkOfTasksTask`.
 
         Returns
         -------
@@ -83,16 +215,23 @@ class TaskManager(object):
             Enqueued single task or :py:obj:`.ChunkOfTasksTask` in the case of
             multiple tasks.
         """
-        if not issubclass(task.__class__, Task):
-            tasks = task
-            for task in tasks:
-                task.update_defaults(self.get_task_defaults(
-                    task.__class__.__name__))
-            task = ChunkOfTasksTask(tasks)
-        task.update_defaults(self.get_task_defaults(task.__class__.__name__))
-        return self.enqueue_inner(task)
+        with self.metrics.timer('enqueue'):
+            if not issubclass(task.__class__, Task):
+                tasks = task
+                for task in tasks:
+                    task.update_defaults(self.get_shared_defaults(
+                        task.__class__.__name__))
+                task = wrapper(tasks)
+                self.metrics.observe('tasks_per_chunk', len(tasks))
+                self.metrics.increment('tasks_enqueued', len(tasks))
+            else:
+                self.metrics.increment('tasks_enqueued')
+            task.update_defaults(self.get_shared_defaults(
+                task.__class__.__name__))
+            return self.enqueue_inner(task)
 
-    def get_chunk_size(self, clsname, default=5):
+    def get_chunk_size(self, clsname, default=5,
+                       wrapper_clsname='ChunkOfTasksTask'):
         """Get chunk size from defaults.
 
         Parameters
@@ -101,20 +240,24 @@ class TaskManager(object):
             Class name of the tasks to be chunked.
         default : int
             Default number of tasks per chunk.
+        wrapper_clsname : string
+            Class name of the wrapper task whose defaults are checked.
 
         Returns
         -------
         n : int
             Number of tasks per chunk.
         """
-        opts = self.get_task_defaults('ChunkOfTasksTask')
+        opts = self.get_task_defaults(wrapper_clsname)
         n = opts.get('chunk_size', {}).get(clsname, default)
         return n
 
-    def enqueue_chunked(self, tasks, n=None):
+    def enqueue_chunked(self, tasks, n=None, max_in_flight=None,
+                        wrapper=ChunkOfTasksTask):
         """Enqueue in chunks.
 
-        Iterator returning enqueued jobs.
+        Iterator returning enqueued jobs. The tasks are consumed lazily, only
+        a single chunk is held in memory at a time.
 
         Parameters
         ----------
@@ -122,21 +265,510 @@ class TaskManager(object):
             Tasks.
         n : int
             Number of tasks per chunk.
+        max_in_flight : int, optional
+            Maximum number of jobs of the user in the queue. When reached,
+            the enqueueing pauses until some of the jobs leave the queue, see
+            :py:meth:`.wait_for_capacity`. Default:
+            ``backpressure.max_in_flight`` from the setup, or no limit.
+        wrapper : type, optional
+            Class of the wrapper task of the chunks. Default:
+            :py:class:`.ChunkOfTasksTask`.
 
-        If ``n`` is not specified, the defaults of ChunkOfTasksTask are checked
-        for ``chunk_size.clsname_of_the_task``. If the default is not specified
-        either, ``n=5`` is used.
+        If ``n`` is not specified, the defaults of the wrapper class are
+        checked for ``chunk_size.clsname_of_the_task``. If the default is not
+        specified either, ``n=5`` is used.
         """
+        if max_in_flight is None:
+            max_in_flight = self.kwargs.get(
+                    'backpressure', {}).get('max_in_flight')
         chunk = []
         for task in tasks:
             if n is None:
-                n = self.get_chunk_size(task.__class__.__name__)
+                n = self.get_chunk_size(
+                        task.__class__.__name__,
+                        wrapper_clsname=wrapper.__name__)
             chunk += [task]
             if len(chunk) >= n:
-                yield self.enqueue(chunk)
+                if max_in_flight is not None:
+                    self.wait_for_capacity(max_in_flight)
+                yield self.enqueue(chunk, wrapper=wrapper)
                 chunk = []
         if chunk:
-            yield self.enqueue(chunk)
+            if max_in_flight is not None:
+                self.wait_for_capacity(max_in_flight)
+            yield self.enqueue(chunk, wrapper=wrapper)
+
+    def enqueue_segmented(self, task, segment_walltime=None):
+        """Enqueue a long task as a chain of shorter dependent jobs.
+
+        The task resumes from its checkpoint in every job but the first one,
+        see :py:class:`.CheckpointingMixin` and :py:class:`.SegmentOfTaskTask`.
+        Short jobs get backfilled much sooner than a single long one. The
+        chain is configured by the ``segmentation`` section of the setup::
+
+            "segmentation": {
+              "walltime": "04:00:00",
+              "grace": 300,
+              "extra_segments": 1
+            }
+
+        Every segment stops the command `grace` seconds before its walltime,
+        leaving half of that time to write the checkpoint. The number of
+        segments covers the walltime of the task plus `extra_segments`.
+
+        Parameters
+        ----------
+        task : CheckpointingMixin
+            Task to be enqueued.
+        segment_walltime : int | str, optional
+            Walltime of a segment. Default: ``segmentation.walltime``.
+
+        Returns
+        -------
+        segments : list of SegmentOfTaskTask
+            Enqueued segments. The `job_id` and `runner_name` of the task are
+            those of the last one, so that tasks depending on the task wait
+            for the whole chain. A task fitting a single segment is enqueued
+            as it is.
+        """
+        segments = self.make_segments(task, segment_walltime)
+        if not segments:
+            return [self.enqueue(task)]
+        for segment in segments:
+            self.enqueue(segment)
+        task.job_id = segments[-1].job_id
+        task.runner_name = segments[-1].runner_name
+        return segments
+
+    def make_segments(self, task, segment_walltime=None):
+        """Split a long task into a chain of shorter dependent segments.
+
+        See :py:meth:`enqueue_segmented`.
+
+        Parameters
+        ----------
+        task : CheckpointingMixin
+            Task to be split.
+        segment_walltime : int | str, optional
+            Walltime of a segment. Default: ``segmentation.walltime``.
+
+        Returns
+        -------
+        segments : list of SegmentOfTaskTask
+            Segments, each depending on the previous one, or an empty list if
+            the task fits a single segment.
+        """
+        setup = self.kwargs.get('segmentation', {})
+        if segment_walltime is None:
+            segment_walltime = setup.get('walltime')
+        if segment_walltime is None:
+            raise ValueError('Missing segmentation.walltime option')
+        segment_walltime = parse_walltime(segment_walltime)
+        grace = setup.get('grace', 300)
+        limit = segment_walltime - grace
+        if limit <= 0:
+            raise ValueError(
+                'Segment walltime %ds not longer than grace %ds' % (
+                    segment_walltime, grace))
+        task.update_defaults(self.get_shared_defaults(
+            task.__class__.__name__))
+        walltime = task.resolve_opts(self.kwargs, update_self=False).get(
+                'walltime')
+        if walltime is None or walltime <= segment_walltime:
+            return []
+        count = int(ceil(walltime / limit)) + setup.get('extra_segments', 0)
+        self.log.info('Splitting %s into %d segments', task, count)
+        segments = []
+        for i in range(count):
+            segment = SegmentOfTaskTask(
+                    task, i, count, segment_walltime, limit, grace // 2)
+            if segments:
+                segment.opts['dependencies'] = [segments[-1]]
+            segments += [segment]
+        return segments
+
+    def enqueue_graph(self, tasks, max_nice=None):
+        """Enqueue a graph of dependent tasks prioritizing the critical path.
+
+        The slack of each task, i.e., the time by which it can be delayed
+        without delaying the whole graph, is computed from the dependencies
+        and walltimes of the tasks. The tasks are enqueued in a topological
+        order, the tasks with the lowest slack first, and their priority is
+        lowered proportionally to their slack by the ``nice`` option.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Tasks forming the graph, the tasks they depend on have to be either
+            enqueued already or contained in `tasks`.
+        max_nice : int, optional
+            Value of ``nice`` assigned to a task with the slack equal to the
+            length of the critical path. Default: ``critical_path.max_nice``
+            from the setup, or 1000.
+
+        Returns
+        -------
+        enqueued : list of Task
+            Enqueued tasks in the order of submission.
+        """
+        if max_nice is None:
+            max_nice = self.kwargs.get(
+                    'critical_path', {}).get('max_nice', 1000)
+        tasks = list(tasks)
+        for task in tasks:
+            for t in list(getattr(task, 'tasks', [])) + [task]:
+                t.update_defaults(self.get_shared_defaults(
+                    t.__class__.__name__))
+        order, slack, makespan = analyze_critical_path(tasks)
+        self.log.info(
+                'Critical path of %d tasks takes %ds', len(tasks), makespan)
+        enqueued = []
+        for task in order:
+            if makespan > 0:
+                task.opts['nice'] = int(round(
+                    max_nice * slack[task] / makespan))
+            enqueued += [self.enqueue(task)]
+        return enqueued
+
+    def get_job_states(self):
+        """Get states of all the jobs of the user in the queue.
+
+        The queue is queried by a single call of :py:attr:`status_command`.
+
+        Returns
+        -------
+        states : dict
+            Mapping of job IDs to one of 'pending', 'running', 'held',
+            'error', or 'other'.
+
+        Raises
+        ------
+        NotImplementedError
+            If the queue of the manager cannot be queried.
+        """
+        raise NotImplementedError(
+            'Cannot query the queue of %s' % self.__class__.__name__)
+
+    def get_task_states(self, tasks):
+        """Get states of the jobs of given tasks in the queue.
+
+        The queue is queried once, see :py:meth:`get_job_states`.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks.
+
+        Returns
+        -------
+        states : dict
+            Mapping of the tasks whose jobs are in the queue to the states of
+            their jobs.
+        """
+        states = self.get_job_states()
+        return dict((task, states[task.job_id]) for task in tasks
+                    if task.job_id in states)
+
+    def get_job_names(self):
+        """Get names of all the jobs of the user in the queue.
+
+        The queue is queried by a single call of :py:attr:`status_command`.
+
+        Returns
+        -------
+        names : dict
+            Mapping of job IDs to job names.
+        """
+        raise NotImplementedError
+
+    def find_jobs(self, salt=None):
+        """Find the jobs of the user in the queue enqueued with a salt.
+
+        Jobs are matched by the suffix of their names, which end with the
+        salt unless the tasks override their ``name`` option, see
+        :py:class:`.Task`.
+
+        Parameters
+        ----------
+        salt : str, optional
+            Salt of the manager that enqueued the jobs. Default: the salt of
+            this manager.
+
+        Returns
+        -------
+        job_ids : list of int
+            IDs of the matching jobs.
+        """
+        if salt is None:
+            salt = self.kwargs['salt']
+        suffix = '-%s' % salt
+        return sorted(job_id for job_id, name in self.get_job_names().items()
+                      if name.endswith(suffix))
+
+    def render_control_cmd(self, action, job_ids, value=None):
+        """Render a command controlling jobs.
+
+        Parameters
+        ----------
+        action : str
+            One of :py:attr:`control_actions`.
+        job_ids : list of str
+            IDs of the jobs, at most :py:attr:`max_job_ids`.
+        value : int, optional
+            New ``nice`` value of the jobs for 'renice'.
+
+        Returns
+        -------
+        cmd : list of str
+            Command to run.
+        """
+        command = getattr(self, action + '_command')
+        if command is None or action == 'renice':
+            raise NotImplementedError(
+                'Cannot %s jobs with %s' % (action, self.__class__.__name__))
+        return [command] + job_ids
+
+    def control_jobs(self, action, job_ids, value=None):
+        """Cancel, hold, release, or change the priority of jobs in bulk.
+
+        The job IDs are passed in batches of :py:attr:`max_job_ids` to
+        single calls of the binary of the action, pipelined through the
+        transport, see :py:meth:`.ShellTransport.run_many`. Failing calls are
+        logged only, because some of the jobs may have left the queue
+        already.
+
+        Parameters
+        ----------
+        action : str
+            One of :py:attr:`control_actions`.
+        job_ids : iterable of int
+            IDs of the jobs. Jobs of dry runs are skipped.
+        value : int, optional
+            New ``nice`` value of the jobs for 'renice', see the ``nice``
+            option of tasks.
+
+        Returns
+        -------
+        count : int
+            Number of jobs acted on.
+        """
+        if action not in self.control_actions:
+            raise ValueError('Unknown action: %s' % action)
+        if action == 'renice' and value is None:
+            raise ValueError('Missing nice value')
+        if self.dryrun:
+            return 0
+        job_ids = [str(j) for j in sorted(set(
+            j for j in job_ids if j is not None and j >= 0))]
+        if not job_ids:
+            return 0
+        cmds = [
+            self.render_control_cmd(
+                action, job_ids[i:i + self.max_job_ids], value)
+            for i in range(0, len(job_ids), self.max_job_ids)]
+        for cmd, (returncode, out) in zip(
+                cmds, self.transport.run_many(cmds)):
+            if returncode != 0:
+                self.log.warning('%s failed (%d): %s', cmd[0], returncode,
+                                 decode_output(out).strip())
+        self.metrics.increment(
+                'jobs_' + self.control_metrics[action], len(job_ids))
+        self.log.info('Action %s on %d jobs in %d calls', action,
+                      len(job_ids), len(cmds))
+        return len(job_ids)
+
+    def control(self, action, tasks=None, salt=None, value=None):
+        """Control the jobs of tasks, or all the jobs with a salt.
+
+        Parameters
+        ----------
+        action : str
+            One of :py:attr:`control_actions`.
+        tasks : iterable of Task, optional
+            Enqueued tasks. Tasks sharing a job, e.g. the tasks of a chunk,
+            count once.
+        salt : str, optional
+            Salt of the jobs if no tasks are given, see :py:meth:`find_jobs`.
+            Default: the salt of this manager.
+        value : int, optional
+            See :py:meth:`control_jobs`.
+
+        Returns
+        -------
+        count : int
+            Number of jobs acted on.
+        """
+        if tasks is not None:
+            if salt is not None:
+                raise ValueError('Give either tasks or a salt')
+            job_ids = [task.job_id for task in tasks]
+        elif self.dryrun:
+            job_ids = []
+        else:
+            job_ids = self.find_jobs(salt)
+        return self.control_jobs(action, job_ids, value)
+
+    def cancel(self, tasks=None, salt=None):
+        """Cancel the jobs of tasks, or all the jobs with a salt.
+
+        See :py:meth:`control` for the parameters.
+        """
+        return self.control('cancel', tasks, salt)
+
+    def hold(self, tasks=None, salt=None):
+        """Hold the pending jobs of tasks, or all the jobs with a salt.
+
+        See :py:meth:`control` for the parameters.
+        """
+        return self.control('hold', tasks, salt)
+
+    def release(self, tasks=None, salt=None):
+        """Release the held jobs of tasks, or all the jobs with a salt.
+
+        See :py:meth:`control` for the parameters.
+        """
+        return self.control('release', tasks, salt)
+
+    def renice(self, nice, tasks=None, salt=None):
+        """Change the priority of the jobs of tasks, or of all the jobs with
+        a salt.
+
+        Parameters
+        ----------
+        nice : int
+            New ``nice`` value, the higher the lower the priority, see the
+            ``nice`` option of tasks.
+
+        See :py:meth:`control` for the other parameters.
+        """
+        return self.control('renice', tasks, salt, nice)
+
+    def cancel_jobs(self, job_ids):
+        """Cancel jobs, see :py:meth:`control_jobs`.
+
+        Parameters
+        ----------
+        job_ids : iterable of int
+            IDs of the jobs to cancel. Jobs of dry runs are skipped.
+        """
+        self.control_jobs('cancel', job_ids)
+
+    def resubmit(self, task):
+        """Submit the runner of an enqueued task again as a new job.
+
+        The task keeps its runner and resolved options except for its
+        dependencies, which were already satisfied when the previous job
+        started.
+
+        Parameters
+        ----------
+        task : Task
+            Enqueued task, e.g., whose job was cancelled.
+
+        Returns
+        -------
+        task : Task
+            The task with the new `job_id`.
+        """
+        opts = OrderedDict(
+                (k, v) for k, v in task.opts.items() if k != 'dependencies')
+        enqueue_cmd = self.make_submit_cmd(task, self.map_opts(opts))
+        if self.dryrun is True:
+            self.log.info('Would run %s', enqueue_cmd)
+            task.job_id = self.record_job(enqueue_cmd, [task])
+        else:
+            out = self.submit(enqueue_cmd)
+            task.job_id = self.get_job_id(out)
+            self.metrics.increment('jobs_resubmitted')
+            if self.in_flight is not None:
+                self.in_flight += 1
+            self.log.info('Resubmitted %s', task)
+        return task
+
+    def enqueue_copy(self, task, exclude_hosts=None):
+        """Enqueue a copy of an enqueued task as another job.
+
+        The copy gets a runner of its own, so that it has its own sentinel
+        and heartbeat, but claims the commit of the outputs of its tasks
+        together with the original, see :py:func:`.speculator.render_claims`.
+
+        Parameters
+        ----------
+        task : Task
+            Enqueued task.
+        exclude_hosts : list of str, optional
+            Hosts the copy must not run on.
+
+        Returns
+        -------
+        copy : Task
+            Enqueued copy with the `job_id` attribute set.
+        """
+        duplicate = copy(task)
+        duplicate.job_id = None
+        duplicate.opts = OrderedDict(
+                (k, v) for k, v in task.opts.items() if k != 'dependencies')
+        if exclude_hosts:
+            duplicate.opts['exclude_hosts'] = list(exclude_hosts)
+        self.copy_origins[duplicate] = self.copy_origins.get(
+                task, task.runner_name)
+        enqueue_cmd = self.prepare_job(duplicate, resolve=False)
+        if self.dryrun is True:
+            self.log.info('Would run %s', enqueue_cmd)
+            duplicate.job_id = self.record_job(enqueue_cmd, [duplicate])
+        else:
+            out = self.submit(enqueue_cmd)
+            duplicate.job_id = self.get_job_id(out)
+            self.metrics.increment('jobs_copied')
+            if self.in_flight is not None:
+                self.in_flight += 1
+            self.log.info('Enqueued a copy of %s as %d', task,
+                          duplicate.job_id)
+        return duplicate
+
+    def count_in_flight(self):
+        """Count jobs of the user in the queue.
+
+        Returns
+        -------
+        n : int
+            Number of jobs in the queue in any state, held and failed ones
+            included, since they count against the queue limits too.
+        """
+        return len(self.get_job_states())
+
+    def wait_for_capacity(self, max_in_flight, poll_interval=None):
+        """Block until there is room for another job in the queue.
+
+        The queue is not queried for every job. Instead, the number of jobs in
+        flight is estimated by the last queried number plus the number of jobs
+        submitted since then. The queue is only queried when the estimate
+        reaches the limit.
+
+        Parameters
+        ----------
+        max_in_flight : int
+            Maximum number of jobs of the user in the queue.
+        poll_interval : float, optional
+            Seconds to wait between queries of a full queue. Default:
+            ``backpressure.poll_interval`` from the setup, or 30.
+        """
+        if self.dryrun is True or (
+                self.in_flight is not None and self.in_flight < max_in_flight):
+            return
+        if poll_interval is None:
+            poll_interval = self.kwargs.get(
+                    'backpressure', {}).get('poll_interval', 30)
+        with self.metrics.timer('wait_for_capacity'):
+            while True:
+                with self.metrics.timer('count_in_flight'):
+                    self.in_flight = self.count_in_flight()
+                if self.in_flight < max_in_flight:
+                    return
+                self.log.info(
+                        'Queue full (%d/%d jobs), waiting %ds',
+                        self.in_flight, max_in_flight, poll_interval)
+                time.sleep(poll_interval)
 
     def enqueue_inner(self, task):
         """Actually enque task.
@@ -153,17 +785,105 @@ class TaskManager(object):
         """
         assert task.job_id is None
         log = logging.getLogger(self.__class__.__name__)
-        task.resolve_opts(self.kwargs)
+        enqueue_cmd = self.prepare_job(task)
+        if self.dryrun is True:
+            log.info('Would run %s', enqueue_cmd)
+            task.job_id = self.record_job(enqueue_cmd, [task])
+        else:
+            out = self.submit(enqueue_cmd)
+            task.job_id = self.get_job_id(out)
+            self.metrics.increment('jobs_submitted')
+            if self.in_flight is not None:
+                self.in_flight += 1
+            log.info('Enqueued %s' % task)
+        return task
+
+    def start_plan(self):
+        """Record the jobs prepared by this dry run into a plan.
+
+        The jobs get symbolic IDs instead of -1, so that the dependencies
+        between them are kept, see :py:class:`.Plan`.
+
+        Returns
+        -------
+        plan : Plan
+            Plan recording the jobs enqueued from now on.
+        """
+        if self.dryrun is not True:
+            raise ValueError('Plans are recorded by dry runs only')
+        setup = deepcopy(self.kwargs)
+        setup.setdefault('manager', self.__class__.__name__.replace(
+            'TaskManager', '').lower())
+        self.plan = Plan(setup)
+        return self.plan
+
+    def record_job(self, enqueue_cmd, tasks, files=()):
+        """Record a job of a dry run.
+
+        Parameters
+        ----------
+        enqueue_cmd : list of str
+            Submission command.
+        tasks : list of Task
+            Tasks whose runners the job runs.
+        files : iterable of str, optional
+            Other files the job needs, besides its runners and the files
+            given in the submission command.
+
+        Returns
+        -------
+        job_id : int | str
+            -1, or a symbolic ID if a plan is recorded, see
+            :py:meth:`start_plan`.
+        """
+        if self.plan is None:
+            return -1
+        runner_dir = os.path.abspath(self.runner_dir) + os.sep
+        files = [t.runner_name for t in tasks] + list(files) + [
+            a for a in enqueue_cmd if os.path.abspath(a).startswith(
+                runner_dir) and os.path.isfile(a)]
+        directories = [os.path.dirname(t.opts.get('log_filename') or '')
+                       for t in tasks]
+        return self.plan.add(
+            enqueue_cmd, files=OrderedDict.fromkeys(files),
+            directories=directories)
+
+    def prepare_job(self, task, resolve=True):
+        """Prepare the runner of a task and the command submitting it.
+
+        Parameters
+        ----------
+        task : Task
+            Task to be enqueued. Its options are resolved and the
+            `runner_name` attribute is set.
+        resolve : bool, optional
+            Whether to resolve the options of the task. Default: True.
+
+        Returns
+        -------
+        enqueue_cmd : list of str
+            Submission command.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+        if resolve:
+            with self.metrics.timer('resolve_opts'):
+                task.resolve_opts(self.kwargs)
+        if self.placement is not None and not self.dryrun:
+            # Dry runs need not reach the cluster.
+            with self.metrics.timer('place'):
+                self.placement.place(task.opts)
         log_filename = task.opts.get('log_filename')
         if log_filename is not None:
-            makedirs(os.path.dirname(log_filename))
-        enqueue_cmd = [
-                self.kwargs['submit_command']] + [
-                o for oo in self.map_opts(task.opts).values() for o in oo]
-        runner_name = self.make_runner(task)
+            with self.metrics.timer('makedirs'):
+                makedirs(os.path.dirname(log_filename))
+        with self.metrics.timer('map_opts'):
+            mapped = self.map_opts(task.opts)
+        with self.metrics.timer('make_runner'):
+            runner_name = self.make_runner(task)
         log.info('Prepared a runner file: %s', runner_name)
-        enqueue_cmd += [runner_name]
-        with open(runner_name, 'a') as fw:
+        task.runner_name = runner_name
+        enqueue_cmd = self.make_submit_cmd(task, mapped)
+        with self.metrics.timer('write_footer'), open(runner_name, 'a') as fw:
             footer = [
                     '',
                     '#',
@@ -173,14 +893,91 @@ class TaskManager(object):
                     '# %s' % ' '.join(enqueue_cmd),
                     '#']
             fw.write('\n'.join(footer))
-        if self.dryrun is True:
-            log.info('Would run %s', enqueue_cmd)
-            task.job_id = -1
-        else:
-            out = run_cmd(enqueue_cmd)
-            task.job_id = self.get_job_id(out)
-            log.info('Enqueued %s' % task)
-        return task
+        return enqueue_cmd
+
+    def make_submit_cmd(self, task, mapped):
+        """Make the command submitting the runner of a task.
+
+        Parameters
+        ----------
+        task : Task
+            Task with its runner already made.
+        mapped : dict-like
+            Options mapped by :py:meth:`map_opts`.
+
+        Returns
+        -------
+        enqueue_cmd : list of str
+            Submission command.
+        """
+        return [self.kwargs['submit_command']] + [
+                o for oo in mapped.values() for o in oo] + [task.runner_name]
+
+    def run_cmd(self, cmd):
+        """Run a command of the scheduler by the transport of this manager.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Command to run.
+
+        Returns
+        -------
+        out : bytes
+            Output of the command.
+
+        Raises
+        ------
+        RuntimeError
+            If the command returns a non-zero exit code.
+        """
+        return self.transport.run(cmd)
+
+    def submit(self, cmd):
+        """Run a submission command.
+
+        The submission is governed by :py:attr:`governor`, if any, which
+        limits the rate of submissions and retries transient errors, and
+        ambiguous errors if :py:meth:`find_submission` does not find the job.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Submission command.
+
+        Returns
+        -------
+        out : str
+            Output of the submission command.
+        """
+        def run_submit_cmd(cmd):
+            with self.metrics.timer('submit'):
+                return self.run_cmd(cmd)
+
+        if self.governor is None:
+            return run_submit_cmd(cmd)
+        lookup = None
+        if self.ambiguous_errors:
+            lookup = partial(self.find_submission, cmd)
+        return self.governor.run(run_submit_cmd, cmd, lookup=lookup)
+
+    def find_submission(self, cmd):
+        """Find a job submitted by a command that failed ambiguously.
+
+        Subclasses with :py:attr:`ambiguous_errors` have to implement it.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Submission command.
+
+        Returns
+        -------
+        out : str
+            Output the submission command would have printed, parsed by
+            :py:meth:`get_job_id`, or None if the job is not in the queue.
+        """
+        raise NotImplementedError
 
     def make_runner(self, task):
         """Create a runner script in a temporary file.
@@ -211,10 +1008,285 @@ class TaskManager(object):
                 log.error('Missing a runner.template section')
                 raise ValueError('Missing a runner.template section')
             template = '\n'.join(template)
-            fw.write(task.render_runner(template))
+            with self.metrics.timer('render_runner'):
+                contents = task.render_runner(template, {
+                    'environment': self.render_environment(task)})
+                preamble = self.render_preamble(task, fw.name)
+                if preamble:
+                    # Insert the preamble right after the shebang.
+                    lines = contents.split('\n')
+                    at = 1 if lines[0].startswith('#!') else 0
+                    contents = '\n'.join(lines[:at] + preamble + lines[at:])
+            with self.metrics.timer('write_runner'):
+                fw.write(contents)
         make_executable(fw.name)
         return fw.name
 
+    def render_environment(self, task):
+        """Render commands setting up the environment of a task.
+
+        The commands replace ``%(environment)s`` in the runner template. They
+        are configured by the ``runner.environment`` section of the setup::
+
+            "environment": {
+              "setup": [
+                "module reset",
+                "for module in %(modules)s; do module load $module; done"
+              ],
+              "snapshot_dir": "%(shared_tmp)s/environments",
+              "modulepath": ["/software/modules/all"],
+              "watch": ["~/etc/setup-modules.sh"],
+              "exclude": ["MY_JOB_SPECIFIC_VARIABLE"]
+            }
+
+        The first job with a given set of modules runs the `setup` commands and
+        saves the resulting environment into `snapshot_dir`. The following
+        jobs source the saved environment instead. The snapshot is keyed by
+        the modules, the setup commands, and the modification times of the
+        module files found in `modulepath` (default: ``$MODULEPATH`` of the
+        driver) and of the `watch` files, so that it is invalidated when
+        versions of the modules change. Without `snapshot_dir`, the setup
+        commands are run by every job.
+
+        Parameters
+        ----------
+        task : Task
+            Resolved task.
+
+        Returns
+        -------
+        environment : str
+            Rendered commands, empty if there is no environment section.
+        """
+        setup = self.get_runner_setup().get('environment')
+        if setup is None:
+            return ''
+        modules = task.render_modules()
+        commands = setup.get('setup', [])
+        snapshot_dir = setup.get('snapshot_dir')
+        if snapshot_dir is None:
+            return '\n'.join(c % {'modules': modules} for c in commands)
+        fingerprint = self.module_fingerprints.get(modules)
+        if fingerprint is None:
+            modulepath = setup.get('modulepath')
+            if modulepath is None:
+                modulepath = [
+                    p for p in os.environ.get('MODULEPATH', '').split(':')
+                    if p]
+            modulepath = [os.path.expandvars(p) for p in modulepath]
+            watch = [os.path.expanduser(os.path.expandvars(f))
+                     for f in setup.get('watch', [])]
+            with self.metrics.timer('fingerprint_modules'):
+                fingerprint = get_modules_fingerprint(
+                        modules.split(), modulepath, watch)
+            self.module_fingerprints[modules] = fingerprint
+        sha1 = hashlib.sha1()
+        for value in [modules, fingerprint] + commands:
+            sha1.update(value.encode('utf-8'))
+            sha1.update(b'\n')
+        filename = os.path.join(
+                os.path.expandvars(snapshot_dir % self.kwargs),
+                sha1.hexdigest()[:20] + '.env')
+        return '\n'.join(render_environment(
+            commands, modules, filename, setup.get('exclude', ())))
+
+    def render_preamble(self, task, runner_name):
+        """Render commands inserted at the beginning of a runner script.
+
+        If the ``completion.sentinel_dir`` option is set, the runner writes a
+        sentinel file named after the runner into that directory when it
+        exits, see :py:func:`.completion_watcher.render_sentinel`. If the
+        ``heartbeat.dir`` option is set, the runner reports regularly that it
+        is alive, see :py:func:`.watchdog.render_heartbeat`. If the
+        ``speculation`` section is given, the runner claims the commit of the
+        outputs of its tasks, see :py:func:`.speculator.render_claims`. If the
+        ``results.dir`` option is set, the results of the tasks are collected,
+        see :py:func:`.result_store.render_results`.
+
+        Parameters
+        ----------
+        task : Task
+            Task for which the runner script is created.
+        runner_name : str
+            Filename of the runner script.
+
+        Returns
+        -------
+        lines : list of str
+            Lines of the preamble, possibly empty.
+        """
+        lines = []
+        on_exit = []
+        if 'speculation' in self.kwargs:
+            lines += render_claims(
+                    self.copy_origins.get(task, runner_name))
+        if self.heartbeat_dir is not None:
+            start, stop = render_heartbeat(
+                    runner_name, self.get_heartbeat_filename(runner_name),
+                    self.kwargs.get('heartbeat', {}).get('interval', 60),
+                    self.get_job_id_reference())
+            lines += start
+            on_exit += stop
+        if self.results_dir is not None:
+            start, stop = render_results(
+                    self.get_segment_filename(runner_name),
+                    None if getattr(task, 'tasks', None) is not None
+                    else task.get_key())
+            lines += start
+            on_exit += stop
+        if self.sentinel_dir is not None:
+            start, stop = render_sentinel(
+                    runner_name, self.get_sentinel_filename(runner_name),
+                    self.get_job_id_reference())
+            lines += start
+            on_exit += stop
+        if not on_exit:
+            return lines
+        return lines + [
+            'yatamana_exit () {',
+            '\tlocal rv=$?'] + ['\t' + line for line in on_exit] + [
+            '}',
+            'trap yatamana_exit EXIT']
+
+    def get_job_id_reference(self):
+        """Get a shell word expanding to the job ID inside a job.
+
+        Returns
+        -------
+        reference : str
+            Reference to :py:attr:`job_id_variable`, empty if there is none.
+        """
+        if self.job_id_variable:
+            return '$%s' % self.job_id_variable
+        return ''
+
+    def get_segment_filename(self, runner_name):
+        """Get the filename of the segment of results written by a runner.
+
+        Parameters
+        ----------
+        runner_name : str
+            Filename of the runner script.
+
+        Returns
+        -------
+        filename : str
+            Filename of the segment, its index has the ``.idx`` suffix.
+        """
+        name = os.path.splitext(os.path.basename(runner_name))[0]
+        return os.path.join(self.results_dir, name + '.seg')
+
+    def get_heartbeat_filename(self, runner_name):
+        """Get the filename of the heartbeat written by a runner.
+
+        Parameters
+        ----------
+        runner_name : str
+            Filename of the runner script.
+
+        Returns
+        -------
+        filename : str
+            Filename of the heartbeat.
+        """
+        name = os.path.splitext(os.path.basename(runner_name))[0]
+        return os.path.join(self.heartbeat_dir, name + '.json')
+
+    def get_sentinel_filename(self, runner_name):
+        """Get the filename of the sentinel written by a runner.
+
+        Parameters
+        ----------
+        runner_name : str
+            Filename of the runner script.
+
+        Returns
+        -------
+        filename : str
+            Filename of the sentinel.
+        """
+        name = os.path.splitext(os.path.basename(runner_name))[0]
+        return os.path.join(self.sentinel_dir, name + '.json')
+
+    def watch_completions(self, **kwargs):
+        """Create a watcher of the sentinels of finished jobs.
+
+        Parameters
+        ----------
+        kwargs
+            Arguments of :py:class:`.CompletionWatcher`, defaults are taken
+            from the ``completion`` section of the setup.
+
+        Returns
+        -------
+        watcher : CompletionWatcher
+            Watcher of ``completion.sentinel_dir``.
+        """
+        if self.sentinel_dir is None:
+            raise ValueError('Missing completion.sentinel_dir option')
+        setup = self.kwargs.get('completion', {})
+        for name in ('scan_interval', 'use_inotify'):
+            if name in setup:
+                kwargs.setdefault(name, setup[name])
+        return CompletionWatcher(self.sentinel_dir, **kwargs)
+
+    def wait_for_tasks(self, tasks, timeout=None, watcher=None):
+        """Iterate over enqueued tasks as their jobs finish.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks.
+        timeout : float, optional
+            Maximum number of seconds to wait in total. Default: no limit.
+        watcher : CompletionWatcher, optional
+            Watcher to use. Default: create one by
+            :py:meth:`.watch_completions`.
+
+        Returns
+        -------
+        finished : iterator of (Task, dict)
+            Finished tasks with the records of their sentinels, in the order
+            of finishing. The exit code is in the `exit_code` item.
+        """
+        pending = dict(
+                (os.path.splitext(os.path.basename(t.runner_name))[0], t)
+                for t in tasks)
+        own_watcher = watcher is None
+        if own_watcher:
+            watcher = self.watch_completions()
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while pending:
+                remaining = None if deadline is None else \
+                    max(0, deadline - time.time())
+                records = watcher.poll(remaining)
+                for record in records:
+                    task = pending.pop(record['name'], None)
+                    if task is not None:
+                        yield task, record
+                if deadline is not None and time.time() >= deadline:
+                    break
+        finally:
+            if own_watcher:
+                watcher.close()
+
+    def export_metrics(self):
+        """Write the collected metrics to the files given in the setup.
+
+        The ``metrics`` section of the setup can contain the filenames
+        ``prometheus`` (Prometheus text format), ``json``, and ``profile``
+        (cProfile statistics of the enqueueing, readable by :py:mod:`pstats`).
+        """
+        setup = self.kwargs.get('metrics', {})
+        if setup.get('prometheus') is not None:
+            self.metrics.export_prometheus(
+                    os.path.expandvars(setup['prometheus']))
+        if setup.get('json') is not None:
+            self.metrics.export_json(os.path.expandvars(setup['json']))
+        if setup.get('profile') is not None:
+            self.metrics.export_profile()
+
     def get_runner_setup(self):
         """Get a runner section of the setup.
         """
@@ -252,3 +1324,28 @@ class TaskManager(object):
             opts.update(setup)
         opts = deepcopy(opts)
         return opts
+
+    def get_shared_defaults(self, clsname):
+        """Get defaults shared by all the tasks of a given class.
+
+        Unlike :py:meth:`get_task_defaults`, the defaults are computed once per
+        class and include the defaults of every task, so that the enqueued
+        tasks can refer to them instead of keeping their own copies.
+
+        Parameters
+        ----------
+        clsname : string
+            Name of the task class.
+
+        Returns
+        -------
+        defaults : SharedDefaults
+            Read-only default options.
+        """
+        defaults = self.shared_defaults.get(clsname)
+        if defaults is None:
+            defaults = DEFAULTS.copy()
+            defaults.update(self.get_task_defaults(clsname))
+            defaults = SharedDefaults(defaults)
+            self.shared_defaults[clsname] = defaults
+        return defaults
@@ -4,6 +4,8 @@ import json
 from .local_task_manager import LocalTaskManager
 from .sge_task_manager import SgeTaskManager
 from .slurm_task_manager import SlurmTaskManager
+from .condor_task_manager import CondorTaskManager
+from .federated_task_manager import FederatedTaskManager
 
 
 def get_task_manager(setup_file, **kwargs):
@@ -11,8 +13,8 @@ def get_task_manager(setup_file, **kwargs):
 
     Parameters
     ----------
-    setup_file : string
-        File name of the setup file.
+    setup_file : string | dict
+        File name of the setup file, or the setup itself.
     kwargs : dict
         Additional kwargs.
 
@@ -21,13 +23,20 @@ def get_task_manager(setup_file, **kwargs):
     manager : TaskManager
         Created task manager.
     """
-    setup = json.load(open(setup_file))
+    if isinstance(setup_file, dict):
+        setup = setup_file
+    else:
+        setup = json.load(open(setup_file))
     manager = setup['manager'].lower()
     if manager == 'slurm':
         return SlurmTaskManager(setup_file, **kwargs)
     elif manager == 'sge':
         return SgeTaskManager(setup_file, **kwargs)
+    elif manager == 'condor':
+        return CondorTaskManager(setup_file, **kwargs)
     elif manager == 'local':
         return LocalTaskManager(setup_file, **kwargs)
+    elif manager == 'federated':
+        return FederatedTaskManager(setup_file, **kwargs)
     else:
         raise ValueError('Unknown task manager: %s', manager)
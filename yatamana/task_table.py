@@ -0,0 +1,223 @@
+"""
+yatamana.task_table
+-------------------
+
+Column-wise description of large sweeps of tasks.
+
+Millions of task objects with their option dicts take a lot of memory. A
+:py:class:`TaskTable` stores only the parameters of the tasks, column by
+column, and creates the tasks on demand, e.g., one chunk at a time while
+enqueueing them by :py:meth:`.TaskManager.enqueue_chunked`.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import numbers
+from array import array
+from collections import OrderedDict
+
+
+class Column(object):
+    """Column of values stored compactly.
+
+    Integers and floats are stored in arrays of machine types. Other hashable
+    values, e.g. strings, are stored as indices into a list of the distinct
+    values. Unhashable values are stored as they are.
+
+    Parameters
+    ----------
+    values : iterable, optional
+        Initial values.
+    """
+    __slots__ = ('kind', 'data', 'levels', 'level_index')
+
+    def __init__(self, values=()):
+        self.kind = None
+        self.data = None
+        self.levels = None
+        self.level_index = None
+        for value in values:
+            self.append(value)
+
+    @staticmethod
+    def get_kind(value):
+        if isinstance(value, numbers.Integral) and \
+                not isinstance(value, bool):
+            return 'int'
+        if isinstance(value, float):
+            return 'float'
+        try:
+            hash(value)
+        except TypeError:
+            return 'objects'
+        return 'levels'
+
+    def convert(self, kind):
+        """Convert the stored values to a more general kind.
+
+        Parameters
+        ----------
+        kind : str
+            Either 'levels' or 'objects'.
+        """
+        values = list(self)
+        self.kind = kind
+        if kind == 'levels':
+            self.data = array(str('l'))
+            self.levels = []
+            self.level_index = {}
+        else:
+            self.data = []
+            self.levels = None
+            self.level_index = None
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        """Append a value.
+
+        Parameters
+        ----------
+        value : object
+            Value to append.
+        """
+        kind = self.get_kind(value)
+        if self.kind is None:
+            self.kind = kind
+            if kind == 'objects':
+                self.data = []
+            else:
+                self.data = array(str('d' if kind == 'float' else 'l'))
+                if kind == 'levels':
+                    self.levels = []
+                    self.level_index = {}
+        if self.kind in ('int', 'float') and kind != self.kind:
+            self.convert('objects' if kind == 'objects' else 'levels')
+        elif self.kind == 'levels' and kind == 'objects':
+            self.convert('objects')
+        if self.kind == 'int':
+            try:
+                self.data.append(value)
+                return
+            except OverflowError:
+                self.convert('levels')
+        if self.kind == 'levels':
+            # Keep e.g. 1 and 1.0 apart.
+            key = (type(value), value)
+            code = self.level_index.get(key)
+            if code is None:
+                code = len(self.levels)
+                self.levels.append(value)
+                self.level_index[key] = code
+            self.data.append(code)
+        else:
+            self.data.append(value)
+
+    def __len__(self):
+        return 0 if self.data is None else len(self.data)
+
+    def __getitem__(self, i):
+        if self.kind == 'levels':
+            return self.levels[self.data[i]]
+        return self.data[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class TaskTable(object):
+    """Table of parameters of tasks created on demand.
+
+    Parameters
+    ----------
+    factory : callable
+        Called with the values of a row as keyword arguments to create its
+        task, typically the class of the tasks.
+    columns : dict, optional
+        Columns of the table, mapping names of the parameters to sequences of
+        their values of the same length.
+
+    Examples
+    --------
+    >>> table = TaskTable(FitTask, OrderedDict([  # doctest: +SKIP
+    ...     ('sample', samples), ('alpha', alphas)]))
+    >>> for job in task_manager.enqueue_chunked(table):  # doctest: +SKIP
+    ...     pass
+    """
+    __slots__ = ('factory', 'columns')
+
+    def __init__(self, factory, columns=None):
+        self.factory = factory
+        self.columns = OrderedDict()
+        if columns:
+            n = None
+            for name, values in columns.items():
+                self.columns[name] = Column(values)
+                if n is not None and len(self.columns[name]) != n:
+                    raise ValueError(
+                            'Columns of a task table differ in length.')
+                n = len(self.columns[name])
+
+    def append(self, **row):
+        """Append parameters of a task.
+
+        Parameters
+        ----------
+        row
+            Values of all the columns. The first row of an empty table
+            defines the columns.
+        """
+        if not self.columns:
+            for name in sorted(row):
+                self.columns[name] = Column()
+        if set(row) != set(self.columns):
+            raise ValueError('Expected values of columns: %s, got: %s' % (
+                ', '.join(self.columns), ', '.join(sorted(row))))
+        for name, column in self.columns.items():
+            column.append(row[name])
+
+    def extend(self, rows):
+        """Append parameters of multiple tasks.
+
+        Parameters
+        ----------
+        rows : iterable of dict
+            Values of all the columns for each task.
+        """
+        for row in rows:
+            self.append(**row)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def get_row(self, i):
+        """Get parameters of a task.
+
+        Parameters
+        ----------
+        i : int
+            Index of the task.
+
+        Returns
+        -------
+        row : dict
+            Values of all the columns.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Task table index out of range.')
+        return dict(
+                (name, column[i]) for name, column in self.columns.items())
+
+    def __getitem__(self, i):
+        return self.factory(**self.get_row(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,317 @@
+"""
+yatamana.transport
+------------------
+
+Transports running the commands of task managers, e.g. submissions and queue
+listings.
+
+:py:class:`LocalTransport` starts a new process for every command.
+:py:class:`ShellTransport` keeps a single shell running and sends it the
+commands one after another, their outputs are delimited by frame lines.
+:py:class:`SshTransport` does the same with a shell on a remote host reached
+over a multiplexed ssh connection, so that jobs can be submitted from outside
+of the cluster. The runners have to be on a file system shared with the
+remote host in that case, see the ``shared_tmp`` option.
+
+"""
+
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import logging
+import os
+import subprocess
+import threading
+from uuid import uuid4
+from .utils import run_cmd, quote
+
+
+class LocalTransport(object):
+    """Run every command in a new local process.
+    """
+
+    def run(self, cmd):
+        """Run a command.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Command to run.
+
+        Returns
+        -------
+        out : bytes
+            Stdout and stderr of the command.
+
+        Raises
+        ------
+        RuntimeError
+            If the command returns a non-zero exit code.
+        """
+        return run_cmd(cmd)
+
+    def run_many(self, cmds):
+        """Run multiple commands.
+
+        Parameters
+        ----------
+        cmds : list of list of str
+            Commands to run.
+
+        Returns
+        -------
+        results : list of tuple
+            Exit code and output of each command.
+        """
+        results = []
+        for cmd in cmds:
+            p = subprocess.Popen(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out = p.communicate()[0]
+            results += [(p.returncode, out)]
+        return results
+
+    def close(self):
+        """Release the resources of the transport.
+        """
+
+
+class ShellTransport(LocalTransport):
+    """Run commands in a single long-lived shell.
+
+    Each command is written to the standard input of the shell followed by a
+    command printing a frame line with a random marker, the sequence number
+    of the command, and its exit code. The output of the command is read up
+    to its frame line. Multiple commands can be pipelined, i.e., written
+    before reading their outputs, see :py:meth:`run_many`. The shell is
+    restarted if it dies.
+
+    Parameters
+    ----------
+    shell : list of str, optional
+        Command starting the shell reading commands from its standard input.
+    max_pipelined : int, optional
+        Maximum number of commands written ahead of their outputs. Bounds the
+        amount of data in the pipes so that neither side blocks.
+    """
+
+    def __init__(self, shell=('/bin/bash', '--noprofile', '--norc', '-s'),
+                 max_pipelined=32):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.shell = list(shell)
+        self.max_pipelined = max_pipelined
+        self.marker = 'yatamana-frame-%s' % uuid4().hex
+        self.process = None
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the shell and wait until it is ready.
+
+        Anything the shell prints when starting, e.g. a message of the day,
+        is discarded.
+        """
+        self.log.info('Starting %s', ' '.join(self.shell))
+        self.process = subprocess.Popen(
+                self.shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        seq = self.write(['true'])
+        self.flush()
+        self.read(seq)
+
+    def write(self, cmd):
+        """Write a command to the shell.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Command to run.
+
+        Returns
+        -------
+        seq : int
+            Sequence number of the command.
+        """
+        self.seq += 1
+        line = '%s < /dev/null 2>&1; printf "\\n%s %d %%d\\n" $?\n' % (
+                ' '.join(quote(c) for c in cmd), self.marker, self.seq)
+        self.process.stdin.write(line.encode('utf-8'))
+        return self.seq
+
+    def flush(self):
+        self.process.stdin.flush()
+
+    def read(self, seq):
+        """Read the output of a command.
+
+        Parameters
+        ----------
+        seq : int
+            Sequence number of the command.
+
+        Returns
+        -------
+        returncode : int
+            Exit code of the command.
+        out : bytes
+            Output of the command.
+
+        Raises
+        ------
+        RuntimeError
+            If the shell ends before printing the frame of the command.
+        """
+        prefix = ('%s %d ' % (self.marker, seq)).encode('ascii')
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                returncode = self.process.wait()
+                self.process = None
+                raise RuntimeError('Shell %s ended (%d): %s' % (
+                    ' '.join(self.shell), returncode,
+                    b''.join(lines).decode('utf-8', 'replace')))
+            if line.startswith(prefix):
+                returncode = int(line[len(prefix):])
+                break
+            lines += [line]
+        # Drop the newline printed before the frame.
+        return returncode, b''.join(lines)[:-1]
+
+    def run_many(self, cmds):
+        """Run multiple commands pipelined through the shell.
+
+        Parameters
+        ----------
+        cmds : list of list of str
+            Commands to run.
+
+        Returns
+        -------
+        results : list of tuple
+            Exit code and output of each command.
+        """
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            results = []
+            pending = []
+            try:
+                for cmd in cmds:
+                    if len(pending) >= self.max_pipelined:
+                        self.flush()
+                        results += [self.read(pending.pop(0))]
+                    pending += [self.write(cmd)]
+                self.flush()
+                while pending:
+                    results += [self.read(pending.pop(0))]
+            except (IOError, OSError) as e:
+                # Broken pipe, the shell will be restarted by the next call.
+                self.close()
+                raise RuntimeError('Shell %s failed: %s' % (
+                    ' '.join(self.shell), e))
+            return results
+
+    def run(self, cmd):
+        """Run a command in the shell.
+
+        Parameters
+        ----------
+        cmd : list of str
+            Command to run.
+
+        Returns
+        -------
+        out : bytes
+            Stdout and stderr of the command.
+
+        Raises
+        ------
+        RuntimeError
+            If the command returns a non-zero exit code.
+        """
+        returncode, out = self.run_many([cmd])[0]
+        if returncode != 0:
+            raise RuntimeError('Error running "%s" (%d): %s' % (
+                ' '.join(cmd), returncode, out))
+        return out
+
+    def close(self):
+        """Stop the shell.
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+        self.process = None
+
+
+class SshTransport(ShellTransport):
+    """Run commands in a single long-lived shell on a remote host.
+
+    The ssh connection is multiplexed by a control master kept alive for
+    `control_persist` seconds, so that restarting the shell or running other
+    ssh commands does not need a new connection.
+
+    Parameters
+    ----------
+    host : str
+        Remote host, optionally with the user, e.g. ``'me@login1'``.
+    options : list of str, optional
+        Additional options of ssh.
+    control_path : str, optional
+        Path of the control socket. Default:
+        ``~/.ssh/yatamana-%r@%h:%p``.
+    control_persist : int, optional
+        Seconds the control master stays alive when unused. Default: 600.
+    shell : list of str, optional
+        Command starting the remote shell. Default: a login shell, so that
+        the submitters are on the path.
+    max_pipelined : int, optional
+        See :py:class:`ShellTransport`.
+    """
+
+    def __init__(self, host, options=(), control_path=None,
+                 control_persist=600, shell=('bash', '-l', '-s'),
+                 max_pipelined=32):
+        if control_path is None:
+            control_path = os.path.join('~', '.ssh', 'yatamana-%r@%h:%p')
+        ssh = [
+            'ssh', '-T',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.expanduser(control_path),
+            '-o', 'ControlPersist=%d' % control_persist] + list(options)
+        super(SshTransport, self).__init__(
+                ssh + [host, ' '.join(quote(s) for s in shell)],
+                max_pipelined=max_pipelined)
+
+
+def get_transport(setup=None):
+    """Create a transport from its setup.
+
+    Parameters
+    ----------
+    setup : dict, optional
+        The ``transport`` section of the setup, i.e., the `type` of the
+        transport ('local', 'shell', or 'ssh') and the arguments of its
+        class. Default: a :py:class:`LocalTransport`.
+
+    Returns
+    -------
+    transport : LocalTransport
+        Created transport.
+    """
+    setup = dict(setup or {})
+    kind = setup.pop('type', 'local').lower()
+    if kind == 'local':
+        return LocalTransport(**setup)
+    elif kind == 'shell':
+        return ShellTransport(**setup)
+    elif kind == 'ssh':
+        return SshTransport(**setup)
+    else:
+        raise ValueError('Unknown transport: %s' % kind)
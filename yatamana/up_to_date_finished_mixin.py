@@ -0,0 +1,233 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import hashlib
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from .utils import quote
+
+_digests = {}
+_digests_users = 0
+_digests_lock = threading.Lock()
+
+
+def get_fingerprint(filename, mode='hash'):
+    """Get a fingerprint of the contents of a file.
+
+    While :py:func:`find_unfinished` runs, digests of file contents are
+    cached by filename, size, and modification time, so that a file shared by
+    many tasks is read only once. The cache is dropped when it returns.
+
+    Parameters
+    ----------
+    filename : str
+        Filename.
+    mode : str, optional
+        Either 'hash' to use the SHA1 digest of the contents, or 'mtime' to use
+        the size and the modification time in whole seconds. Default: 'hash'.
+
+    Returns
+    -------
+    fingerprint : str | None
+        Fingerprint of the file, or None if it does not exist.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if mode == 'mtime':
+        return '%d:%d' % (st.st_size, st.st_mtime)
+    elif mode != 'hash':
+        raise ValueError('Unknown fingerprint mode: %s' % mode)
+    key = (filename, st.st_size, st.st_mtime)
+    with _digests_lock:
+        digest = _digests.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as fr:
+            for block in iter(lambda: fr.read(1 << 20), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+        with _digests_lock:
+            if _digests_users:
+                _digests[key] = digest
+    return digest
+
+
+#: Shell commands printing the fingerprint of a file as a json value, see
+#: :py:func:`get_fingerprint`.
+FINGERPRINT_COMMANDS = {
+        'hash': 'sha1sum < "$1" | cut -d " " -f 1',
+        'mtime': 'stat -L -c %s:%Y "$1"'}
+
+
+class UpToDateFinishedMixin(object):
+    """Mixin checking that the outputs are up to date with the inputs.
+
+    The task is finished if all its outputs exist and they were produced by
+    the same command with the same parameters from the same inputs. This is
+    recorded by a stamp file written by the runner after the command
+    succeeds. The runner fingerprints the inputs then, by ``sha1sum`` or
+    ``stat``, so that inputs rewritten by upstream jobs of the same campaign
+    are recorded as the command read them.
+
+    The task has to specify the following attributes:
+
+    - `inputs` - list of input filenames,
+    - `outputs` - list of output filenames, at least one,
+    - `params` - optional dict of parameters not visible in the command.
+
+    Attributes
+    ----------
+    fingerprint_mode : str
+        Either 'hash' (default) to compare the inputs by their contents, or
+        'mtime' to compare them only by their size and modification time,
+        which is cheap but less reliable.
+    """
+
+    __slots__ = ()
+    fingerprint_mode = 'hash'
+
+    def get_stamp_filename(self):
+        """Get the filename of the stamp next to the first output.
+
+        Returns
+        -------
+        filename : str
+            Filename of the stamp.
+        """
+        return self.outputs[0] + '.yatamana'
+
+    def get_command_digest(self):
+        """Get the digest of the command and parameters.
+
+        Returns
+        -------
+        digest : str
+            SHA1 digest of the command and the json of the parameters.
+        """
+        command = super(UpToDateFinishedMixin, self).render_command()
+        params = json.dumps(
+                getattr(self, 'params', None), sort_keys=True, default=str)
+        sha1 = hashlib.sha1()
+        sha1.update(command.encode('utf-8'))
+        sha1.update(params.encode('utf-8'))
+        return sha1.hexdigest()
+
+    def get_stamp(self):
+        """Get the stamp describing the current command and inputs.
+
+        Returns
+        -------
+        stamp : dict
+            Digest of the command and parameters, see
+            :py:meth:`get_command_digest`, and fingerprints of the inputs.
+        """
+        return {
+                'command': self.get_command_digest(),
+                'inputs': dict(
+                    (filename, get_fingerprint(
+                        filename, self.fingerprint_mode))
+                    for filename in self.inputs)}
+
+    def is_finished(self):
+        """Return True if the outputs are up to date.
+        """
+        if not all(os.path.exists(filename) for filename in self.outputs):
+            return False
+        stamp_filename = self.get_stamp_filename()
+        try:
+            with open(stamp_filename) as fr:
+                recorded = json.load(fr)
+            stamp_mtime = os.path.getmtime(stamp_filename)
+        except (IOError, OSError, ValueError):
+            return False
+        current = self.get_stamp()
+        if recorded.get('command') != current['command']:
+            return False
+        recorded_inputs = recorded.get('inputs', {})
+        for filename, fingerprint in current['inputs'].items():
+            if filename not in recorded_inputs or fingerprint is None:
+                return False
+            if recorded_inputs[filename] is None:
+                # Missing when the stamp was written.
+                if os.path.getmtime(filename) > stamp_mtime:
+                    return False
+            elif recorded_inputs[filename] != fingerprint:
+                return False
+        return True
+
+    def render_command(self):
+        """Render the command followed by writing the stamp.
+
+        The stamp is written as json by printing its parts, with the
+        fingerprints of the inputs taken by the runner.
+
+        Returns
+        -------
+        command : str
+            Rendered command.
+        """
+        command = super(UpToDateFinishedMixin, self).render_command()
+        stamp_filename = self.get_stamp_filename()
+        tmp = stamp_filename + '.tmp'
+        parts = ['{"command": %s, "inputs": {' % json.dumps(
+            self.get_command_digest())]
+        for i, filename in enumerate(self.inputs):
+            parts += [
+                '%s%s: ' % (', ' if i else '', json.dumps(filename)),
+                '"$(yatamana_fingerprint %s)"' % quote(filename)]
+        parts += ['}}']
+        fingerprint = (
+            'yatamana_fingerprint() { [ -e "$1" ] && '
+            'printf \'"%%s"\' "$(%s)" || printf null; }' % (
+                FINGERPRINT_COMMANDS[self.fingerprint_mode]))
+        return '{ %s\n} && %s && printf %%s %s > %s && mv %s %s' % (
+                command, fingerprint, ' '.join(
+                    p if p.startswith('"$(') else quote(p) for p in parts),
+                quote(tmp), quote(tmp), quote(stamp_filename))
+
+
+def find_unfinished(tasks, n_threads=8):
+    """Find tasks that are not finished.
+
+    The inputs of all the tasks are fingerprinted in parallel first, each of
+    them only once. Then the tasks are checked in parallel as well. The
+    digests are cached only until the last concurrent call returns.
+
+    Parameters
+    ----------
+    tasks : iterable of Task
+        Tasks to check.
+    n_threads : int, optional
+        Number of threads reading the files. Default: 8.
+
+    Returns
+    -------
+    unfinished : list of Task
+        Tasks whose :py:meth:`is_finished` returned False, in the original
+        order.
+    """
+    global _digests_users
+    tasks = list(tasks)
+    inputs = set()
+    for task in tasks:
+        mode = getattr(task, 'fingerprint_mode', None)
+        if mode is not None:
+            inputs.update((f, mode) for f in task.inputs)
+    with _digests_lock:
+        _digests_users += 1
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(lambda args: get_fingerprint(*args), inputs, chunksize=64)
+        finished = pool.map(lambda t: t.is_finished(), tasks, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+        with _digests_lock:
+            _digests_users -= 1
+            if not _digests_users:
+                _digests.clear()
+    return [task for task, done in zip(tasks, finished) if not done]
@@ -21,6 +21,11 @@ import sys
 from base64 import b64encode
 from math import ceil
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 
 def parse_walltime(value):
     """Parse walltime in the setup file.
@@ -54,6 +59,7 @@ def parse_walltime(value):
     days, hours, minutes, seconds = 0, 0, 0, 0
     if '-' in value:
         days, value = value.split('-')
+        days = int(days)
         if ':' in value:
             value = value.split(':')
         else:
@@ -133,6 +139,24 @@ def run_cmd(cmd):
         sys.exit(signal.SIGTERM)
 
 
+def decode_output(out):
+    """Decode output of a command into a string.
+
+    Parameters
+    ----------
+    out : bytes | str
+        Output as returned by :py:func:`run_cmd`.
+
+    Returns
+    -------
+    out : str
+        Decoded output.
+    """
+    if isinstance(out, bytes):
+        out = out.decode('utf-8', 'replace')
+    return out
+
+
 def which(name):
     """ Find a full path of an executable.
 
@@ -258,3 +282,21 @@ def make_executable(path):
     mode = os.stat(path).st_mode
     mode |= (mode & 0o444) >> 2    # copy R bits to X
     os.chmod(path, mode)
+
+
+def render_export_functions():
+    """ Render exporting the shell functions of a runner.
+
+    Commands run by a new ``"$BASH" -c`` rather than in a subshell, e.g., by
+    a profiler or by ``srun``, can then call the functions defined by the
+    runner template, like ``module``. Variables of the runner have to be
+    exported by the template itself.
+
+    Returns
+    -------
+    lines : list of str
+        Lines of the rendered shell commands.
+    """
+    return [
+        'yatamana_functions=$(declare -F | cut -d " " -f 3)',
+        '[ -z "$yatamana_functions" ] || export -f $yatamana_functions']
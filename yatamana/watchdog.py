@@ -0,0 +1,266 @@
+from __future__ import (
+        division, print_function, unicode_literals, absolute_import)
+
+import json
+import logging
+import os
+import time
+from .utils import quote
+
+
+class Watchdog(object):
+    """Cancel and optionally resubmit jobs that hang.
+
+    Runners report regularly that they are alive when the ``heartbeat``
+    section of the setup is given, see :py:func:`render_heartbeat`.
+    A running job is considered hung if its heartbeat did not change for
+    `stall_timeout` seconds, e.g., because it is stuck on a file system, or if
+    its processes used less than `min_cpu` CPU seconds per second during the
+    last `idle_timeout` seconds, e.g., because of a deadlock.
+    Tasks enqueued by :py:meth:`.CondorTaskManager.enqueue_dag` share the job
+    of DAGMan and cannot be watched.
+
+    The defaults of the parameters are taken from the ``heartbeat`` section::
+
+        "heartbeat": {
+          "dir": "%(shared_tmp)s/heartbeats",
+          "interval": 60,
+          "stall_timeout": 900,
+          "idle_timeout": 3600,
+          "min_cpu": 0.01,
+          "max_resubmits": 1
+        }
+
+    Parameters
+    ----------
+    manager : TaskManager
+        Manager that enqueued the tasks.
+    stall_timeout : float, optional
+        Seconds without a new heartbeat. Default: 10 heartbeat intervals.
+    idle_timeout : float, optional
+        Length of the window in seconds over which CPU use is checked.
+        Default: None, CPU use is not checked.
+    min_cpu : float, optional
+        Minimum CPU seconds per second within the window. Default: 0.01.
+    max_resubmits : int, optional
+        Number of times a cancelled task is resubmitted. Default: 0.
+    """
+
+    def __init__(self, manager, stall_timeout=None, idle_timeout=None,
+                 min_cpu=None, max_resubmits=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if manager.heartbeat_dir is None:
+            raise ValueError('Missing heartbeat.dir option')
+        setup = manager.kwargs.get('heartbeat', {})
+        self.manager = manager
+        self.interval = setup.get('interval', 60)
+        self.stall_timeout = stall_timeout if stall_timeout is not None \
+            else setup.get('stall_timeout', 10 * self.interval)
+        self.idle_timeout = idle_timeout if idle_timeout is not None \
+            else setup.get('idle_timeout')
+        self.min_cpu = min_cpu if min_cpu is not None \
+            else setup.get('min_cpu', 0.01)
+        self.max_resubmits = max_resubmits if max_resubmits is not None \
+            else setup.get('max_resubmits', 0)
+        self.last_change = {}
+        self.cpu_history = {}
+        self.resubmits = {}
+
+    def read_heartbeat(self, task):
+        """Read the last heartbeat of the job of a task.
+
+        Parameters
+        ----------
+        task : Task
+            Enqueued task.
+
+        Returns
+        -------
+        heartbeat : dict | None
+            Time, CPU time used by the job in seconds, and progress reported
+            by the tasks, or None if there is no heartbeat of the current job
+            of the task.
+        """
+        filename = self.manager.get_heartbeat_filename(task.runner_name)
+        try:
+            with open(filename) as fr:
+                heartbeat = json.load(fr)
+        except (IOError, OSError, ValueError):
+            return None
+        job_id = heartbeat.get('job_id')
+        if job_id and job_id != str(task.job_id):
+            # Heartbeat of a previous job of a resubmitted task.
+            return None
+        return heartbeat
+
+    def is_hung(self, task, now):
+        """Check whether the running job of a task hangs.
+
+        Parameters
+        ----------
+        task : Task
+            Task whose job is running.
+        now : float
+            Current time.
+
+        Returns
+        -------
+        reason : str | None
+            Reason why the job is considered hung, or None.
+        """
+        heartbeat = self.read_heartbeat(task)
+        beat = None if heartbeat is None else heartbeat.get('time')
+        # Stalls are measured by the clock of the driver to avoid clock skew.
+        last_beat, last_change = self.last_change.get(
+                task.job_id, (None, now))
+        if beat != last_beat:
+            last_change = now
+        self.last_change[task.job_id] = (beat, last_change)
+        if now - last_change > self.stall_timeout:
+            return 'no heartbeat for %ds' % (now - last_change)
+        if self.idle_timeout is None or heartbeat is None:
+            return None
+        history = self.cpu_history.setdefault(task.job_id, [])
+        if not history or history[-1][0] != beat:
+            history += [(beat, heartbeat.get('cpu', 0.))]
+        while len(history) > 1 and history[1][0] <= beat - self.idle_timeout:
+            history.pop(0)
+        first_beat, first_cpu = history[0]
+        window = beat - first_beat
+        if window >= self.idle_timeout and \
+                history[-1][1] - first_cpu < self.min_cpu * window:
+            return 'CPU use %.3f over %ds' % (
+                    (history[-1][1] - first_cpu) / window, window)
+        return None
+
+    def check(self, tasks):
+        """Check the jobs of given tasks once, cancel and resubmit hung ones.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks.
+
+        Returns
+        -------
+        hung : list of tuple
+            Tasks whose jobs were cancelled with the reasons. Resubmitted
+            tasks have a new `job_id`.
+        """
+        tasks = list(tasks)
+        states = self.manager.get_task_states(tasks)
+        now = time.time()
+        hung = []
+        for task in tasks:
+            if states.get(task) != 'running':
+                continue
+            reason = self.is_hung(task, now)
+            if reason is not None:
+                self.log.warning('Job %s of %s hangs: %s', task.job_id, task,
+                                 reason)
+                hung += [(task, reason)]
+        if not hung:
+            return hung
+        self.manager.control('cancel', [task for task, _ in hung])
+        for task, _ in hung:
+            self.last_change.pop(task.job_id, None)
+            self.cpu_history.pop(task.job_id, None)
+            n = self.resubmits.get(task, 0)
+            if n >= self.max_resubmits:
+                continue
+            try:
+                os.remove(self.manager.get_heartbeat_filename(
+                    task.runner_name))
+            except OSError:
+                pass
+            self.manager.resubmit(task)
+            self.resubmits[task] = n + 1
+        return hung
+
+    def watch(self, tasks, interval=None):
+        """Check the jobs of given tasks until all of them leave the queue.
+
+        Parameters
+        ----------
+        tasks : iterable of Task
+            Enqueued tasks.
+        interval : float, optional
+            Seconds between checks. Default: the heartbeat interval.
+
+        Returns
+        -------
+        hung : iterator of tuple
+            Tasks whose jobs were cancelled with the reasons.
+        """
+        tasks = list(tasks)
+        if interval is None:
+            interval = self.interval
+        while True:
+            for item in self.check(tasks):
+                yield item
+            if not self.manager.get_task_states(tasks):
+                break
+            time.sleep(interval)
+
+
+def render_heartbeat(runner_name, filename, interval=60, job_id=''):
+    """Render commands reporting regularly that a job is alive.
+
+    A background loop writes every `interval` seconds a json record with the
+    time, the CPU time in seconds used so far by the processes of the job,
+    and the first line of the file ``$yatamana_progress``, where the tasks
+    can report their progress, see :py:class:`Watchdog`.
+
+    Parameters
+    ----------
+    runner_name : str
+        Filename of the runner script.
+    filename : str
+        Filename of the heartbeat.
+    interval : int, optional
+        Seconds between heartbeats. Default: 60.
+    job_id : str, optional
+        Shell word expanding to the job ID inside the job.
+
+    Returns
+    -------
+    start : list of str
+        Commands starting the loop.
+    stop : list of str
+        Commands run at exit stopping the loop.
+    """
+    directory = os.path.dirname(filename)
+    heartbeat = quote(filename)
+    tmp = quote(os.path.join(
+        directory, '.%s.tmp' % os.path.basename(runner_name)))
+    start = [
+        'yatamana_progress=$(mktemp '
+        '"${TMPDIR:-/tmp}/yatamana-progress.XXXXXX")',
+        'export yatamana_progress',
+        'yatamana_beat () {',
+        '\tlocal sid cpu progress',
+        '\tsid=$(ps -o sid= $$ | tr -d " ")',
+        # CPU time of the session including reaped children, tools like
+        # timeout move their children to process groups of their own.
+        '\tcpu=$(sed "s/^.*) //" /proc/[0-9]*/stat 2>/dev/null | '
+        'awk -v s="$sid" -v hz="$(getconf CLK_TCK)" '
+        '\'$4 == s {t += $12 + $13 + $14 + $15} '
+        'END {printf "%.2f", t / hz}\')',
+        '\tprogress=$(head -n 1 "$yatamana_progress" 2>/dev/null | '
+        'tr -d \'"\\\\\')',
+        '\tmkdir -p %s' % quote(directory or '.'),
+        '\tprintf \'{"runner": "%s", "job_id": "%s", "host": "%s", '
+        '"time": %d, "cpu": %s, "progress": "%s"}\\n\' \\',
+        '\t\t%s "%s" "$(hostname)" $(date +%%s) "$cpu" "$progress" \\' % (
+            quote(runner_name), job_id),
+        '\t\t> %s.$$ && mv %s.$$ %s' % (tmp, tmp, heartbeat),
+        '}',
+        '( while kill -0 $$ 2>/dev/null; do',
+        '\tyatamana_beat',
+        '\tsleep %d' % interval,
+        'done ) < /dev/null > /dev/null 2>&1 &',
+        'yatamana_heartbeat_pid=$!']
+    stop = [
+        'kill $yatamana_heartbeat_pid 2>/dev/null',
+        'rm -f "$yatamana_progress" %s' % heartbeat]
+    return start, stop